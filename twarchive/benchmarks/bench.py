@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Benchmark twarchive against a synthetic archive and site
+
+Generates a synthetic Twitter archive and Hugo site (see twarchive.synthetic),
+then times each benchmark and records its peak memory use.
+Results are compared against a baseline, and the script exits nonzero if anything regressed.
+
+Timings are the best of several runs, each from a fresh copy of the site.
+Peak memory is measured with tracemalloc in one more run,
+so it counts Python allocations only, and does not slow down the timed runs.
+
+Baselines only mean something on the machine that made them;
+run with --save-baseline to make one.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from twarchive import hugo
+from twarchive import synthetic
+from twarchive import twitterarchive
+from twarchive.inflatedtweet.body import tweet_html_bodies
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
+
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(SCRIPTDIR, "baseline.json")
+
+
+class Fixture(typing.NamedTuple):
+    """The synthetic data that benchmarks share
+
+    archive:    The synthetic archive
+    imported:   A site with the archive already imported and data2md already run
+    workdir:    A directory for benchmarks to make copies of the site in
+    """
+
+    archive: twitterarchive.TwitterArchive
+    imported: hugo.HugoSite
+    workdir: str
+
+
+def copy_site(site: hugo.HugoSite, path: str, cache=True) -> hugo.HugoSite:
+    """Copy a site, optionally without its caches"""
+    ignore = None if cache else shutil.ignore_patterns("cache")
+    shutil.copytree(site.base, path, ignore=ignore)
+    return hugo.HugoSite(path)
+
+
+def new_workdir(fixture: Fixture) -> str:
+    return tempfile.mkdtemp(dir=fixture.workdir)
+
+
+# Each benchmark takes the fixture, does any setup, and returns a function to time.
+
+
+def bench_archive2data(fixture: Fixture) -> typing.Callable:
+    site = synthetic.make_site(new_workdir(fixture), [], pages=0)
+    return lambda: twitterarchive.archive2data(site, fixture.archive, api=None)
+
+
+def bench_data2md(fixture: Fixture) -> typing.Callable:
+    site = copy_site(fixture.imported, os.path.join(new_workdir(fixture), "site"))
+    for page in os.listdir(site.content_twarchive):
+        os.remove(os.path.join(site.content_twarchive, page))
+    os.remove(site.data_twarchive_threads)
+    return lambda: hugo.data2md(site)
+
+
+def bench_jload(fixture: Fixture) -> typing.Callable:
+    site = fixture.imported
+    paths = [site.tweet_data_path(tweetid) for tweetid in site.tweet_index.ids()]
+    return lambda: [InflatedTweet.jload(filepath=path) for path in paths]
+
+
+def bench_jdump(fixture: Fixture) -> typing.Callable:
+    site = fixture.imported
+    tweets = [
+        InflatedTweet.jload(filepath=site.tweet_data_path(tweetid))
+        for tweetid in site.tweet_index.ids()
+    ]
+    outdir = new_workdir(fixture)
+
+    def run():
+        for tweet in tweets:
+            tweet.jdump(filepath=os.path.join(outdir, f"{tweet.id}.json"))
+
+    return run
+
+
+def bench_tweet_html_body(fixture: Fixture) -> typing.Callable:
+    tweets = [
+        outertweet["tweet"]
+        for outertweet in twitterarchive.iter_twitter_window_YTD_bullshit(
+            fixture.archive.tweetjs
+        )
+    ]
+
+    def run():
+        for tweet in tweets:
+            tweet_html_bodies(tweet["full_text"], tweet["entities"])
+
+    return run
+
+
+def bench_find_inline_tweets_cold(fixture: Fixture) -> typing.Callable:
+    site = copy_site(
+        fixture.imported, os.path.join(new_workdir(fixture), "site"), cache=False
+    )
+    return lambda: hugo.find_inline_tweets(site)
+
+
+def bench_find_inline_tweets_warm(fixture: Fixture) -> typing.Callable:
+    site = copy_site(fixture.imported, os.path.join(new_workdir(fixture), "site"))
+    hugo.find_inline_tweets(site)
+    return lambda: hugo.find_inline_tweets(site)
+
+
+BENCHMARKS = {
+    "archive2data": bench_archive2data,
+    "data2md": bench_data2md,
+    "jload": bench_jload,
+    "jdump": bench_jdump,
+    "tweet_html_body": bench_tweet_html_body,
+    "find_inline_tweets_cold": bench_find_inline_tweets_cold,
+    "find_inline_tweets_warm": bench_find_inline_tweets_warm,
+}
+
+
+def make_fixture(
+    workdir: str, params: synthetic.SyntheticArchiveParams, pages: int
+) -> Fixture:
+    site_path = os.path.join(workdir, "imported")
+    archive_path = os.path.join(site_path, "twitter-archives", "synthetic")
+    tweetids = synthetic.make_archive(archive_path, params)
+    site = synthetic.make_site(site_path, tweetids, pages=pages, seed=params.seed)
+    archive = twitterarchive.TwitterArchive.frompath(archive_path)
+    twitterarchive.archive2data(site, archive, api=None)
+    hugo.data2md(site)
+    hugo.find_inline_tweets(site)
+    return Fixture(archive, site, workdir)
+
+
+def measure(fixture: Fixture, benchmark: typing.Callable, repeat: int) -> typing.Dict:
+    """Return the best time and the peak memory of a benchmark"""
+    times = []
+    for _ in range(repeat):
+        run = benchmark(fixture)
+        # Don't make the timed run wait on writeback from setup
+        os.sync()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    run = benchmark(fixture)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def compare(
+    results: typing.Dict,
+    baseline: typing.Dict,
+    time_tolerance: float,
+    memory_tolerance: float,
+    time_slack: float,
+) -> typing.List[str]:
+    """Print results next to the baseline, and return a list of regressions
+
+    A benchmark regressed if it got slower by more than time_tolerance (a fraction)
+    and also by more than time_slack seconds,
+    so that fast benchmarks don't fail on noise,
+    or if its peak memory grew by more than memory_tolerance.
+    """
+    regressions = []
+    print(
+        f"{'benchmark':<26} {'seconds':>9} {'baseline':>9} {'peak MiB':>9} {'baseline':>9}"
+    )
+    for name, result in results.items():
+        base = baseline.get(name)
+        seconds, peak = result["seconds"], result["peak_bytes"]
+        base_seconds = f"{base['seconds']:9.3f}" if base else f"{'-':>9}"
+        base_peak = f"{base['peak_bytes'] / 2**20:9.1f}" if base else f"{'-':>9}"
+        print(
+            f"{name:<26} {seconds:9.3f} {base_seconds} {peak / 2**20:9.1f} {base_peak}"
+        )
+        if not base:
+            continue
+        slower = seconds - base["seconds"]
+        if slower > base["seconds"] * time_tolerance and slower > time_slack:
+            regressions.append(
+                f"{name} took {seconds:.3f}s, baseline {base['seconds']:.3f}s"
+            )
+        if peak > base["peak_bytes"] * (1 + memory_tolerance):
+            regressions.append(
+                f"{name} used {peak} bytes at peak, baseline {base['peak_bytes']}"
+            )
+    return regressions
+
+
+def main(*arguments):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    # The archive is the same shape as synthetic.py makes by default
+    defaults = synthetic.SyntheticArchiveParams()
+    parser.add_argument("--tweets", type=int, default=defaults.tweets)
+    parser.add_argument("--media-ratio", type=float, default=defaults.media_ratio)
+    parser.add_argument("--thread-depth", type=int, default=defaults.thread_depth)
+    parser.add_argument("--thread-ratio", type=float, default=defaults.thread_ratio)
+    parser.add_argument("--qt-ratio", type=float, default=defaults.qt_ratio)
+    parser.add_argument("--rt-ratio", type=float, default=defaults.rt_ratio)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--pages", type=int, default=200, help="Content pages that inline tweets"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Time the best of this many runs"
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=BENCHMARKS.keys(),
+        help="Run only this benchmark; may be passed more than once",
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline instead of comparing against it",
+    )
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--time-slack", type=float, default=0.05)
+    parser.add_argument("--memory-tolerance", type=float, default=0.10)
+    parser.add_argument(
+        "--workdir", help="Generate data here and keep it, instead of a temp dir"
+    )
+    parsed = parser.parse_args(arguments)
+
+    # archive2data logs every tweet
+    logging.getLogger("twarchive").setLevel(logging.WARNING)
+
+    params = synthetic.SyntheticArchiveParams(
+        tweets=parsed.tweets,
+        media_ratio=parsed.media_ratio,
+        thread_depth=parsed.thread_depth,
+        thread_ratio=parsed.thread_ratio,
+        qt_ratio=parsed.qt_ratio,
+        rt_ratio=parsed.rt_ratio,
+        seed=parsed.seed,
+    )
+    config = {
+        **params._asdict(),
+        "media_sizes": {str(k): v for k, v in params.media_sizes.items()},
+        "pages": parsed.pages,
+    }
+
+    if parsed.workdir:
+        os.makedirs(parsed.workdir, exist_ok=True)
+        workdir_context = contextlib.nullcontext(parsed.workdir)
+    else:
+        workdir_context = tempfile.TemporaryDirectory(prefix="twarchive-bench-")
+    with workdir_context as workdir:
+        start = time.perf_counter()
+        fixture = make_fixture(workdir, params, parsed.pages)
+        print(f"Generated fixture in {time.perf_counter() - start:.1f}s")
+        results = {
+            name: measure(fixture, BENCHMARKS[name], parsed.repeat)
+            for name in parsed.only or BENCHMARKS.keys()
+        }
+
+    if parsed.save_baseline:
+        with open(parsed.baseline, "w") as bfp:
+            json.dump(
+                {
+                    "config": config,
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                bfp,
+                indent=2,
+                sort_keys=True,
+            )
+        compare(results, {}, 0, 0, 0)
+        print(f"Saved baseline to {parsed.baseline}")
+        return
+
+    try:
+        with open(parsed.baseline) as bfp:
+            baseline = json.load(bfp)
+    except FileNotFoundError:
+        baseline = {"config": config, "results": {}}
+        print(f"No baseline at {parsed.baseline}, not comparing")
+    if baseline["config"] != config:
+        print("Baseline was made with different parameters, not comparing")
+        baseline["results"] = {}
+
+    regressions = compare(
+        results,
+        baseline["results"],
+        parsed.time_tolerance,
+        parsed.memory_tolerance,
+        parsed.time_slack,
+    )
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"- {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -30,6 +30,10 @@ setuptools.setup(
     python_requires=">=3.9",
     include_package_data=True,
     install_requires=["tweepy"],
+    extras_require={
+        "fast": ["orjson"],
+        "images": ["Pillow"],
+    },
     setup_requires=[
         "black",
         "mypy",
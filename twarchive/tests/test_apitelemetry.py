@@ -0,0 +1,97 @@
+"""Test apitelemetry.py"""
+
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from twarchive import apitelemetry
+from twarchive import ratelimit
+
+
+@contextlib.contextmanager
+def serve_rate_limited(remaining, reset):
+    """Serve a small JSON body with Twitter's rate limit headers"""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            status = 429 if self.path == "/refused" else 200
+            body = b'{"ok": true}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("x-rate-limit-limit", "900")
+            self.send_header("x-rate-limit-remaining", str(remaining))
+            self.send_header("x-rate-limit-reset", str(int(reset)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_request(self, code="-", size="-"):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+
+
+class FakeAPI:
+    """Just enough of tweepy.API: a requests session that calls are made with"""
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def get(self, url):
+        response = self.session.get(url)
+        response.raise_for_status()
+        return response.json()
+
+
+@pytest.fixture
+def fresh_buckets():
+    ratelimit.bucket.cache_clear()
+    yield
+    ratelimit.bucket.cache_clear()
+
+
+def test_call_records_latency_and_budget(tmp_path, fresh_buckets):
+    reset = time.time() + 600
+    report_path = tmp_path / "telemetry.json"
+    telemetry = apitelemetry.Telemetry(report_path=str(report_path))
+    api = FakeAPI()
+    with serve_rate_limited(remaining=10, reset=reset) as base:
+        for _ in range(3):
+            assert telemetry.call(api, "statuses/show", api.get, f"{base}/ok") == {
+                "ok": True
+            }
+        with pytest.raises(requests.HTTPError):
+            telemetry.call(api, "statuses/show", api.get, f"{base}/refused")
+
+    stats = telemetry.summary()["statuses/show"]
+    assert stats["calls"] == 4
+    assert stats["errors"] == 1
+    assert stats["statuses"] == {"200": 3, "429": 1}
+    assert sum(stats["latency_histogram"].values()) == 4
+    assert stats["bytes"] == 4 * len(b'{"ok": true}')
+    assert stats["budget"]["limit"] == 900
+    assert stats["budget"]["remaining"] == 10
+    assert 0 < stats["budget"]["calls_per_minute"] <= 1
+
+    # The headers drained the bucket from 900 tokens to what Twitter says is left
+    assert ratelimit.bucket("statuses/show").tokens <= 10
+
+    telemetry.dump()
+    with open(report_path) as rfp:
+        assert json.load(rfp)["statuses/show"]["calls"] == 4
+
+
+def test_observe_exhausted_window(fresh_buckets):
+    bucket = ratelimit.bucket("statuses/lookup")
+    bucket.observe(remaining=0, reset=time.time() + 60)
+    assert bucket.delay() > 50
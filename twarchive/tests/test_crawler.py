@@ -0,0 +1,302 @@
+"""Test crawler.py"""
+
+import asyncio
+import concurrent.futures
+import time
+
+import pytest
+import tweepy
+
+from twarchive import crawler
+from twarchive import ratelimit
+from twarchive import testutil
+from twarchive import twitterapi
+
+
+def status_json(tweetid: str, replyto: str = None, qt: str = None):
+    urls = []
+    if qt:
+        urls.append(
+            {
+                "url": f"https://t.co/{qt}",
+                "expanded_url": f"https://twitter.com/mrled/status/{qt}",
+                "display_url": f"twitter.com/mrled/status/{qt}",
+                "indices": [0, 0],
+            }
+        )
+    return {
+        "id": int(tweetid),
+        "id_str": tweetid,
+        "created_at": "Fri May 06 17:27:17 +0000 2022",
+        "full_text": f"Tweet {tweetid}",
+        "entities": {"hashtags": [], "urls": urls, "user_mentions": []},
+        "in_reply_to_status_id_str": replyto,
+        "in_reply_to_screen_name": "mrled" if replyto else None,
+        "user": {
+            "screen_name": "mrled",
+            "name": "Micah R Ledbetter",
+            "profile_image_url": "https://example.com/pfp.jpg",
+        },
+    }
+
+
+class FakeAPI:
+    """Answer statuses/lookup from a dict of tweet JSON, and record every call"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.lookups = []
+        self.timeline_calls = []
+        self.since_ids = []
+        self.fail_timeline_after = None
+        self.page_size = 2
+        # Exceptions to raise from the next statuses/lookup calls, in order,
+        # or None to answer that call
+        self.lookup_errors = []
+
+    def lookup_statuses(self, ids, **kwargs):
+        self.lookups.append(list(ids))
+        if self.lookup_errors:
+            error = self.lookup_errors.pop(0)
+            if error:
+                raise error
+        found = [
+            tweepy.models.Status.parse(self, self.statuses[i])
+            for i in ids
+            if i in self.statuses
+        ]
+        if not found:
+            raise tweepy.errors.NotFound(FakeResponse())
+        return found
+
+    def user_timeline(self, screen_name, count, tweet_mode, max_id=None, since_id=None):
+        self.timeline_calls.append(max_id)
+        self.since_ids.append(since_id)
+        if self.fail_timeline_after is not None:
+            if len(self.timeline_calls) > self.fail_timeline_after:
+                raise ConnectionError("Interrupted")
+        statuses = sorted(self.statuses.values(), key=lambda s: -s["id"])
+        if max_id:
+            statuses = [s for s in statuses if s["id"] <= int(max_id)]
+        if since_id:
+            statuses = [s for s in statuses if s["id"] > int(since_id)]
+        return [tweepy.models.Status.parse(self, s) for s in statuses[: self.page_size]]
+
+
+class FakeResponse:
+    status_code = 404
+    reason = "Not Found"
+
+    def json(self):
+        return {}
+
+
+class FakeDownloader:
+    def get(self, url):
+        if "broken" in url:
+            raise ConnectionError(f"Could not download {url}")
+        return b"pfp"
+
+    def submit(self, url):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self.get(url))
+        except ConnectionError as exc:
+            future.set_exception(exc)
+        return future
+
+    def get_many(self, urls):
+        return [self.get(url) for url in urls]
+
+
+def test_crawler_looks_up_each_tweet_once():
+    # A thread of three tweets, where the last and the middle both QT the same tweet,
+    # plus a reply to a deleted tweet
+    api = FakeAPI(
+        {
+            "1": status_json("1"),
+            "2": status_json("2", replyto="1", qt="9"),
+            "3": status_json("3", replyto="2", qt="9"),
+            "9": status_json("9"),
+            "5": status_json("5", replyto="404"),
+        }
+    )
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        tweetcrawler = crawler.Crawler(site, api)
+        for tweetid in ["3", "5", "3"]:
+            tweetcrawler.add(tweetid)
+        assert tweetcrawler.run() == 5
+
+        assert api.lookups[0] == ["3", "5"]
+        looked_up = [i for lookup in api.lookups for i in lookup]
+        assert sorted(looked_up) == ["1", "2", "3", "404", "5", "9"]
+        assert site.tweet_index.ids() == {"1", "2", "3", "5", "9"}
+
+        # Tweets already in site data are not downloaded again
+        api.lookups = []
+        tweetcrawler = crawler.Crawler(site, api)
+        tweetcrawler.add("3")
+        assert tweetcrawler.run() == 0
+        assert api.lookups == []
+
+
+def test_crawler_max_rlevel():
+    api = FakeAPI(
+        {
+            "1": status_json("1"),
+            "2": status_json("2", replyto="1"),
+            "3": status_json("3", replyto="2"),
+        }
+    )
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        tweetcrawler = crawler.Crawler(site, api, max_rlevel=1)
+        tweetcrawler.add("3")
+        tweetcrawler.run()
+        assert site.tweet_index.ids() == {"2", "3"}
+
+
+def test_token_bucket():
+    bucket = ratelimit.TokenBucket(2, window=0.2)
+    start = time.monotonic()
+    for _ in range(4):
+        asyncio.run(bucket.acquire())
+    # The first two tokens are free, and the next two refill at 10/second
+    assert 0.15 < time.monotonic() - start < 1
+
+    bucket.exhaust(time.time() + 0.3)
+    assert bucket.delay() > 0.3
+
+
+def test_crawler_resumes_from_journal():
+    api = FakeAPI(
+        {
+            "1": status_json("1"),
+            "2": status_json("2", replyto="1"),
+            "3": status_json("3", replyto="2"),
+        }
+    )
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        # An earlier run saved 3, then stopped before saving its parent
+        site.crawl_journal.complete("test", "3")
+        site.crawl_journal.add_pending("test", "2", 1)
+
+        tweetcrawler = crawler.Crawler(site, api, force=True, crawl="test")
+        tweetcrawler.add("3")
+        tweetcrawler.run()
+
+        assert api.lookups == [["2"], ["1"]]
+        assert site.crawl_journal.pending("test") == []
+        assert site.crawl_journal.completed("test") == set()
+
+
+def test_crawler_skips_tweets_that_fail():
+    broken = status_json("2", replyto="1")
+    broken["user"]["profile_image_url"] = "https://example.com/broken.jpg"
+    api = FakeAPI(
+        {
+            "1": status_json("1"),
+            "2": broken,
+            "3": status_json("3", replyto="2"),
+            "4": status_json("4", replyto="1"),
+        }
+    )
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        tweetcrawler = crawler.Crawler(site, api)
+        tweetcrawler.add("3")
+        tweetcrawler.add("4")
+        assert tweetcrawler.run() == 3
+        assert tweetcrawler.failed == {"2": 1}
+        assert site.tweet_index.ids() == {"1", "3", "4"}
+
+        # Resuming a crawl doesn't try tweets that already failed again
+        site.crawl_journal.fail("test", "2", 1, "ConnectionError: broken")
+        site.crawl_journal.add_pending("test", "3", 0)
+        api.lookups = []
+        tweetcrawler = crawler.Crawler(site, api, force=True, crawl="test")
+        tweetcrawler.run()
+        assert api.lookups == [["3"]]
+        assert tweetcrawler.failed == {"2": 1}
+        assert site.crawl_journal.failed("test") == []
+
+
+def test_crawler_retries_or_skips_failed_lookups(monkeypatch):
+    monkeypatch.setattr(crawler, "LOOKUP_RETRY_DELAY", 0)
+    api = FakeAPI(
+        {
+            "1": status_json("1"),
+            "2": status_json("2", replyto="1"),
+            "3": status_json("3", replyto="2"),
+        }
+    )
+    unauthorized = FakeResponse()
+    unauthorized.status_code = 401
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        tweetcrawler = crawler.Crawler(site, api)
+        tweetcrawler.add("3")
+        # Transient errors are retried, but other errors fail the whole batch
+        api.lookup_errors = [
+            tweepy.errors.TweepyException("Failed to send request: reset"),
+            tweepy.errors.TwitterServerError(FakeResponse()),
+            None,
+            tweepy.errors.Unauthorized(unauthorized),
+        ]
+        assert tweetcrawler.run() == 1
+        assert api.lookups == [["3"], ["3"], ["3"], ["2"]]
+        assert tweetcrawler.failed == {"2": 1}
+        assert site.tweet_index.ids() == {"3"}
+
+        # Transient errors that don't go away fail the batch too
+        api.lookup_errors = [ConnectionError("reset")] * (crawler.LOOKUP_RETRIES + 1)
+        api.lookups = []
+        tweetcrawler = crawler.Crawler(site, api, force=True)
+        tweetcrawler.add("1")
+        assert tweetcrawler.run() == 0
+        assert len(api.lookups) == crawler.LOOKUP_RETRIES + 1
+        assert tweetcrawler.failed == {"1": 0}
+
+
+def test_usertweets2data_resumes_pagination():
+    api = FakeAPI({str(i): status_json(str(i)) for i in range(1, 6)})
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        # Each call retrieves two tweets; die retrieving the second page
+        api.fail_timeline_after = 1
+        with pytest.raises(ConnectionError):
+            twitterapi.usertweets2data(site, api, "mrled", 20)
+        assert len(site.crawl_journal.pending("user2data/mrled")) == 2
+
+        api.fail_timeline_after = None
+        twitterapi.usertweets2data(site, api, "mrled", 20)
+        assert api.timeline_calls == [None, "3", "3", "1", "0"]
+        assert api.lookups == []
+        assert site.tweet_index.ids() == {"1", "2", "3", "4", "5"}
+
+
+def test_usertweets2data_since_id():
+    api = FakeAPI({str(i): status_json(str(i)) for i in range(1, 4)})
+    with testutil.TemporaryHugoSite() as site:
+        site.downloader = FakeDownloader()
+        twitterapi.usertweets2data(site, api, "mrled", 20)
+        assert api.since_ids == [None, None, None]
+        assert twitterapi.UserSyncState(site.user_sync_state).users == {
+            "mrled": {"newest_id": "3"}
+        }
+
+        # Nothing new: one call, and nothing else
+        api.timeline_calls, api.since_ids = [], []
+        twitterapi.usertweets2data(site, api, "MrLed", 20)
+        assert api.timeline_calls == [None]
+        assert api.since_ids == ["3"]
+
+        api.statuses.update({str(i): status_json(str(i)) for i in range(4, 7)})
+        api.timeline_calls, api.since_ids = [], []
+        twitterapi.usertweets2data(site, api, "mrled", 20)
+        assert api.timeline_calls == [None, "4", "3"]
+        assert api.since_ids == ["3", "3", "3"]
+        assert site.tweet_index.ids() == {"1", "2", "3", "4", "5", "6"}
+        assert twitterapi.UserSyncState(site.user_sync_state).newest_id("mrled") == "6"
@@ -0,0 +1,137 @@
+"""Test download.py and httpcache.py"""
+
+import contextlib
+import http.server
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+import requests
+
+from twarchive import download
+from twarchive import httpcache
+
+
+@contextlib.contextmanager
+def serve_files(files):
+    """Serve a dict of {name: contents} over HTTP
+
+    Yields the base URL and a list that each response status is appended to.
+    """
+    statuses = []
+    with tempfile.TemporaryDirectory() as servedir:
+        for name, contents in files.items():
+            with open(os.path.join(servedir, name), "w") as fp:
+                fp.write(contents)
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=servedir, **kwargs)
+
+            def log_request(self, code="-", size="-"):
+                statuses.append(int(code))
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}", statuses
+        finally:
+            server.shutdown()
+
+
+def test_get_many():
+    files = {name: f"contents of {name}" for name in ["a", "b", "c"]}
+    with serve_files(files) as (base, _):
+        downloader = download.Downloader(max_workers=3, max_per_host=2)
+        result = downloader.get_many([f"{base}/c", f"{base}/a", f"{base}/b"])
+        assert result == [b"contents of c", b"contents of a", b"contents of b"]
+
+
+def test_cache_revalidates_and_evicts():
+    files = {"a": "a" * 10, "b": "b" * 10}
+    with serve_files(files) as (
+        base,
+        statuses,
+    ), tempfile.TemporaryDirectory() as cachedir:
+        cache = httpcache.HTTPCache(cachedir, max_size=15)
+        downloader = download.Downloader(cache=cache)
+
+        assert downloader.get(f"{base}/a") == b"a" * 10
+        # The test server sends Last-Modified but no Cache-Control,
+        # so the second request is a conditional one that gets no body
+        assert downloader.get(f"{base}/a") == b"a" * 10
+        assert statuses == [200, 304]
+
+        # Caching b pushes the cache over its max size, and a is least recently used
+        downloader.get(f"{base}/b")
+        assert cache.lookup(f"{base}/a") is None
+        assert cache.lookup(f"{base}/b")
+
+
+def test_cache_fresh_responses_skip_network():
+    with tempfile.TemporaryDirectory() as cachedir:
+        cache = httpcache.HTTPCache(cachedir)
+        cache.store("https://example.invalid/x", b"x", {"Cache-Control": "max-age=60"})
+        downloader = download.Downloader(cache=cache)
+        assert downloader.get("https://example.invalid/x") == b"x"
+
+
+def test_evicted_after_lookup_is_a_miss():
+    with serve_files({"a": "contents"}) as (
+        base,
+        statuses,
+    ), tempfile.TemporaryDirectory() as cachedir:
+        cache = httpcache.HTTPCache(cachedir)
+        url = f"{base}/a"
+        cache.store(url, b"contents", {"Cache-Control": "max-age=60"})
+        looked_up = cache.lookup(url)
+        # Another thread evicts the response between lookup and read
+        os.remove(os.path.join(cachedir, looked_up.filename))
+        assert cache.read(looked_up) is None
+
+        downloader = download.Downloader(cache=cache)
+        with mock.patch.object(cache, "lookup", return_value=looked_up):
+            assert downloader.get(url) == b"contents"
+            os.remove(os.path.join(cachedir, looked_up.filename))
+            path = downloader.get_file(url)
+        with open(path) as dfp:
+            assert dfp.read() == "contents"
+        assert statuses == [200, 200]
+
+
+def test_get_file():
+    files = {"video": "v" * (3 * 1024 * 1024)}
+    with serve_files(files) as (
+        base,
+        statuses,
+    ), tempfile.TemporaryDirectory() as tmpdir:
+        cache = httpcache.HTTPCache(os.path.join(tmpdir, "cache"))
+        spool = os.path.join(tmpdir, "spool")
+        downloader = download.Downloader(cache=cache, spool=spool)
+
+        first = downloader.submit_file(f"{base}/video").result()
+        second = downloader.get_file(f"{base}/video")
+        assert first != second
+        for path in [first, second]:
+            assert os.path.dirname(path) == spool
+            with open(path) as vfp:
+                assert vfp.read() == files["video"]
+        # The second download was revalidated and linked from the cache
+        assert statuses == [200, 304]
+        assert os.stat(second).st_ino == os.stat(first).st_ino
+
+
+def test_error_responses_raise():
+    with serve_files({}) as (base, _), tempfile.TemporaryDirectory() as tmpdir:
+        cache = httpcache.HTTPCache(os.path.join(tmpdir, "cache"))
+        spool = os.path.join(tmpdir, "spool")
+        downloader = download.Downloader(cache=cache, spool=spool)
+        with pytest.raises(requests.HTTPError):
+            downloader.get(f"{base}/missing")
+        with pytest.raises(requests.HTTPError):
+            downloader.get_file(f"{base}/missing")
+        # Neither the error page nor a partial download is kept
+        assert os.listdir(spool) == []
+        assert cache.lookup(f"{base}/missing") is None
@@ -0,0 +1,314 @@
+"""Test hugo.py"""
+
+import datetime
+import io
+import json
+import logging
+import os
+from unittest import mock
+
+import pytest
+
+from twarchive import derivatives
+from twarchive import hugo
+from twarchive import testutil
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet, TweetMediaAttachment
+
+
+def minimal_tweet_with_media(tweetid: str, data: bytes) -> InflatedTweet:
+    infltweet = InflatedTweet.minimal(
+        tweetid,
+        datetime.datetime(2022, 5, 6, 17, 27, 17, tzinfo=datetime.timezone.utc),
+        "Look at this",
+        "mrled",
+        "Micah R Ledbetter",
+    )
+    infltweet.media = [
+        TweetMediaAttachment(
+            "photo", "image/jpeg", 10, 10, "", "https://example.com/x.jpg", data
+        )
+    ]
+    return infltweet
+
+
+def test_media2blobs():
+    with testutil.TemporaryHugoSite() as site:
+        hugo.save_tweet(site, minimal_tweet_with_media("1", b"same image"))
+        hugo.save_tweet(site, minimal_tweet_with_media("2", b"same image"))
+
+        hugo.media2blobs(site)
+
+        blobs = [
+            f for _, _, files in os.walk(site.assets_twarchive_blobs) for f in files
+        ]
+        assert len(blobs) == 1
+        with open(site.tweet_data_path("1")) as tfp:
+            media = json.load(tfp)["media"][0]
+        assert "data" not in media
+        assert media["sha256"] == blobs[0]
+        assert media["size"] == len(b"same image")
+
+        # Tweets saved after migrating go to the blob store too
+        assert hugo.HugoSite(site.base).blobstore
+        infltweet = InflatedTweet.jload(filepath=site.tweet_data_path("2"))
+        assert infltweet.media[0].load(site.blobstore) == b"same image"
+
+
+def test_save_tweet_user_pfp_table():
+    with testutil.TemporaryHugoSite() as site:
+        table_path = os.path.join(site.data_twarchive_pfps, "mrled.json")
+        for tweetid in ["1", "2", "3"]:
+            infltweet = minimal_tweet_with_media(tweetid, b"image")
+            infltweet.user_pfp = b"pfp"
+            hugo.save_tweet(site, infltweet)
+            # The caller's tweet is left alone
+            assert infltweet.user_pfp == b"pfp"
+            assert not infltweet.user_pfp_sha256
+            if tweetid == "1":
+                with open(table_path) as tfp:
+                    table = json.load(tfp)
+                assert len(table) == 1
+                # Known pictures don't make save_tweet read the table again
+                with open(table_path, "w") as tfp:
+                    tfp.write("not JSON")
+        with open(site.tweet_data_path("3")) as tfp:
+            saved = json.load(tfp)
+        assert saved["user_pfp"] == ""
+        assert saved["user_pfp_sha256"] in table
+
+
+def test_data2md_only_writes_changed_pages():
+    with testutil.TemporaryHugoSite() as site:
+        hugo.save_tweet(site, minimal_tweet_with_media("1", b"image"))
+        hugo.data2md(site)
+        page = os.path.join(site.content_twarchive, "1.md")
+        with open(page) as pfp:
+            assert 'tweetid: "1"' in pfp.read()
+        os.utime(page, ns=(0, 0))
+
+        hugo.data2md(site)
+        assert os.stat(page).st_mtime_ns == 0
+        assert os.path.exists(site.tweet_index_path)
+
+
+def test_tweet_index():
+    with testutil.TemporaryHugoSite() as site:
+        infltweet = minimal_tweet_with_media("2", b"image")
+        infltweet.replyto_tweetid = "1"
+        infltweet.qts = ["3"]
+        hugo.save_tweet(site, infltweet)
+        assert hugo.get_downloaded_tweets(site) == {"2"}
+
+        # A missing index is rebuilt from the data files
+        hugo.save_tweet(site, minimal_tweet_with_media("4", b"image"))
+        os.remove(site.tweet_index_path)
+        fresh = hugo.HugoSite(site.base)
+        assert hugo.get_downloaded_tweets(fresh) == {"2", "4"}
+
+        rows = {row["id"]: row for row in fresh.tweet_index.rows()}
+        assert rows["2"]["replyto_tweetid"] == "1"
+        assert json.loads(rows["2"]["qts"]) == ["3"]
+        with open(site.tweet_data_path("2")) as tfp:
+            assert rows["2"]["date"] == json.load(tfp)["date"]
+
+
+def test_find_inline_tweets():
+    with testutil.TemporaryHugoSite() as site:
+        os.makedirs(os.path.join(site.content, "blog"))
+        post = os.path.join(site.content, "blog", "post.md")
+        with open(post, "w") as pfp:
+            pfp.write(
+                '{{< twarchiveTweet "1" >}} and {{< twarchiveThread "2" >}}\n'
+                '{{< twarchiveTweet "3-intentionallyinvalid" >}}\n'
+            )
+        # Pages generated by data2md are not inlines
+        hugo.save_tweet(site, minimal_tweet_with_media("9", b"image"))
+        hugo.data2md(site)
+
+        assert hugo.find_inline_tweets(site) == {"1", "2", "3-intentionallyinvalid"}
+
+        with open(post, "a") as pfp:
+            pfp.write('{{% twarchiveTweet "4" %}}\n')
+        assert hugo.find_inline_tweets(site) == {
+            "1",
+            "2",
+            "3-intentionallyinvalid",
+            "4",
+        }
+
+        os.remove(post)
+        assert hugo.find_inline_tweets(site) == set()
+
+
+def test_build_thread_index():
+    tweets = {
+        "1": {"thread_parent_id": None},
+        "2": {"thread_parent_id": "1"},
+        "3": {"thread_parent_id": "2"},
+        # A second reply to 2, making a branch
+        "4": {"thread_parent_id": "2"},
+        # A reply to a tweet that hasn't been downloaded
+        "6": {"thread_parent_id": "5"},
+        "7": {"thread_parent_id": None},
+    }
+    index = hugo.build_thread_index(tweets)
+    assert index["threads"] == {
+        "3": ["1", "2", "3"],
+        "4": ["1", "2", "4"],
+        "6": ["5", "6"],
+    }
+    assert index["tweets"] == {
+        "1": "4",
+        "2": "4",
+        "3": "3",
+        "4": "4",
+        "5": "6",
+        "6": "6",
+    }
+
+
+def test_set_layout():
+    with testutil.TemporaryHugoSite() as site:
+        hugo.save_tweet(site, minimal_tweet_with_media("1", b"image"))
+        hugo.data2md(site)
+
+        hugo.set_layout(site, "bundles")
+        bundle = os.path.join(site.content_twarchive, "1")
+        assert not os.path.exists(os.path.join(site.data_twarchive, "1.json"))
+        assert not os.path.exists(os.path.join(site.content_twarchive, "1.md"))
+        assert site.tweet_data_path("1") == os.path.join(bundle, "tweet.json")
+        with open(site.tweet_data_path("1")) as tfp:
+            media = json.load(tfp)["media"][0]
+        assert site.media_store("1").get(media["sha256"]) == b"image"
+        with open(os.path.join(bundle, "index.md")) as pfp:
+            assert "publishResources: false" in pfp.read()
+        assert hugo.HugoSite(site.base).tweet_index.ids() == {"1"}
+        assert site.tweet_index.data_dir == site.content_twarchive
+
+        # Tweets saved after switching are saved as bundles too
+        hugo.save_tweet(site, minimal_tweet_with_media("2", b"image"))
+        assert os.path.exists(os.path.join(site.content_twarchive, "2", "tweet.json"))
+
+        hugo.set_layout(site, "data")
+        assert not os.path.exists(bundle)
+        assert os.path.exists(os.path.join(site.content_twarchive, "1.md"))
+        infltweet = InflatedTweet.jload(filepath=site.tweet_data_path("2"))
+        assert infltweet.media[0].data == b"image"
+        assert site.tweet_index.ids() == {"1", "2"}
+
+
+def test_save_tweet_video_by_reference():
+    with testutil.TemporaryHugoSite() as site:
+        archived = os.path.join(site.twitter_archives, "video.mp4")
+        downloaded = os.path.join(site.twitter_archives, "download-video")
+        os.makedirs(site.twitter_archives)
+        for path in [archived, downloaded]:
+            with open(path, "wb") as vfp:
+                vfp.write(b"video")
+        infltweet = minimal_tweet_with_media("1", b"image")
+        infltweet.media += [
+            TweetMediaAttachment(
+                "video", "video/mp4", 10, 10, "", "https://example.com/x.mp4", path=path
+            )
+            for path in [archived, downloaded]
+        ]
+        infltweet.media[2].temporary = True
+        hugo.save_tweet(site, infltweet)
+
+        # Photos are still embedded, but videos go to the blob store
+        with open(site.tweet_data_path("1")) as tfp:
+            photo, video, _ = json.load(tfp)["media"]
+        assert "data" in photo
+        assert "data" not in video and "path" not in video
+        assert video["size"] == len(b"video")
+        blobstore = site.video_store("1")
+        assert blobstore.get(video["sha256"]) == b"video"
+        # Files from an archive are left alone, and temporary files are moved
+        assert os.path.exists(archived)
+        assert not os.path.exists(downloaded)
+
+        hugo.set_layout(site, "bundles")
+        infltweet = InflatedTweet.jload(filepath=site.tweet_data_path("1"))
+        assert infltweet.media[1].load(site.media_store("1")) == b"video"
+
+
+def test_image_derivatives():
+    Image = pytest.importorskip("PIL.Image")
+    photo = io.BytesIO()
+    Image.new("RGB", (1000, 500), (200, 30, 30)).save(photo, format="JPEG")
+    with testutil.TemporaryHugoSite() as site:
+        site.settings["media_storage"] = "blobs"
+        site.settings["image_derivatives"] = {"widths": [640, 320, 2000], "webp": True}
+        hugo.save_tweet(site, minimal_tweet_with_media("1", photo.getvalue()))
+        hugo.save_tweet(site, minimal_tweet_with_media("2", b"not an image"))
+
+        assert hugo.image_derivatives(site, jobs=1) == 2
+        photo_sha = (
+            InflatedTweet.jload(filepath=site.tweet_data_path("1")).media[0].sha256
+        )
+        with open(
+            os.path.join(
+                site.assets_twarchive_derivatives,
+                photo_sha[0:2],
+                photo_sha,
+                "derivatives.json",
+            )
+        ) as dfp:
+            manifest = json.load(dfp)
+        assert manifest["image"]
+        assert (manifest["width"], manifest["height"]) == (1000, 500)
+        assert manifest["placeholder"].startswith("data:image/jpeg;base64,")
+        # Never enlarged
+        assert [(v["width"], v["content_type"]) for v in manifest["variants"]] == [
+            (320, "image/jpeg"),
+            (320, "image/webp"),
+            (640, "image/jpeg"),
+            (640, "image/webp"),
+        ]
+        for variant in manifest["variants"]:
+            path = os.path.join(site.base, "assets", variant["path"])
+            with Image.open(path) as resized:
+                assert resized.size == (variant["width"], variant["height"])
+
+        # Derivatives are cached by the hash of the original,
+        # and the index means their derivatives.json files aren't even read
+        with mock.patch.object(derivatives, "up_to_date", side_effect=AssertionError):
+            assert hugo.image_derivatives(site, jobs=1) == 0
+        # Without the index, existing derivatives are found and the index is rebuilt
+        os.remove(site.derivatives_index)
+        assert hugo.image_derivatives(site, jobs=1) == 0
+        assert os.path.exists(site.derivatives_index)
+        # New settings mean new derivatives
+        site.settings["image_derivatives"] = {"widths": [320]}
+        assert hugo.image_derivatives(site, jobs=1) == 2
+        site.settings["image_derivatives"] = False
+        assert hugo.image_derivatives(site, jobs=1) == 0
+
+
+def test_image_derivatives_failures(caplog):
+    Image = pytest.importorskip("PIL.Image")
+    photo = io.BytesIO()
+    Image.new("RGB", (1000, 500), (200, 30, 30)).save(photo, format="JPEG")
+    with testutil.TemporaryHugoSite() as site:
+        # Embedded media is the default, so that only gets a warning if derivatives are set
+        caplog.set_level(logging.INFO)
+        hugo.image_derivatives(site, jobs=1)
+        assert "media2blobs" in caplog.text
+        assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+        site.settings["image_derivatives"] = {}
+        caplog.clear()
+        hugo.image_derivatives(site, jobs=1)
+        assert [r.levelno for r in caplog.records] == [logging.WARNING]
+
+        site.settings["media_storage"] = "blobs"
+        hugo.save_tweet(site, minimal_tweet_with_media("1", photo.getvalue()))
+        hugo.save_tweet(site, minimal_tweet_with_media("2", b"not an image"))
+        # A photo that fails doesn't stop the others, and leaves nothing behind
+        with mock.patch.object(derivatives, "encode", side_effect=ValueError("mode")):
+            assert hugo.image_derivatives(site, jobs=1) == 1
+        for shard in os.listdir(site.assets_twarchive_derivatives):
+            for name in os.listdir(
+                os.path.join(site.assets_twarchive_derivatives, shard)
+            ):
+                assert ".tmp-" not in name
+        assert hugo.image_derivatives(site, jobs=1) == 1
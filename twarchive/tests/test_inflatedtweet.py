@@ -0,0 +1,184 @@
+"""Test the InflatedTweet class and its JSON en/de-coders"""
+
+import base64
+import datetime
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from twarchive import jsonbackend
+from twarchive.inflatedtweet.body import tweet_html_bodies
+from twarchive.inflatedtweet.inflatedtweet import (
+    InflatedTweet,
+    InflatedTweetEncoder,
+    TweetMediaAttachment,
+    inflated_tweet_object_hook,
+)
+
+
+def test_jload_jdump_does_not_decode_media():
+    infltweet = InflatedTweet.minimal(
+        "1",
+        datetime.datetime(2022, 5, 6, 17, 27, 17, tzinfo=datetime.timezone.utc),
+        "Look at this",
+        "mrled",
+        "Micah R Ledbetter",
+    )
+    infltweet.user_pfp = b"pfp"
+    infltweet.media = [
+        TweetMediaAttachment(
+            "photo", "image/jpeg", 10, 10, "", "https://example.com/x.jpg", b"image"
+        )
+    ]
+    original = io.StringIO()
+    infltweet.jdump(original)
+
+    loaded = InflatedTweet.jload(io.StringIO(original.getvalue()))
+    # Without decoding the base64, re-encoding gives exactly the same JSON
+    with mock.patch.object(base64, "b64decode", side_effect=AssertionError):
+        redumped = io.StringIO()
+        loaded.jdump(redumped)
+    assert redumped.getvalue() == original.getvalue()
+
+    # The base64 is decoded on demand
+    assert loaded.media[0].data == b"image"
+    assert loaded.user_pfp == b"pfp"
+
+
+def test_json_backends_agree():
+    pytest.importorskip("orjson")
+    infltweet = InflatedTweet.minimal(
+        "1",
+        datetime.datetime(2022, 5, 6, 17, 27, 17, tzinfo=datetime.timezone.utc),
+        'Café \U0001f426   \x7f \x00 "quoted" \\ 1e16, 0.00001',
+        "mrled",
+        "Micah R Ledbetter",
+    )
+    infltweet.entities = {
+        "floats": [1e16, 1e-05, 0.1, 1.5e-07, 2.0],
+        "big": 2**70,
+        "empty": [{}, []],
+    }
+    infltweet.user_pfp = b"pfp"
+    encoder = InflatedTweetEncoder()
+    canonical = jsonbackend.dumps(infltweet, default=encoder.default, backend="orjson")
+    assert canonical == json.dumps(
+        infltweet, cls=InflatedTweetEncoder, indent=2, sort_keys=True
+    )
+
+    compact = jsonbackend.dumps(
+        infltweet, default=encoder.default, compact=True, backend="orjson"
+    )
+    for backend in ["stdlib", "orjson"]:
+        for contents in [canonical, compact]:
+            loaded = jsonbackend.loads(
+                contents, object_hook=inflated_tweet_object_hook, backend=backend
+            )
+            assert isinstance(loaded, InflatedTweet)
+            assert loaded.full_text == infltweet.full_text
+            assert loaded.entities == infltweet.entities
+
+
+def test_dump_matches_dumps(monkeypatch):
+    # A small chunk size, so that media and long strings are written in several pieces
+    monkeypatch.setattr(jsonbackend, "STREAM_CHUNK_SIZE", 6)
+    infltweet = InflatedTweet.minimal(
+        "1",
+        datetime.datetime(2022, 5, 6, 17, 27, 17, tzinfo=datetime.timezone.utc),
+        'Café \U0001f426   \x7f \x00 "quoted" \\ 1e16, 0.00001',
+        "mrled",
+        "Micah R Ledbetter",
+    )
+    infltweet.entities = {
+        "floats": [1e16, 1e-05, 0.1, 2.0],
+        "long": "abcdefghijklmnopqrstuvwxyz",
+        "long_ascii_only_in_compact": "abcdefghijklmnopqrstuvwxyzé",
+        "empty": [{}, []],
+        "ok": [True, False, None],
+    }
+    infltweet.media = [
+        TweetMediaAttachment(
+            "photo", "image/jpeg", 10, 10, "", "https://example.com/x.jpg", data
+        )
+        for data in [b"", b"i", b"image", b"a longer image"]
+    ]
+    encoder = InflatedTweetEncoder()
+    for compact in [False, True]:
+        expected = jsonbackend.dumps(
+            infltweet, default=encoder.default, compact=compact, backend="stdlib"
+        )
+        streamed = io.StringIO()
+        jsonbackend.dump(infltweet, streamed, default=encoder.default, compact=compact)
+        assert streamed.getvalue() == expected
+
+    # Media loaded from JSON is a base64 string, and is passed through in slices
+    original = io.StringIO()
+    infltweet.jdump(original)
+    loaded = InflatedTweet.jload(io.StringIO(original.getvalue()))
+    redumped = io.StringIO()
+    loaded.jdump(redumped)
+    assert redumped.getvalue() == original.getvalue()
+
+
+def test_skim(monkeypatch):
+    doc = {
+        "a_number": -1.5e3,
+        "escapes": 'a "quoted" \\ backslash \\" and Café \U0001f426',
+        "media": [{"data": "QUJD" * 50, "nested": {"x": [1, "]", "}"]}}],
+        "qts": ["1", "2"],
+        "username": "mrled",
+        "z_last": 12,
+    }
+    keys = ["a_number", "escapes", "qts", "username", "z_last", "missing"]
+    expected = {key: doc[key] for key in keys if key in doc}
+    for chunk_size in [1, 2, 3, 7, 4096]:
+        monkeypatch.setattr(jsonbackend, "STREAM_CHUNK_SIZE", chunk_size)
+        for contents in [
+            json.dumps(doc, indent=2, sort_keys=True),
+            json.dumps(doc, separators=(",", ":"), ensure_ascii=False),
+        ]:
+            assert jsonbackend.skim(io.StringIO(contents), keys) == expected
+
+
+def test_tweet_html_bodies():
+    text = "See #this from @mrled:\nhttps://t.co/a https://t.co/qt https://t.co/pic"
+    entities = {
+        # Archives give indices as strings; "15" must still come after "4"
+        "hashtags": [{"text": "this", "indices": ["4", "9"]}],
+        "user_mentions": [{"screen_name": "mrled", "indices": ["15", "21"]}],
+        "urls": [
+            {
+                "expanded_url": "https://example.com/a",
+                "display_url": "example.com/a",
+                "indices": [23, 37],
+            },
+            {
+                "expanded_url": "https://twitter.com/mrled/status/1234",
+                "display_url": "twitter.com/mrled/status/1234",
+                "indices": [38, 53],
+            },
+        ],
+        "media": [{"indices": [54, 70]}],
+    }
+    common = (
+        'See <a href="https://twitter.com/hashtag/this">#this</a> '
+        'from <a href="https://twitter.com/mrled">@mrled</a>:<br/>'
+        '<a href="https://example.com/a">example.com/a</a> '
+    )
+    bodies = tweet_html_bodies(text, entities)
+    assert bodies.strip_qts == common + " "
+    assert bodies.link_qts == (
+        common
+        + '<a href="https://twitter.com/mrled/status/1234">twitter.com/mrled/status/1234</a> '
+    )
+
+
+def test_check_backend(monkeypatch):
+    assert jsonbackend.check_backend("stdlib") == "stdlib"
+    with pytest.raises(ValueError, match="Unknown JSON backend"):
+        jsonbackend.check_backend("ujson")
+    monkeypatch.setattr(jsonbackend, "orjson", None)
+    with pytest.raises(ValueError, match="not installed"):
+        jsonbackend.check_backend("orjson")
@@ -0,0 +1,55 @@
+"""Test profiling.py"""
+
+import json
+import os
+import time
+
+from twarchive import profiling
+from twarchive import synthetic
+from twarchive import testutil
+from twarchive import twitterarchive
+
+
+def test_nested_phases_count_only_their_own_time(tmp_path):
+    report_path = str(tmp_path / "report.json")
+    with profiling.profile(report_path) as profiler:
+        with profiling.phase("write", items=1):
+            time.sleep(0.01)
+            with profiling.phase("encode") as measure:
+                time.sleep(0.05)
+                measure.nbytes = 2**20
+    phases = profiler.snapshot()
+    assert phases["encode"].seconds >= 0.05
+    assert 0.01 <= phases["write"].seconds < 0.05
+    # Nothing is recorded when no profile is running
+    with profiling.phase("write"):
+        pass
+    assert profiler.snapshot()["write"].calls == 1
+
+    with open(report_path) as rfp:
+        report = json.load(rfp)
+    assert report["tweets_saved"] == 1
+    assert report["phases"]["encode"]["bytes"] == 2**20
+    assert report["phases"]["encode"]["megabytes_per_second"] > 0
+
+
+def test_profile_archive2data(tmp_path):
+    params = synthetic.SyntheticArchiveParams(tweets=40, rt_ratio=0, seed=2)
+    for jobs in [1, 2]:
+        with testutil.TemporaryHugoSite() as site:
+            archive_path = os.path.join(site.twitter_archives, "synthetic")
+            synthetic.make_archive(archive_path, params)
+            archive = twitterarchive.TwitterArchive.frompath(archive_path)
+            report_path = str(tmp_path / f"jobs{jobs}.json")
+            with profiling.profile(report_path, cprofile=True, memory=True):
+                twitterarchive.archive2data(site, archive, api=None, jobs=jobs)
+
+            with open(report_path) as rfp:
+                report = json.load(rfp)
+            # Phases in worker processes are added to the report too
+            assert report["tweets_saved"] == 40
+            assert report["phases"]["parse"]["items"] == 40
+            assert report["phases"]["inflate"]["items"] == 40
+            assert report["phases"]["media"]["bytes"] > 0
+            assert report["memory"]["peak_bytes"] > 0
+            assert os.path.exists(report["cprofile"])
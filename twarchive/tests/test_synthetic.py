@@ -0,0 +1,38 @@
+"""Test synthetic.py"""
+
+import json
+import os
+
+from twarchive import hugo
+from twarchive import synthetic
+from twarchive import testutil
+from twarchive import twitterarchive
+
+
+def test_synthetic_archive():
+    params = synthetic.SyntheticArchiveParams(
+        tweets=60, thread_ratio=0.5, qt_ratio=0.3, rt_ratio=0.1, seed=1
+    )
+    with testutil.TemporaryHugoSite() as site:
+        archive_path = os.path.join(site.twitter_archives, "synthetic")
+        tweetids = synthetic.make_archive(archive_path, params)
+        assert len(tweetids) == 60
+        assert synthetic.make_archive(archive_path, params) == tweetids
+
+        archive = twitterarchive.TwitterArchive.frompath(archive_path)
+        assert archive.anymissing() == []
+        twitterarchive.archive2data(site, archive, api=None)
+        saved = hugo.get_downloaded_tweets(site)
+        # Low fidelity retweets are not saved without an API
+        assert 0 < len(saved) < len(tweetids)
+
+        rows = {row["id"]: row for row in site.tweet_index.rows()}
+        threads = hugo.build_thread_index(rows)["threads"]
+        assert threads
+        assert max(len(thread) for thread in threads.values()) <= params.thread_depth
+        assert any(json.loads(row["qts"]) for row in rows.values())
+
+        synthetic.make_site(site.base, tweetids, pages=4, inlines_per_page=3)
+        inlines = hugo.find_inline_tweets(site)
+        assert 0 < len(inlines) <= 12
+        assert inlines <= set(tweetids)
@@ -1,10 +1,20 @@
 """Test twitterarchive.py"""
 
+import json
+import logging
 import os
 import pathlib
+import shutil
+from unittest import mock
+
+import pytest
 
 from twarchive import testutil
 from twarchive import twitterarchive
+from twarchive.inflatedtweet.from_twitter_archive import (
+    twitter_archive_tweet_is_low_fidelity_retweet,
+)
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
 
 
 SCRIPTDIR = pathlib.Path(__file__).parent
@@ -53,3 +63,145 @@ def test_archive2infltweets():
         tweetfiles = os.listdir(site.data_twarchive)
         # Don't forget: RTs are not saved when api=None
         assert len(tweetfiles) == 1
+
+
+def test_iter_twitter_window_YTD_bullshit():
+    parsed = twitterarchive.parse_twitter_window_YTD_bullshit(TESTARCHIVE.tweetjs)
+    iterated = list(
+        twitterarchive.iter_twitter_window_YTD_bullshit(TESTARCHIVE.tweetjs)
+    )
+    assert iterated == parsed
+
+    # A tiny chunk size means prefix and items are always split across reads
+    iterated = twitterarchive.iter_twitter_window_YTD_bullshit(
+        TESTARCHIVE.tweetjs, chunksize=7
+    )
+    assert list(iterated) == parsed
+
+
+def test_archive2data_jobs_matches_serial():
+    with testutil.TemporaryHugoSite() as serial_site:
+        twitterarchive.archive2data(serial_site, TESTARCHIVE, api=None)
+        with testutil.TemporaryHugoSite() as parallel_site:
+            twitterarchive.archive2data(
+                parallel_site, TESTARCHIVE, api=None, jobs=2, chunksize=1
+            )
+            tweetfiles = sorted(os.listdir(serial_site.data_twarchive))
+            assert tweetfiles == sorted(os.listdir(parallel_site.data_twarchive))
+            for tweetfile in tweetfiles:
+                serial_path = os.path.join(serial_site.data_twarchive, tweetfile)
+                parallel_path = os.path.join(parallel_site.data_twarchive, tweetfile)
+                with open(serial_path) as sfp, open(parallel_path) as pfp:
+                    assert sfp.read() == pfp.read()
+
+
+def test_archive2data_skips_unchanged_tweets(caplog):
+    with testutil.TemporaryHugoSite() as site:
+        twitterarchive.archive2data(site, TESTARCHIVE, api=None)
+        tweetpath = site.tweet_data_path("1276916896974110721")
+        os.utime(tweetpath, ns=(0, 0))
+
+        twitterarchive.archive2data(site, TESTARCHIVE, api=None)
+        assert os.stat(tweetpath).st_mtime_ns == 0
+
+        caplog.set_level(logging.INFO)
+        caplog.clear()
+        twitterarchive.archive2data(site, TESTARCHIVE, api=None, reimport_all=True)
+        assert os.stat(tweetpath).st_mtime_ns != 0
+        assert "0 new, 0 changed, 0 skipped" in caplog.text
+
+
+def regular_test_tweet():
+    """Return the one tweet in the test archive that isn't a low fidelity retweet"""
+    (regular,) = [
+        outertweet["tweet"]
+        for outertweet in twitterarchive.iter_twitter_window_YTD_bullshit(
+            TESTARCHIVE.tweetjs
+        )
+        if not twitter_archive_tweet_is_low_fidelity_retweet(outertweet["tweet"])
+    ]
+    return regular
+
+
+def archive_with_tweets(path: pathlib.Path, tweets) -> twitterarchive.TwitterArchive:
+    """Copy the test archive to path, with tweets in place of its tweet.js"""
+    shutil.copytree(TESTDATADIR, path.joinpath("data"))
+    with open(path.joinpath("data", "tweet.js"), "w") as tfp:
+        tfp.write("window.YTD.tweet.part0 = ")
+        json.dump([{"tweet": tweet} for tweet in tweets], tfp)
+    return twitterarchive.TwitterArchive.frompath(path)
+
+
+def test_archive2data_interrupted_import_resumes(tmp_path, caplog):
+    regular = regular_test_tweet()
+    tweets = [dict(regular, id="1", id_str="1"), dict(regular, id="2", id_str="2")]
+    archive = archive_with_tweets(tmp_path, tweets)
+
+    save_archive_tweets = twitterarchive.save_archive_tweets
+
+    def fail_second_chunk(site, archive, chunk, *args):
+        if chunk[0]["id_str"] == "2":
+            raise RuntimeError("interrupted")
+        save_archive_tweets(site, archive, chunk, *args)
+
+    with testutil.TemporaryHugoSite() as site:
+        with mock.patch.object(
+            twitterarchive, "save_archive_tweets", side_effect=fail_second_chunk
+        ):
+            with pytest.raises(RuntimeError):
+                twitterarchive.archive2data(site, archive, api=None, chunksize=1)
+        # Only the tweet that was saved is in the manifest
+        manifest = twitterarchive.ArchiveImportManifest(site.archive_import_manifest)
+        assert set(manifest.tweets) == {"1"}
+        assert manifest.archives == {}
+
+        caplog.set_level(logging.INFO)
+        twitterarchive.archive2data(site, archive, api=None)
+        assert "1 new, 0 changed, 1 skipped" in caplog.text
+
+
+def test_archive2data_media(tmp_path, caplog):
+    regular = regular_test_tweet()
+    sizes = {"small": {"w": 10, "h": 10}}
+    media = [
+        {
+            "type": "photo",
+            "sizes": sizes,
+            "media_url_https": "https://pbs.twimg.com/media/photo.jpg",
+        },
+        {
+            "type": "video",
+            "sizes": sizes,
+            "video_info": {
+                "variants": [
+                    {
+                        "bitrate": "832000",
+                        "content_type": "video/mp4",
+                        "url": "https://video.twimg.com/ext_tw_video/1/pu/vid/video.mp4?tag=12",
+                    }
+                ]
+            },
+        },
+        {
+            "type": "photo",
+            "sizes": sizes,
+            "media_url_https": "https://pbs.twimg.com/media/missing.jpg",
+        },
+    ]
+    tweet = dict(regular, id="1", id_str="1", extended_entities={"media": media})
+    archive = archive_with_tweets(tmp_path, [tweet])
+    for filename, data in [("1-photo.jpg", b"photo"), ("1-video.mp4", b"video")]:
+        with open(os.path.join(archive.tweetmedia, filename), "wb") as mfp:
+            mfp.write(data)
+
+    with testutil.TemporaryHugoSite() as site:
+        caplog.set_level(logging.INFO)
+        twitterarchive.archive2data(site, archive, api=None)
+        assert "missing.jpg for tweet 1 is missing from the archive" in caplog.text
+        infltweet = InflatedTweet.jload(filepath=site.tweet_data_path("1"))
+        assert [m.url.split("/")[-1] for m in infltweet.media] == [
+            "photo.jpg",
+            "video.mp4?tag=12",
+        ]
+        assert infltweet.media[0].data == b"photo"
+        assert infltweet.media[1].load(site.video_store("1")) == b"video"
@@ -0,0 +1,211 @@
+"""Recording every Twitter API call, to see where a crawl's time and quota go
+
+Calls are made through call(), which records, per endpoint:
+
+- How many calls were made and how many failed, by HTTP status
+- A histogram of latencies
+- The size of the responses
+- The rate limit headers of the latest response:
+  how many calls the window allows, how many are left, and when it resets
+
+From the headers we estimate a budget for each endpoint:
+how many calls per minute we can keep making until the window resets.
+The rate limit headers also correct the token buckets in ratelimit.py,
+which otherwise only know about the calls made by this process.
+
+A summary is logged every LOG_INTERVAL seconds while calls are being made,
+and again at exit,
+when it is also saved as JSON to report_path if that is set.
+"""
+
+import atexit
+import bisect
+import collections
+import functools
+import json
+import os
+import threading
+import time
+import typing
+
+import requests
+import tweepy
+
+from twarchive import logger
+from twarchive import ratelimit
+
+
+# Upper bounds of the latency histogram buckets, in seconds; the last bucket is everything slower
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LOG_INTERVAL = 60
+
+
+class EndpointStats:
+    """Everything recorded about calls to one endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.nbytes = 0
+        self.statuses: typing.Counter[int] = collections.Counter()
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.limit: typing.Optional[int] = None
+        self.remaining: typing.Optional[int] = None
+        self.reset: typing.Optional[float] = None
+
+    def record(self, seconds: float, response: typing.Optional[requests.Response]):
+        self.calls += 1
+        self.seconds += seconds
+        self.latencies[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if response is None:
+            return
+        self.statuses[response.status_code] += 1
+        self.nbytes += len(response.content or b"")
+        try:
+            self.limit = int(response.headers["x-rate-limit-limit"])
+            self.remaining = int(response.headers["x-rate-limit-remaining"])
+            self.reset = float(response.headers["x-rate-limit-reset"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    def budget(self) -> typing.Dict[str, typing.Any]:
+        """Estimate what is left of the rate limit window"""
+        if self.remaining is None or self.reset is None:
+            return {}
+        reset_in = max(0.0, self.reset - time.time())
+        return {
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset_in_seconds": round(reset_in),
+            # If the window has already reset, the whole limit is available again
+            "calls_per_minute": round(self.remaining / reset_in * 60, 1)
+            if reset_in
+            else self.limit,
+        }
+
+    def jsonable(self) -> typing.Dict[str, typing.Any]:
+        bounds = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [
+            f">{LATENCY_BUCKETS[-1]}s"
+        ]
+        return {
+            "calls": self.calls,
+            "errors": sum(c for s, c in self.statuses.items() if s >= 400),
+            "statuses": {str(s): c for s, c in sorted(self.statuses.items())},
+            "seconds": round(self.seconds, 3),
+            "mean_seconds": round(self.seconds / self.calls, 3) if self.calls else None,
+            "bytes": self.nbytes,
+            "latency_histogram": dict(zip(bounds, self.latencies)),
+            "budget": self.budget(),
+        }
+
+
+class Telemetry:
+    """API call statistics for one process; safe to use from several threads at once
+
+    Arguments:
+        log_interval:   Log a summary at most this often, in seconds, while calls are being made
+        report_path:    If set, save the summary to this file as JSON at exit
+    """
+
+    def __init__(
+        self,
+        log_interval: float = LOG_INTERVAL,
+        report_path: typing.Optional[str] = None,
+    ):
+        self.log_interval = log_interval
+        self.report_path = report_path
+        self.endpoints: typing.Dict[str, EndpointStats] = collections.defaultdict(
+            EndpointStats
+        )
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_logged = time.monotonic()
+
+    def instrument(self, api: tweepy.API):
+        """Capture the responses to API calls, so call() can read their headers
+
+        tweepy keeps only the last response on the API object,
+        which another thread may have replaced by the time we look at it,
+        so instead we hook the session and keep the last response per thread.
+        """
+        session = getattr(api, "session", None)
+        if session is None or self._hook in session.hooks["response"]:
+            return
+        session.hooks["response"].append(self._hook)
+
+    def _hook(self, response: requests.Response, *args, **kwargs):
+        self._local.response = response
+
+    def call(
+        self, api: tweepy.API, endpoint: str, func: typing.Callable, *args, **kwargs
+    ):
+        """Call func(*args, **kwargs), a method of api, and record it as a call to endpoint"""
+        self.instrument(api)
+        self._local.response = None
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            response = self._local.response
+            with self._lock:
+                stats = self.endpoints[endpoint]
+                stats.record(seconds, response)
+                remaining, reset = stats.remaining, stats.reset
+            if response is not None and endpoint in ratelimit.RATE_LIMITS:
+                if remaining is not None and reset is not None:
+                    ratelimit.bucket(endpoint).observe(remaining, reset)
+            self.log_periodically()
+
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                endpoint: stats.jsonable()
+                for endpoint, stats in sorted(self.endpoints.items())
+            }
+
+    def log(self):
+        for endpoint, stats in self.summary().items():
+            budget = stats["budget"]
+            quota = (
+                f", {budget['remaining']}/{budget['limit']} left for {budget['reset_in_seconds']}s ({budget['calls_per_minute']}/min)"
+                if budget
+                else ""
+            )
+            logger.info(
+                f"API {endpoint}: {stats['calls']} calls, {stats['errors']} errors, mean {stats['mean_seconds']}s{quota}"
+            )
+
+    def log_periodically(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_logged < self.log_interval:
+                return
+            self._last_logged = now
+        self.log()
+
+    def dump(self):
+        """Log a summary, and save it to report_path if set; called at exit"""
+        if not self.endpoints:
+            return
+        self.log()
+        if self.report_path:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.report_path)), exist_ok=True
+            )
+            with open(self.report_path, "w") as rfp:
+                json.dump(self.summary(), rfp, indent=2, sort_keys=True)
+
+
+@functools.cache
+def default_telemetry() -> Telemetry:
+    """The Telemetry shared by everything in this process, which is dumped at exit"""
+    telemetry = Telemetry()
+    atexit.register(telemetry.dump)
+    return telemetry
+
+
+def call(api: tweepy.API, endpoint: str, func: typing.Callable, *args, **kwargs):
+    """Make an API call, recording it in the default Telemetry"""
+    return default_telemetry().call(api, endpoint, func, *args, **kwargs)
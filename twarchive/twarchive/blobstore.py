@@ -0,0 +1,96 @@
+"""A content-addressed store for media payloads
+
+Each payload is written once, under the sha256 of its contents,
+so an image attached to several tweets only takes up space one time.
+Tweet JSON that uses the blob store keeps only the hash of each payload.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from twarchive import util
+
+
+class BlobStore:
+    """A directory of files named after the sha256 of their contents
+
+    Blobs are sharded into subdirectories by the first two characters of their hash,
+    so that no single directory gets too large.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def blobpath(self, sha256: str) -> str:
+        """Return the path to a blob, whether or not it exists"""
+        return os.path.join(self.path, sha256[0:2], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.blobpath(sha256))
+
+    def put(self, data: bytes) -> str:
+        """Save a payload to the store if it isn't there already, and return its hash"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.blobpath(sha256)
+        if os.path.exists(path):
+            return sha256
+        shard = os.path.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+        # Write to a temporary file and rename it into place,
+        # so that a reader never sees a partially written blob.
+        fd, tmppath = tempfile.mkstemp(dir=shard, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tfp:
+                tfp.write(data)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        return sha256
+
+    def put_file(self, path: str, move: bool = False) -> str:
+        """Save a file to the store if it isn't there already, and return its hash
+
+        The file is never read into memory all at once,
+        so this is the way to save large media like videos.
+        If move is True, the file is moved into the store (or removed, if the store already has it);
+        otherwise it is hard linked into the store if possible, or copied.
+        """
+        hasher = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(util.CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        sha256 = hasher.hexdigest()
+        blobpath = self.blobpath(sha256)
+        if os.path.exists(blobpath):
+            if move:
+                os.remove(path)
+            return sha256
+        shard = os.path.dirname(blobpath)
+        os.makedirs(shard, exist_ok=True)
+        if move:
+            try:
+                os.replace(path, blobpath)
+                return sha256
+            except OSError:
+                # Probably a different filesystem; copy it instead
+                pass
+        fd, tmppath = tempfile.mkstemp(dir=shard, prefix=".tmp-")
+        os.close(fd)
+        try:
+            os.remove(tmppath)
+            util.link_or_copy(path, tmppath)
+            os.replace(tmppath, blobpath)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        if move:
+            os.remove(path)
+        return sha256
+
+    def get(self, sha256: str) -> bytes:
+        """Return the contents of a blob"""
+        with open(self.blobpath(sha256), "rb") as bfp:
+            return bfp.read()
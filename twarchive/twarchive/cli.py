@@ -8,8 +8,10 @@ import typing
 
 import tweepy
 
+from twarchive import apitelemetry
 from twarchive import hugo
 from twarchive import logger
+from twarchive import profiling
 from twarchive import twitterapi
 from twarchive import twitterarchive
 from twarchive import version
@@ -36,14 +38,34 @@ def inline2data(
     """Save tweets to data that have been inlined
 
     Does not redownload items already saved.
+    If interrupted, running it again continues where it stopped.
     """
+    tweetids = []
     for tweetid in hugo.find_inline_tweets(site):
         if tweetid.endswith("-intentionallyinvalid"):
             logger.info(f"Skipping intentionally invalid tweet id {tweetid}")
         else:
-            twitterapi.tweet2data(
-                site, api, tweetid=tweetid, force=force, max_rlevel=max_rlevel
-            )
+            tweetids.append(tweetid)
+    twitterapi.tweets2data(
+        site, api, tweetids, force=force, max_rlevel=max_rlevel, crawl="inline2data"
+    )
+
+
+def read_tweetids_file(path: str) -> typing.List[str]:
+    """Read tweet IDs from a file, one per line, or from stdin if path is "-"
+
+    Blank lines and lines starting with # are ignored.
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as tifp:
+            lines = tifp.readlines()
+    return [
+        line.strip()
+        for line in lines
+        if line.strip() and not line.strip().startswith("#")
+    ]
 
 
 def list_directory_tweetid_filename(directory: str) -> typing.List[str]:
@@ -73,6 +95,25 @@ def parseargs():
         action="store_true",
         help="Launch a debugger on unhandled exception",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time each phase of the run (parsing, inflating, media, encoding, writing, and waiting on the API), and save a JSON report",
+    )
+    parser.add_argument(
+        "--profile-report",
+        help="Save the --profile report here. Defaults to .twarchive/cache/profiles/<command>-<time>.json in the Hugo site, or the $PWD for commands that don't use one.",
+    )
+    parser.add_argument(
+        "--profile-cprofile",
+        action="store_true",
+        help="With --profile, also run cProfile, and save its stats next to the report with a .prof extension",
+    )
+    parser.add_argument(
+        "--profile-tracemalloc",
+        action="store_true",
+        help="With --profile, also trace memory allocations, and report the peak and the biggest allocation sites. This slows the run down considerably.",
+    )
 
     ## Options related to the Twitter API
     twitter_opts = argparse.ArgumentParser(add_help=False)
@@ -152,6 +193,13 @@ def parseargs():
         help="Use our custom JSON en/de-coders to parse JSON of every tweet saved to data/twarchive/*.json, and save it back out.",
     )
 
+    ## Subcommand: internals: Subcommand: reindex
+    sub_internals_sub_reindex = sub_internals_subparsers.add_parser(
+        "reindex",
+        parents=[hugo_opts],
+        help="Rebuild the index of tweets in data/twarchive/*.json, which is kept in .twarchive/cache/index.sqlite3",
+    )
+
     ## Subcommand: tweet2json
     sub_tweet2json = subparsers.add_parser(
         "tweet2json",
@@ -167,7 +215,15 @@ def parseargs():
         parents=[twitter_opts, hugo_opts],
         help="Download JSON for a tweet, and store it under './data/twarchive/$tweetId.json', including any QTs or parents",
     )
-    sub_tweet2data.add_argument("tweetid", help="ID of a tweet to download")
+    sub_tweet2data.add_argument(
+        "tweetid",
+        nargs="*",
+        help="ID of a tweet to download; may be passed more than once",
+    )
+    sub_tweet2data.add_argument(
+        "--from-file",
+        help="Also download tweets whose IDs are listed in this file, one per line; pass '-' to read from stdin",
+    )
 
     ## Subcommand: manual2data
     sub_manual2data = subparsers.add_parser(
@@ -228,6 +284,13 @@ def parseargs():
         parents=[hugo_opts],
         help="Create a page under content/twarchive/ for every downloaded tweet",
     )
+    sub_data2md.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=0,
+        help="Number of processes to use when making resized copies of photos; 0 means one per CPU",
+    )
 
     ## Subcommand: user2data
     sub_user2data = subparsers.add_parser(
@@ -235,7 +298,11 @@ def parseargs():
         parents=[twitter_opts, hugo_opts],
         help="Retrieve a user's full timeline from Twitter and store in site data",
     )
-    sub_user2data.add_argument("username", help="Twitter username")
+    sub_user2data.add_argument(
+        "username",
+        nargs="+",
+        help="Twitter username. Pass more than one to sync several users. After the first sync, only tweets newer than the newest one saved are retrieved, unless --force or --retrieve-all is passed.",
+    )
     sub_user2data.add_argument(
         "--retrieve-all",
         action="store_true",
@@ -257,6 +324,37 @@ def parseargs():
         action="store_true",
         help="Don't query the API for missing RTs, QTs, or thread parents",
     )
+    sub_archive2data.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes to use when inflating and saving tweets; 0 means one per CPU. Output is identical no matter how many are used.",
+    )
+    sub_archive2data.add_argument(
+        "--reimport-all",
+        action="store_true",
+        help="Inflate and save every tweet in the archive, even tweets that were imported before and have not changed",
+    )
+
+    ## Subcommand: media2blobs
+    sub_media2blobs = subparsers.add_parser(
+        "media2blobs",
+        parents=[hugo_opts],
+        help="Move media embedded in data/twarchive/*.json into a content-addressed blob store under assets/twarchive/blobs, and save media there from now on",
+    )
+
+    ## Subcommand: set-layout
+    sub_set_layout = subparsers.add_parser(
+        "set-layout",
+        parents=[hugo_opts],
+        help="Move every tweet and its media to a layout, and save tweets in that layout from now on",
+    )
+    sub_set_layout.add_argument(
+        "layout",
+        choices=["data", "bundles"],
+        help="'data' saves tweets to data/twarchive/<id>.json, which Hugo loads on every build; 'bundles' saves them as page bundles under content/twarchive/<id>/, which Hugo only reads for pages that use them",
+    )
 
     ## Subcommand: show-inline-tweets
     sub_show_inline_tweets = subparsers.add_parser(
@@ -270,12 +368,39 @@ def parseargs():
     return parser, parsed
 
 
+def profile_report_path(parsed: argparse.Namespace) -> str:
+    """Where to save the --profile report"""
+    if parsed.profile_report:
+        return parsed.profile_report
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    filename = f"{parsed.action}-{timestamp}.json"
+    if hasattr(parsed, "hugo_site_base"):
+        return os.path.join(hugo.HugoSite(parsed.hugo_site_base).profiles, filename)
+    return f"twarchive-profile-{filename}"
+
+
 def main():
     """Main program"""
     parser, parsed = parseargs()
     if parsed.debug:
         sys.excepthook = idb_excepthook
+    if hasattr(parsed, "hugo_site_base"):
+        site = hugo.HugoSite(parsed.hugo_site_base)
+        apitelemetry.default_telemetry().report_path = site.api_telemetry_path
+
+    if not parsed.profile:
+        return run(parser, parsed)
+    with profiling.profile(
+        profile_report_path(parsed),
+        command=sys.argv,
+        cprofile=parsed.profile_cprofile,
+        memory=parsed.profile_tracemalloc,
+    ):
+        return run(parser, parsed)
+
 
+def run(parser: argparse.ArgumentParser, parsed: argparse.Namespace):
+    """Run the subcommand"""
     if parsed.action == "version":
         if parsed.quiet:
             print(version.__version__)
@@ -286,7 +411,7 @@ def main():
     elif parsed.action == "ls":
         site = hugo.HugoSite(parsed.hugo_site_base)
         if parsed.directory == "data":
-            dir = site.data_twarchive
+            dir = site.tweet_data_dir
         elif parsed.directory == "content":
             dir = site.content_twarchive
         else:
@@ -301,12 +426,14 @@ def main():
             pdb.set_trace()
         elif parsed.internalsaction == "json-load-dump-tweets":
             site = hugo.HugoSite(parsed.hugo_site_base)
-            for tweetjson in os.listdir(site.data_twarchive):
-                tweetjson_path = os.path.join(site.data_twarchive, tweetjson)
-                with open(tweetjson_path) as tjfp:
+            site.tweet_index.sync()
+            for tweetid in site.tweet_index.ids():
+                with open(site.tweet_data_path(tweetid)) as tjfp:
                     infltweet = InflatedTweet.jload(tjfp)
-                with open(tweetjson_path, "w") as tjfp:
-                    infltweet.jdump(tjfp)
+                hugo.save_tweet(site, infltweet)
+        elif parsed.internalsaction == "reindex":
+            site = hugo.HugoSite(parsed.hugo_site_base)
+            site.tweet_index.rebuild()
 
     elif parsed.action == "tweet2json":
         api = twitterapi.authenticate(parsed.consumer_key, parsed.consumer_secret)
@@ -314,11 +441,16 @@ def main():
 
     elif parsed.action == "tweet2data":
         site = hugo.HugoSite(parsed.hugo_site_base)
+        tweetids = list(parsed.tweetid)
+        if parsed.from_file:
+            tweetids.extend(read_tweetids_file(parsed.from_file))
+        if not tweetids:
+            parser.error("tweet2data requires at least one tweet ID")
         api = twitterapi.authenticate(parsed.consumer_key, parsed.consumer_secret)
-        twitterapi.tweet2data(
+        twitterapi.tweets2data(
             site,
             api,
-            tweetid=parsed.tweetid,
+            tweetids,
             force=parsed.force,
             max_rlevel=parsed.max_recurse,
         )
@@ -336,8 +468,7 @@ def main():
             parsed.user_uri,
             parsed.user_pfp_color,
         )
-        filename = os.path.join(site.data_twarchive, f"{parsed.id}.json")
-        infltweet.jdump(filepath=filename)
+        hugo.save_tweet(site, infltweet)
         hugo.data2md(site)
 
     elif parsed.action == "showinlines":
@@ -347,7 +478,7 @@ def main():
     elif parsed.action == "inline2data":
         site = hugo.HugoSite(parsed.hugo_site_base)
         api = twitterapi.authenticate(parsed.consumer_key, parsed.consumer_secret)
-        twitterapi.inline2data(
+        inline2data(
             site,
             api,
             force=parsed.force,
@@ -357,19 +488,20 @@ def main():
 
     elif parsed.action == "data2md":
         site = hugo.HugoSite(parsed.hugo_site_base)
-        hugo.data2md(site)
+        hugo.data2md(site, jobs=parsed.jobs)
 
     elif parsed.action == "user2data":
         site = hugo.HugoSite(parsed.hugo_site_base)
         api = twitterapi.authenticate(parsed.consumer_key, parsed.consumer_secret)
-        twitterapi.usertweets2data(
-            site,
-            api,
-            parsed.username,
-            max_rlevel=parsed.max_recurse,
-            force=parsed.force,
-            retrieve_all=parsed.retrieve_all,
-        )
+        for username in parsed.username:
+            twitterapi.usertweets2data(
+                site,
+                api,
+                username,
+                max_rlevel=parsed.max_recurse,
+                force=parsed.force,
+                retrieve_all=parsed.retrieve_all,
+            )
         hugo.data2md(site)
 
     elif parsed.action == "archive2data":
@@ -396,8 +528,18 @@ def main():
                 api=api,
                 max_recurse=parsed.max_recurse,
                 api_force_download=parsed.force,
+                jobs=parsed.jobs,
+                reimport_all=parsed.reimport_all,
             )
 
+    elif parsed.action == "media2blobs":
+        site = hugo.HugoSite(parsed.hugo_site_base)
+        hugo.media2blobs(site)
+
+    elif parsed.action == "set-layout":
+        site = hugo.HugoSite(parsed.hugo_site_base)
+        hugo.set_layout(site, parsed.layout)
+
     elif parsed.action == "show-inline-tweets":
         site = hugo.HugoSite(parsed.hugo_site_base)
         for inline in hugo.find_inline_tweets(site):
@@ -0,0 +1,394 @@
+"""Crawling tweets and every tweet they refer to
+
+Saving a tweet means saving its QTs, its thread parent, and the tweet it retweets,
+and then their QTs, parents, and retweets, and so on.
+The Crawler does this with three concurrent stages on an asyncio event loop:
+
+1.  Looking up tweets, in batches of up to 100 with one statuses/lookup call.
+    Each call waits for a token from the endpoint's rate limit bucket,
+    and the batch is only chosen once the token arrives,
+    so while we wait on the API quota more IDs pile up and the next call is fuller.
+    Tweets closest to the ones we started with are looked up first.
+2.  Inflating tweets, which downloads their media and profile pictures.
+3.  Writing tweets to site data, one at a time,
+    which finds the tweets they refer to and hands those back to the first stage.
+
+Each tweet ID is fetched at most once per run.
+A tweet that can't be inflated or written, for instance because its media won't download,
+is logged and skipped, and the rest of the crawl carries on.
+So is a batch that can't be looked up,
+once server errors and dropped connections have been retried a few times.
+"""
+
+import asyncio
+import concurrent.futures
+import time
+import typing
+
+import tweepy
+
+from twarchive import apitelemetry
+from twarchive import hugo
+from twarchive import logger
+from twarchive import profiling
+from twarchive import ratelimit
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
+from twarchive.inflatedtweet.from_tweepy import inflated_tweet_from_tweepy
+
+
+# The most IDs that statuses/lookup accepts in one call
+LOOKUP_BATCH_SIZE = 100
+
+# How many times to retry a lookup that fails with a transient error,
+# and how long to wait before the first retry; the wait doubles each time
+LOOKUP_RETRIES = 4
+LOOKUP_RETRY_DELAY = 2.0
+
+# Marks the end of an asyncio.Queue
+_DONE = object()
+
+
+def lookup_statuses_expanded(
+    api: tweepy.API, tweetids: typing.List[str]
+) -> typing.List[tweepy.models.Status]:
+    """Get up to LOOKUP_BATCH_SIZE statuses in one API call
+
+    Tweets that have been deleted, or that we are not permitted to see, are left out of the result.
+    """
+    with profiling.phase("api") as measure:
+        try:
+            found = apitelemetry.call(
+                api,
+                "statuses/lookup",
+                api.lookup_statuses,
+                tweetids,
+                include_ext_alt_text=True,
+                tweet_mode="extended",
+            )
+        except tweepy.errors.NotFound:
+            # statuses/lookup returns 404 if none of the tweets can be found
+            found = []
+        measure.items = len(found)
+    return found
+
+
+def related_tweet_ids(
+    tweet: tweepy.models.Status, infltweet: InflatedTweet
+) -> typing.List[str]:
+    """Return the IDs of the QTs, thread parent, and retweet of a tweet"""
+    related = list(infltweet.qts)
+    if infltweet.thread_parent_id:
+        related.append(infltweet.thread_parent_id)
+    try:
+        related.append(tweet.retweeted_status.id_str)
+    except AttributeError:
+        pass
+    return related
+
+
+def rate_limit_reset(exc: tweepy.errors.TooManyRequests) -> float:
+    """Return the Unix time when Twitter says a rate limit window resets"""
+    try:
+        return float(exc.response.headers["x-rate-limit-reset"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return time.time() + ratelimit.RATE_LIMIT_WINDOW
+
+
+def is_transient(exc: Exception) -> bool:
+    """Return whether an API call that raised exc might succeed if it is retried
+
+    That means server errors, and failures to send the request at all,
+    which tweepy raises as a plain TweepyException.
+    Other HTTP errors, like Unauthorized or Forbidden, will just happen again.
+    """
+    if isinstance(exc, tweepy.errors.TwitterServerError):
+        return True
+    if isinstance(exc, tweepy.errors.HTTPException):
+        return False
+    return isinstance(exc, (tweepy.errors.TweepyException, OSError))
+
+
+class Crawler:
+    """Save tweets, and the tweets they refer to
+
+    Arguments:
+        site:           A hugo.HugoSite object
+        api:            A tweepy.API that has already authenticated
+        force:          Redownload tweets that already exist in site data.
+                        Even so, each tweet is downloaded only once per run.
+        max_rlevel:     How many levels of QT, parent, or retweet to follow from the tweets we start with.
+        inflate_jobs:   How many tweets to download media for at once
+        lookup_jobs:    How many statuses/lookup calls to make at once
+        crawl:          If passed, record progress in the site's crawl journal under this name,
+                        and pick up anything left over from an earlier run of the same crawl.
+    """
+
+    def __init__(
+        self,
+        site: hugo.HugoSite,
+        api: tweepy.API,
+        force: bool = False,
+        max_rlevel: int = 20,
+        inflate_jobs: int = 4,
+        lookup_jobs: int = 2,
+        crawl: str = "",
+    ):
+        self.site = site
+        self.api = api
+        self.force = force
+        self.max_rlevel = max_rlevel
+        self.inflate_jobs = inflate_jobs
+        self.lookup_jobs = lookup_jobs
+        # Tweet IDs queued or skipped this run
+        self.seen: typing.Set[str] = set()
+        # Tweet IDs waiting to be looked up, and their recursion levels
+        self.pending: typing.Dict[str, int] = {}
+        # Already retrieved statuses (e.g. from a user timeline), and their recursion levels
+        self.retrieved: typing.List[typing.Tuple[tweepy.models.Status, int]] = []
+        self.downloaded_tweets = hugo.get_downloaded_tweets(site)
+        self.saved = 0
+        # Tweet IDs that could not be saved, and their recursion levels
+        self.failed: typing.Dict[str, int] = {}
+        self.crawl = crawl
+        self.journal = site.crawl_journal if crawl else None
+        if self.journal:
+            self._resume()
+
+    def _resume(self):
+        """Pick up where an earlier run of the same crawl stopped"""
+        self.seen.update(self.journal.completed(self.crawl))
+        for tweetid, rlevel, _ in self.journal.failed(self.crawl):
+            self.seen.add(tweetid)
+            self.failed[tweetid] = rlevel
+        pending = self.journal.pending(self.crawl)
+        for tweetid, rlevel, status in pending:
+            self.seen.add(tweetid)
+            if status:
+                self.retrieved.append(
+                    (tweepy.models.Status.parse(self.api, status), rlevel)
+                )
+            else:
+                self.pending[tweetid] = rlevel
+        if pending:
+            logger.info(
+                f"Resuming crawl {self.crawl} with {len(pending)} tweets left to save"
+            )
+
+    def _complete(self, tweetid: str):
+        if self.journal:
+            self.journal.complete(self.crawl, tweetid)
+
+    def _record_failure(self, tweetid: str, rlevel: int, exc: Exception):
+        error = f"{type(exc).__name__}: {exc}".replace("\n", " ")
+        logger.warning(f"Could not save tweet {tweetid}: {error}")
+        self.failed[tweetid] = rlevel
+        if self.journal:
+            self.journal.fail(self.crawl, tweetid, rlevel, error)
+
+    def _fail(self, tweetid: str, rlevel: int, exc: Exception):
+        """Give up on a tweet that could not be inflated or written"""
+        self._record_failure(tweetid, rlevel, exc)
+        self._inflight -= 1
+        self._changed.set()
+
+    def _fail_batch(self, batch_rlevels: typing.Dict[str, int], exc: Exception):
+        """Give up on a batch of tweets that could not be looked up"""
+        for tweetid, rlevel in batch_rlevels.items():
+            self._record_failure(tweetid, rlevel, exc)
+        self._inflight -= 1
+        self._changed.set()
+
+    def _should_save(self, tweetid: str, rlevel: int) -> bool:
+        if rlevel > self.max_rlevel:
+            # Don't mark it as seen; we might find it again at a lower recursion level
+            if tweetid not in self.seen:
+                logger.warning(
+                    f"WARNING! Recursion level of {rlevel}, refusing to download tweet {tweetid}"
+                )
+            return False
+        if tweetid in self.pending:
+            if rlevel < self.pending[tweetid]:
+                self.pending[tweetid] = rlevel
+                if self.journal:
+                    self.journal.add_pending(self.crawl, tweetid, rlevel)
+            return False
+        if tweetid in self.seen:
+            return False
+        self.seen.add(tweetid)
+        if tweetid in self.downloaded_tweets and not self.force:
+            logger.info(
+                f"Tweet {tweetid} already exists in site data and force=False, not downloading"
+            )
+            return False
+        return True
+
+    def add(self, tweetid: str, rlevel: int = 0):
+        """Queue a tweet ID to be downloaded and saved"""
+        if self._should_save(tweetid, rlevel):
+            self.pending[tweetid] = rlevel
+            if self.journal:
+                self.journal.add_pending(self.crawl, tweetid, rlevel)
+
+    def add_status(self, tweet: tweepy.models.Status, rlevel: int = 0):
+        """Queue an already retrieved tweet to be saved"""
+        if self._should_save(tweet.id_str, rlevel):
+            self.retrieved.append((tweet, rlevel))
+            if self.journal:
+                self.journal.add_pending(self.crawl, tweet.id_str, rlevel, tweet._json)
+
+    def run(self) -> int:
+        """Save everything queued, and everything it refers to
+
+        Returns the number of tweets saved.
+        Tweets that could not be saved are left in self.failed.
+        If the crawl has a name, it is removed from the crawl journal once it finishes.
+        """
+        # Inflating tweets runs in a thread pool, and writing them in a single thread of its own,
+        # so that writes never happen concurrently.
+        self._inflate_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.inflate_jobs, thread_name_prefix="twarchive-inflate"
+        )
+        self._write_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="twarchive-write"
+        )
+        try:
+            asyncio.run(self._crawl())
+        finally:
+            self._inflate_executor.shutdown()
+            self._write_executor.shutdown()
+        if self.failed:
+            logger.warning(
+                f"Could not save {len(self.failed)} tweets: {', '.join(sorted(self.failed))}"
+            )
+        if self.journal:
+            self.journal.finish(self.crawl)
+        return self.saved
+
+    async def _crawl(self):
+        self._changed = asyncio.Event()
+        self._inflate_queue: asyncio.Queue = asyncio.Queue()
+        self._write_queue: asyncio.Queue = asyncio.Queue()
+        # Lookups in progress, plus tweets that have been looked up but not yet written
+        self._inflight = 0
+        self._failure: typing.Optional[BaseException] = None
+        for tweet, rlevel in self.retrieved:
+            self._inflight += 1
+            self._inflate_queue.put_nowait((tweet, rlevel))
+        self.retrieved = []
+        inflaters = [self._inflate_stage() for _ in range(self.inflate_jobs)]
+        await asyncio.gather(self._lookup_stage(), *inflaters, self._write_stage())
+
+    def _take_batch(self) -> typing.Dict[str, int]:
+        """Remove up to LOOKUP_BATCH_SIZE IDs from pending, lowest recursion level first"""
+        batch = sorted(self.pending, key=self.pending.get)[:LOOKUP_BATCH_SIZE]
+        return {tweetid: self.pending.pop(tweetid) for tweetid in batch}
+
+    async def _lookup_stage(self):
+        bucket = ratelimit.bucket("statuses/lookup")
+        slots = asyncio.Semaphore(self.lookup_jobs)
+        lookups = set()
+
+        def lookup_done(task: asyncio.Task):
+            lookups.discard(task)
+            slots.release()
+            if not task.cancelled() and task.exception():
+                self._failure = task.exception()
+                self._changed.set()
+
+        while True:
+            if self._failure:
+                raise self._failure
+            if not self.pending:
+                if self._inflight == 0:
+                    break
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            await slots.acquire()
+            await bucket.acquire()
+            self._inflight += 1
+            task = asyncio.ensure_future(self._lookup(self._take_batch()))
+            lookups.add(task)
+            task.add_done_callback(lookup_done)
+
+        for _ in range(self.inflate_jobs):
+            self._inflate_queue.put_nowait(_DONE)
+
+    async def _lookup(self, batch_rlevels: typing.Dict[str, int]):
+        loop = asyncio.get_running_loop()
+        batch = list(batch_rlevels)
+        logger.info(f"Downloading {len(batch)} tweets")
+        retries = 0
+        while True:
+            try:
+                found = await loop.run_in_executor(
+                    None, lookup_statuses_expanded, self.api, batch
+                )
+                break
+            except tweepy.errors.TooManyRequests as exc:
+                bucket = ratelimit.bucket("statuses/lookup")
+                bucket.exhaust(rate_limit_reset(exc))
+                logger.warning(
+                    f"Rate limited looking up tweets, waiting {bucket.delay():.0f} seconds"
+                )
+                await bucket.acquire()
+            except Exception as exc:
+                if not is_transient(exc) or retries >= LOOKUP_RETRIES:
+                    self._fail_batch(batch_rlevels, exc)
+                    return
+                delay = LOOKUP_RETRY_DELAY * 2**retries
+                retries += 1
+                logger.warning(
+                    f"Error looking up tweets, retrying in {delay:.0f} seconds: {exc}"
+                )
+                await asyncio.sleep(delay)
+        found_ids = {t.id_str for t in found}
+        for tweetid in batch:
+            if tweetid not in found_ids:
+                logger.warning(f"Could not find tweet with ID {tweetid}")
+                self._complete(tweetid)
+        for tweet in found:
+            self._inflight += 1
+            self._inflate_queue.put_nowait((tweet, batch_rlevels[tweet.id_str]))
+        self._inflight -= 1
+        self._changed.set()
+
+    async def _inflate_stage(self):
+        loop = asyncio.get_running_loop()
+        while (item := await self._inflate_queue.get()) is not _DONE:
+            tweet, rlevel = item
+            try:
+                infltweet = await loop.run_in_executor(
+                    self._inflate_executor,
+                    lambda: inflated_tweet_from_tweepy(
+                        tweet, downloader=self.site.downloader
+                    ),
+                )
+            except Exception as exc:
+                self._fail(tweet.id_str, rlevel, exc)
+                continue
+            self._write_queue.put_nowait((tweet, infltweet, rlevel))
+        self._write_queue.put_nowait(_DONE)
+
+    async def _write_stage(self):
+        loop = asyncio.get_running_loop()
+        inflaters_running = self.inflate_jobs
+        while inflaters_running:
+            item = await self._write_queue.get()
+            if item is _DONE:
+                inflaters_running -= 1
+                continue
+            tweet, infltweet, rlevel = item
+            try:
+                await loop.run_in_executor(
+                    self._write_executor, hugo.save_tweet, self.site, infltweet
+                )
+            except Exception as exc:
+                self._fail(tweet.id_str, rlevel, exc)
+                continue
+            self.saved += 1
+            for reltweet in related_tweet_ids(tweet, infltweet):
+                self.add(reltweet, rlevel + 1)
+            self._complete(tweet.id_str)
+            self._inflight -= 1
+            self._changed.set()
@@ -0,0 +1,192 @@
+"""A journal of crawls in progress, so that an interrupted crawl can pick up where it stopped
+
+A crawl is identified by a name, like "user2data/mrled" or "inline2data".
+For each crawl, the journal records:
+
+- Where we are in paginating a timeline, if the crawl has one
+- Tweets waiting to be saved, and their recursion levels.
+  If the tweet has already been retrieved, e.g. as part of a user timeline,
+  its JSON is kept too, so that it does not have to be retrieved again.
+- Tweets already saved (or found to be missing)
+- Tweets that could not be saved, and why
+
+Every change is committed immediately.
+When a crawl finishes, its entries are removed.
+Deleting the journal is always safe; it only forgets the progress of unfinished crawls.
+"""
+
+import json
+import os
+import sqlite3
+import typing
+
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawls (
+    crawl TEXT PRIMARY KEY,
+    cursor TEXT,
+    paginated INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS pending (
+    crawl TEXT NOT NULL,
+    tweetid TEXT NOT NULL,
+    rlevel INTEGER NOT NULL,
+    status_json TEXT,
+    PRIMARY KEY (crawl, tweetid)
+);
+CREATE TABLE IF NOT EXISTS completed (
+    crawl TEXT NOT NULL,
+    tweetid TEXT NOT NULL,
+    PRIMARY KEY (crawl, tweetid)
+);
+CREATE TABLE IF NOT EXISTS failed (
+    crawl TEXT NOT NULL,
+    tweetid TEXT NOT NULL,
+    rlevel INTEGER NOT NULL,
+    error TEXT NOT NULL,
+    PRIMARY KEY (crawl, tweetid)
+);
+"""
+
+
+class PendingTweet(typing.NamedTuple):
+    tweetid: str
+    rlevel: int
+    # The tweet's JSON from the API, if it was already retrieved
+    status: typing.Optional[typing.Dict]
+
+
+class FailedTweet(typing.NamedTuple):
+    tweetid: str
+    rlevel: int
+    error: str
+
+
+class CrawlJournal:
+    """A SQLite journal of crawls in progress
+
+    Like TweetIndex, the connection is opened on first use and is not pickled.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: typing.Optional[sqlite3.Connection] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(JOURNAL_SCHEMA)
+        return self._conn
+
+    def cursor(self, crawl: str) -> typing.Tuple[typing.Optional[str], bool]:
+        """Return the pagination cursor for a crawl, and whether pagination has finished"""
+        row = self.conn.execute(
+            "SELECT cursor, paginated FROM crawls WHERE crawl = ?", (crawl,)
+        ).fetchone()
+        if not row:
+            return None, False
+        return row[0], bool(row[1])
+
+    def save_page(
+        self,
+        crawl: str,
+        cursor: typing.Optional[str],
+        paginated: bool,
+        statuses: typing.Iterable[typing.Dict] = (),
+    ):
+        """Record a page of a timeline: the tweets on it, and the cursor for the next page
+
+        Both are saved in one transaction,
+        so a page is never recorded without its tweets or vice versa.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pending (crawl, tweetid, rlevel, status_json) VALUES (?, ?, 0, ?)",
+                [(crawl, status["id_str"], json.dumps(status)) for status in statuses],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO crawls (crawl, cursor, paginated) VALUES (?, ?, ?)",
+                (crawl, cursor, int(paginated)),
+            )
+
+    def add_pending(
+        self,
+        crawl: str,
+        tweetid: str,
+        rlevel: int,
+        status: typing.Optional[typing.Dict] = None,
+    ):
+        """Record a tweet that is waiting to be saved"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pending (crawl, tweetid, rlevel, status_json) VALUES (?, ?, ?, ?)",
+                (crawl, tweetid, rlevel, json.dumps(status) if status else None),
+            )
+
+    def complete(self, crawl: str, tweetid: str):
+        """Record that a tweet has been saved, or that it could not be found"""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM pending WHERE crawl = ? AND tweetid = ?", (crawl, tweetid)
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO completed (crawl, tweetid) VALUES (?, ?)",
+                (crawl, tweetid),
+            )
+
+    def fail(self, crawl: str, tweetid: str, rlevel: int, error: str):
+        """Record that a tweet could not be saved, so that resuming the crawl doesn't try it again"""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM pending WHERE crawl = ? AND tweetid = ?", (crawl, tweetid)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO failed (crawl, tweetid, rlevel, error) VALUES (?, ?, ?, ?)",
+                (crawl, tweetid, rlevel, error),
+            )
+
+    def pending(self, crawl: str) -> typing.List[PendingTweet]:
+        """Return the tweets waiting to be saved in a crawl"""
+        return [
+            PendingTweet(
+                tweetid, rlevel, json.loads(status_json) if status_json else None
+            )
+            for tweetid, rlevel, status_json in self.conn.execute(
+                "SELECT tweetid, rlevel, status_json FROM pending WHERE crawl = ? ORDER BY rowid",
+                (crawl,),
+            )
+        ]
+
+    def completed(self, crawl: str) -> typing.Set[str]:
+        """Return the IDs of tweets already saved in a crawl"""
+        return {
+            tweetid
+            for (tweetid,) in self.conn.execute(
+                "SELECT tweetid FROM completed WHERE crawl = ?", (crawl,)
+            )
+        }
+
+    def failed(self, crawl: str) -> typing.List[FailedTweet]:
+        """Return the tweets that could not be saved in a crawl"""
+        return [
+            FailedTweet(*row)
+            for row in self.conn.execute(
+                "SELECT tweetid, rlevel, error FROM failed WHERE crawl = ? ORDER BY rowid",
+                (crawl,),
+            )
+        ]
+
+    def finish(self, crawl: str):
+        """Forget a crawl that has finished"""
+        with self.conn:
+            for table in ["crawls", "pending", "completed", "failed"]:
+                self.conn.execute(f"DELETE FROM {table} WHERE crawl = ?", (crawl,))
@@ -0,0 +1,279 @@
+"""Resized copies of photos, so that pages don't have to inline full size images
+
+For each photo in a blob store,
+we make smaller copies at a few widths (and optionally WebP copies too),
+plus a tiny placeholder to show while they load.
+They are saved to <outdir>/<sha[:2]>/<sha>/, named after the sha256 of the original,
+so a photo is only ever processed once,
+no matter how many tweets it is attached to.
+derivatives.json in that directory describes them for the theme.
+The hashes that have been processed are also listed in a single index file,
+so that checking for new photos doesn't mean reading one derivatives.json per blob.
+
+Making derivatives requires Pillow (pip install twarchive[images]).
+Without it, nothing is generated, and the theme inlines full size photos as before.
+"""
+
+import base64
+import concurrent.futures
+import io
+import json
+import os
+import shutil
+import typing
+
+from twarchive import logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+PLACEHOLDER_WIDTH = 16
+
+
+class DerivativeSettings(typing.NamedTuple):
+    """How to make derivatives
+
+    widths:     The widths to resize photos to; photos are never enlarged
+    webp:       Also save a WebP copy at each width
+    quality:    The JPEG and WebP quality
+    """
+
+    widths: typing.Tuple[int, ...] = (320, 640, 1280)
+    webp: bool = False
+    quality: int = 82
+
+    @classmethod
+    def from_setting(cls, setting: typing.Any) -> typing.Optional["DerivativeSettings"]:
+        """Read the image_derivatives site setting
+
+        The setting may be false to turn derivatives off,
+        or a dict with any of the fields of this class.
+        """
+        if setting is False:
+            return None
+        setting = setting if isinstance(setting, dict) else {}
+        return cls(
+            widths=tuple(sorted(setting.get("widths", cls._field_defaults["widths"]))),
+            webp=setting.get("webp", cls._field_defaults["webp"]),
+            quality=setting.get("quality", cls._field_defaults["quality"]),
+        )
+
+    def jsonable(self) -> typing.Dict:
+        return {"widths": list(self.widths), "webp": self.webp, "quality": self.quality}
+
+
+def derivatives_dir(outdir: str, sha256: str) -> str:
+    return os.path.join(outdir, sha256[0:2], sha256)
+
+
+def up_to_date(outdir: str, sha256: str, settings: DerivativeSettings) -> bool:
+    """Return whether derivatives for a blob already exist with these settings"""
+    manifest = os.path.join(derivatives_dir(outdir, sha256), "derivatives.json")
+    try:
+        with open(manifest) as mfp:
+            return json.load(mfp)["settings"] == settings.jsonable()
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return False
+
+
+def read_index(index_path: str, settings: DerivativeSettings) -> typing.Set[str]:
+    """Return the hashes that the index says have derivatives with these settings"""
+    try:
+        with open(index_path) as ifp:
+            index = json.load(ifp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return set()
+    if index.get("settings") != settings.jsonable():
+        return set()
+    return set(index.get("done", []))
+
+
+def write_index(index_path: str, settings: DerivativeSettings, done: typing.Set[str]):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as ifp:
+        json.dump({"settings": settings.jsonable(), "done": sorted(done)}, ifp)
+    os.replace(tmp_path, index_path)
+
+
+def encode(image: "Image.Image", fmt: str, quality: int) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, format=fmt, quality=quality)
+    return buf.getvalue()
+
+
+def make_derivatives(
+    sha256: str,
+    source: str,
+    outdir: str,
+    assets_prefix: str,
+    settings: DerivativeSettings,
+) -> typing.Dict:
+    """Make derivatives for a single blob, and return its derivatives.json
+
+    Blobs that aren't images, like videos, get a derivatives.json that says so,
+    so they are skipped next time.
+
+    Arguments:
+        sha256:         The hash of the blob
+        source:         The path to the blob
+        outdir:         Where to save derivatives
+        assets_prefix:  The path to outdir relative to the Hugo assets directory,
+                        which the theme needs to resources.Get the derivatives
+        settings:       How to make derivatives
+    """
+    final_dir = derivatives_dir(outdir, sha256)
+    prefix = f"{assets_prefix}/{sha256[0:2]}/{sha256}"
+    manifest: typing.Dict[str, typing.Any] = {
+        "source": sha256,
+        "settings": settings.jsonable(),
+    }
+    # Build everything in a temporary directory and rename it into place,
+    # so that the theme never sees half a set of derivatives
+    tmp_dir = f"{final_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        manifest.update(write_variants(source, tmp_dir, prefix, settings))
+        with open(os.path.join(tmp_dir, "derivatives.json"), "w") as mfp:
+            json.dump(manifest, mfp, indent=2, sort_keys=True)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+    finally:
+        # Only left over if something went wrong
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return manifest
+
+
+def write_variants(
+    source: str,
+    tmp_dir: str,
+    prefix: str,
+    settings: DerivativeSettings,
+) -> typing.Dict:
+    """Save resized copies of a blob to tmp_dir, and return what derivatives.json says about them"""
+    manifest: typing.Dict[str, typing.Any] = {}
+    try:
+        image = Image.open(source)
+        image.load()
+    except (OSError, Image.DecompressionBombError):
+        manifest["image"] = False
+    else:
+        manifest["image"] = True
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        fmt, ext, content_type = (
+            ("PNG", "png", "image/png") if has_alpha else ("JPEG", "jpg", "image/jpeg")
+        )
+        manifest["width"], manifest["height"] = image.size
+
+        formats = [(fmt, ext, content_type)]
+        if settings.webp:
+            formats.append(("WEBP", "webp", "image/webp"))
+        variants = []
+        for width in settings.widths:
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            for vfmt, vext, vtype in formats:
+                filename = f"{width}.{vext}"
+                with open(os.path.join(tmp_dir, filename), "wb") as vfp:
+                    vfp.write(encode(resized, vfmt, settings.quality))
+                variants.append(
+                    {
+                        "width": width,
+                        "height": height,
+                        "content_type": vtype,
+                        "path": f"{prefix}/{filename}",
+                    }
+                )
+        manifest["variants"] = variants
+
+        pheight = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+        placeholder = image.convert("RGB").resize((PLACEHOLDER_WIDTH, pheight))
+        manifest["placeholder"] = (
+            "data:image/jpeg;base64,"
+            + base64.b64encode(encode(placeholder, "JPEG", 40)).decode()
+        )
+    return manifest
+
+
+def try_make_derivatives(*args) -> bool:
+    """Call make_derivatives(), and return whether it worked
+
+    If it fails, log why, so that one bad blob doesn't stop the rest.
+    """
+    try:
+        make_derivatives(*args)
+    except Exception as exc:
+        logger.warning(f"Could not make image derivatives for {args[1]}: {exc}")
+        return False
+    return True
+
+
+def generate(
+    sources: typing.Mapping[str, str],
+    outdir: str,
+    assets_prefix: str,
+    settings: DerivativeSettings,
+    index_path: str,
+    jobs: int = 0,
+) -> int:
+    """Make derivatives for every blob that doesn't have them yet
+
+    Arguments:
+        sources:        Maps the sha256 of each blob to its path
+        outdir:         Where to save derivatives
+        assets_prefix:  The path to outdir relative to the Hugo assets directory
+        settings:       How to make derivatives
+        index_path:     The index of hashes that already have derivatives.
+                        Blobs it lists are skipped without looking at outdir;
+                        blobs it doesn't are checked with up_to_date() and added to it.
+                        If it is missing, or was made with other settings,
+                        it is rebuilt.
+        jobs:           The number of processes to use.
+                        If 1, do everything in this process.
+                        If 0, use one process per CPU.
+
+    A blob that can't be processed is logged and skipped,
+    and tried again next time.
+    Returns the number of blobs processed.
+    """
+    if Image is None:
+        logger.debug("Pillow is not installed, not making image derivatives")
+        return 0
+    done = read_index(index_path, settings)
+    indexed = len(done)
+    todo = []
+    for sha256, source in sorted(sources.items()):
+        if sha256 in done:
+            continue
+        if up_to_date(outdir, sha256, settings):
+            done.add(sha256)
+        else:
+            todo.append((sha256, source))
+    if not todo:
+        if len(done) != indexed:
+            write_index(index_path, settings, done)
+        return 0
+    logger.info(f"Making image derivatives for {len(todo)} media files")
+    args = [
+        (sha256, source, outdir, assets_prefix, settings) for sha256, source in todo
+    ]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        results = [try_make_derivatives(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(try_make_derivatives, *zip(*args), chunksize=4))
+    processed = 0
+    for (sha256, _), ok in zip(todo, results):
+        if ok:
+            done.add(sha256)
+            processed += 1
+    write_index(index_path, settings, done)
+    return processed
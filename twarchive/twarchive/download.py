@@ -0,0 +1,157 @@
+"""Downloading media over HTTP
+
+All downloads share one requests.Session,
+so connections to the same host are reused instead of set up again for every file,
+and run on a bounded thread pool,
+so that all the attachments of a tweet (and its profile picture) are fetched at the same time.
+A Downloader can also be given an HTTPCache,
+so that unchanged media is never downloaded twice.
+
+Large files like videos are downloaded with get_file(),
+which streams them to disk in chunks instead of holding them in memory.
+"""
+
+import concurrent.futures
+import functools
+import os
+import tempfile
+import threading
+import typing
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from twarchive import util
+from twarchive.httpcache import HTTPCache
+
+
+class Downloader:
+    """Fetch URLs concurrently over pooled connections
+
+    Arguments:
+        max_workers:    The most downloads to run at once, across all hosts
+        max_per_host:   The most downloads to run at once from any one host
+        cache:          If passed, serve and revalidate responses from this cache
+        spool:          The directory that get_file() downloads to;
+                        if not passed, the system temporary directory
+        timeout:        Give up on a connection that sends nothing for this many seconds
+
+    Error responses raise requests.HTTPError,
+    so that an error page is never mistaken for media.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_per_host: int = 4,
+        cache: typing.Optional[HTTPCache] = None,
+        spool: typing.Optional[str] = None,
+        timeout: float = 30,
+    ):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.spool = spool
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="twarchive-download"
+        )
+        self._host_slots: typing.Dict[str, threading.Semaphore] = {}
+        self._host_slots_lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.Semaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.Semaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def get(self, url: str) -> bytes:
+        """Download a URL in the calling thread and return its contents"""
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached and cached.fresh:
+            body = self.cache.read(cached)
+            if body is not None:
+                return body
+            # Evicted by another download since we looked it up
+            cached = None
+        headers = cached.validators() if cached else {}
+        with self._host_slot(url):
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if cached and response.status_code == 304:
+            self.cache.revalidated(cached, response.headers)
+            body = self.cache.read(cached)
+            if body is not None:
+                return body
+            # Evicted while we revalidated it, so download it again
+            return self.get(url)
+        response.raise_for_status()
+        if self.cache:
+            self.cache.store(url, response.content, response.headers)
+        return response.content
+
+    def get_file(self, url: str) -> str:
+        """Download a URL in the calling thread to a new temporary file, and return its path
+
+        The response is streamed to disk a chunk at a time,
+        so memory use doesn't depend on the size of the file.
+        The caller owns the file, and should move it somewhere or remove it.
+        """
+        if self.spool:
+            os.makedirs(self.spool, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.spool, prefix="download-")
+        os.close(fd)
+        try:
+            cached = self.cache.lookup(url) if self.cache else None
+            if cached and cached.fresh:
+                os.remove(path)
+                if self.cache.read_file(cached, path):
+                    return path
+                # Evicted by another download since we looked it up
+                cached = None
+            headers = cached.validators() if cached else {}
+            with self._host_slot(url):
+                with self.session.get(
+                    url, headers=headers, stream=True, timeout=self.timeout
+                ) as response:
+                    if cached and response.status_code == 304:
+                        self.cache.revalidated(cached, response.headers)
+                        os.remove(path)
+                        if self.cache.read_file(cached, path):
+                            return path
+                        # Evicted while we revalidated it, so download it again
+                        return self.get_file(url)
+                    response.raise_for_status()
+                    with open(path, "wb") as dfp:
+                        for chunk in response.iter_content(util.CHUNK_SIZE):
+                            dfp.write(chunk)
+            if self.cache:
+                self.cache.store_file(url, path, response.headers)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return path
+
+    def submit(self, url: str) -> "concurrent.futures.Future[bytes]":
+        """Start downloading a URL in the background"""
+        return self.executor.submit(self.get, url)
+
+    def submit_file(self, url: str) -> "concurrent.futures.Future[str]":
+        """Start downloading a URL to a temporary file in the background"""
+        return self.executor.submit(self.get_file, url)
+
+    def get_many(self, urls: typing.Iterable[str]) -> typing.List[bytes]:
+        """Download several URLs at once, and return their contents in the same order"""
+        futures = [self.submit(url) for url in urls]
+        return [future.result() for future in futures]
+
+
+@functools.cache
+def default_downloader() -> Downloader:
+    """The Downloader shared by everything in this process"""
+    return Downloader()
@@ -0,0 +1,235 @@
+"""A persistent, size-bounded cache of downloaded media
+
+Twitter media and profile picture URLs almost never change their contents,
+but the same URL is fetched over and over:
+the same profile picture for every tweet by a user,
+and every attachment again when re-downloading tweets with --force.
+This cache keeps response bodies on disk, keyed by URL.
+
+- Responses are fresh for as long as their Cache-Control max-age or Expires header says,
+  and are returned without touching the network at all.
+- Stale responses are revalidated with If-None-Match / If-Modified-Since,
+  so an unchanged file costs a 304 with no body.
+- When the cache grows past its maximum size,
+  the least recently used entries are evicted.
+"""
+
+import email.utils
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import typing
+
+from twarchive import util
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expires REAL NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class CachedResponse(typing.NamedTuple):
+    url: str
+    filename: str
+    etag: typing.Optional[str]
+    last_modified: typing.Optional[str]
+    expires: float
+    size: int
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires > time.time()
+
+    def validators(self) -> typing.Dict[str, str]:
+        """Headers to send to revalidate this response"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def expiry_from_headers(headers: typing.Mapping[str, str]) -> float:
+    """Return the time until which a response is fresh, based on its headers
+
+    Responses that don't say are stale immediately, and will always be revalidated.
+    """
+    now = time.time()
+    cache_control = headers.get("Cache-Control", "")
+    if re.search(r"\b(no-cache|no-store)\b", cache_control):
+        return now
+    m = re.search(r"\bmax-age=(\d+)", cache_control)
+    if m:
+        return now + int(m.group(1))
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return email.utils.parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return now
+
+
+class HTTPCache:
+    """A directory of cached response bodies, with their metadata in SQLite
+
+    Safe to use from several threads at once.
+
+    Arguments:
+        path:       The cache directory
+        max_size:   Evict least recently used responses when the cache grows larger than this many bytes
+    """
+
+    def __init__(self, path: str, max_size: int = 1024**3):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn: typing.Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._conn = sqlite3.connect(
+                os.path.join(self.path, "responses.sqlite3"),
+                timeout=60,
+                check_same_thread=False,
+            )
+            self._conn.executescript(CACHE_SCHEMA)
+        return self._conn
+
+    def lookup(self, url: str) -> typing.Optional[CachedResponse]:
+        """Return the cached response for a URL, if there is one"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT url, filename, etag, last_modified, expires, size FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if not row:
+            return None
+        response = CachedResponse(*row)
+        if not os.path.exists(os.path.join(self.path, response.filename)):
+            return None
+        return response
+
+    def read(self, response: CachedResponse) -> typing.Optional[bytes]:
+        """Return the body of a cached response, and mark it as recently used
+
+        Another thread may evict the response after lookup() returns it;
+        if it has, return None, and the caller should treat it as a cache miss.
+        """
+        try:
+            with open(os.path.join(self.path, response.filename), "rb") as cfp:
+                body = cfp.read()
+        except FileNotFoundError:
+            return None
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE url = ?",
+                (time.time(), response.url),
+            )
+        return body
+
+    def read_file(self, response: CachedResponse, path: str) -> bool:
+        """Link or copy the body of a cached response to path, and mark it as recently used
+
+        Cache files are replaced rather than modified, so a hard link is safe.
+        Like read(), return False if the response has been evicted since lookup().
+        """
+        try:
+            util.link_or_copy(os.path.join(self.path, response.filename), path)
+        except FileNotFoundError:
+            return False
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE url = ?",
+                (time.time(), response.url),
+            )
+        return True
+
+    def revalidated(self, response: CachedResponse, headers: typing.Mapping[str, str]):
+        """Record that the server says a cached response has not changed"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE responses SET expires = ? WHERE url = ?",
+                (expiry_from_headers(headers), response.url),
+            )
+
+    def store(self, url: str, body: bytes, headers: typing.Mapping[str, str]):
+        """Save a response to the cache"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as cfp:
+            cfp.write(body)
+        self._add(url, tmppath, len(body), headers)
+
+    def store_file(self, url: str, path: str, headers: typing.Mapping[str, str]):
+        """Save a response whose body is in a file to the cache, without reading it"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        os.close(fd)
+        os.remove(tmppath)
+        util.link_or_copy(path, tmppath)
+        self._add(url, tmppath, os.stat(tmppath).st_size, headers)
+
+    def _add(
+        self, url: str, tmppath: str, size: int, headers: typing.Mapping[str, str]
+    ):
+        """Move a response body into place and record it"""
+        filename = hashlib.sha256(url.encode()).hexdigest()
+        os.replace(tmppath, os.path.join(self.path, filename))
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                (url, filename, etag, last_modified, expires, size, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    url,
+                    filename,
+                    headers.get("ETag"),
+                    headers.get("Last-Modified"),
+                    expiry_from_headers(headers),
+                    size,
+                    now,
+                ),
+            )
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used responses until the cache fits in max_size"""
+        with self._lock, self.conn:
+            (total,) = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if total <= self.max_size:
+                return
+            evicted = []
+            for url, filename, size in self.conn.execute(
+                "SELECT url, filename, size FROM responses ORDER BY last_used"
+            ).fetchall():
+                if total <= self.max_size:
+                    break
+                evicted.append((url,))
+                total -= size
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except FileNotFoundError:
+                    pass
+            self.conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
@@ -1,15 +1,27 @@
 """Functions that relate to a Hugo blog"""
 
+import base64
+import copy
 import datetime
+import functools
+import hashlib
 import json
 import os
 import pathlib
-import re
+import shutil
 import string
-import subprocess
 import textwrap
 import typing
 
+from twarchive import derivatives, logger, profiling
+from twarchive.blobstore import BlobStore
+from twarchive.crawljournal import CrawlJournal
+from twarchive.download import Downloader
+from twarchive.httpcache import HTTPCache
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
+from twarchive.shortcodes import ShortcodeScanner
+from twarchive.tweetindex import TweetIndex, tweet_metadata
+
 
 class HugoSite:
     def __init__(self, base: str):
@@ -18,54 +30,313 @@ class HugoSite:
         self.content_twarchive = os.path.join(self.content, "twarchive")
         self.data = os.path.join(self.base, "data")
         self.data_twarchive = os.path.join(self.data, "twarchive")
+        self.data_twarchive_pfps = os.path.join(self.data, "twarchive_pfps")
+        self.data_twarchive_threads = os.path.join(self.data, "twarchive_threads.json")
         self.twitter_archives = os.path.join(self.base, "twitter-archives")
+        # Media blobs must be under assets/ so that Hugo templates can resources.Get them
+        self.assets_twarchive_blobs = os.path.join(
+            self.base, "assets", "twarchive", "blobs"
+        )
+        # Resized photos are under assets/ too; see derivatives.py
+        self.assets_twarchive_derivatives = os.path.join(
+            self.base, "assets", "twarchive", "derivatives"
+        )
+        # State kept by the twarchive command itself, not used by Hugo
+        self.twarchive_state = os.path.join(self.base, ".twarchive")
+        self.settings_file = os.path.join(self.twarchive_state, "settings.json")
+        self.archive_import_manifest = os.path.join(
+            self.twarchive_state, "archive-imports.json"
+        )
+        self.user_sync_state = os.path.join(self.twarchive_state, "user-sync.json")
+        # Caches can be deleted at any time, and should not be committed to git
+        self.twarchive_cache = os.path.join(self.twarchive_state, "cache")
+        self.tweet_index_path = os.path.join(self.twarchive_cache, "index.sqlite3")
+        self.http_cache = os.path.join(self.twarchive_cache, "http")
+        self.derivatives_index = os.path.join(self.twarchive_cache, "derivatives.json")
+        # Large downloads are written here and then moved into a blob store
+        self.download_spool = os.path.join(self.twarchive_cache, "spool")
+        self.shortcode_cache = os.path.join(self.twarchive_cache, "shortcodes.json")
+        self.crawl_journal_path = os.path.join(
+            self.twarchive_cache, "crawl-journal.sqlite3"
+        )
+        self.api_telemetry_path = os.path.join(
+            self.twarchive_cache, "api-telemetry.json"
+        )
+        # Reports from 'twarchive --profile'
+        self.profiles = os.path.join(self.twarchive_cache, "profiles")
+        # The hashes of profile pictures already in each user's table, by lowercased username;
+        # see save_user_pfp
+        self.known_pfps: typing.Dict[str, typing.Set[str]] = {}
 
+    def __getstate__(self):
+        """Don't pickle the downloader, which has threads and open connections
 
-def find_inline_tweets(site: HugoSite) -> typing.List[str]:
-    """Find tweets inlined with 'twarchiveTweet' or 'twarchiveThread' shortcodes in site content"""
+        HugoSite objects are passed to worker processes by twitterarchive.archive2data.
+        """
+        state = self.__dict__.copy()
+        state.pop("downloader", None)
+        return state
 
-    result = []
+    @functools.cached_property
+    def settings(self) -> typing.Dict:
+        """Per-site settings for the twarchive command
 
-    rgcmd = [
-        "rg",
-        "--no-filename",
-        "--no-line-number",
-        r"\{\{. twarchiveTweet .[0-9]+(-intentionallyinvalid)?",
-        site.content,
-    ]
-    rg = subprocess.run(rgcmd, capture_output=True)
-    outlines = rg.stdout.decode().strip().split("\n")
-    for line in outlines:
-        if not line:
-            continue
-        m = re.search(
-            "{{. twarchiveTweet .(?P<tweetid>[0-9]+(:?-intentionallyinvalid)?)", line
+        Settings are saved to .twarchive/settings.json,
+        which should be committed to git along with the site.
+        """
+        try:
+            with open(self.settings_file) as sfp:
+                return json.load(sfp)
+        except FileNotFoundError:
+            return {}
+
+    def save_settings(self):
+        os.makedirs(self.twarchive_state, exist_ok=True)
+        with open(self.settings_file, "w") as sfp:
+            json.dump(self.settings, sfp, indent=2, sort_keys=True)
+
+    def reload_settings(self):
+        """Re-read settings, and forget everything cached that depends on them
+
+        The tweet index is tied to the layout, since it lists the files under tweet_data_dir;
+        call this after saving a change to the layout.
+        """
+        for cached in ["settings", "tweet_index"]:
+            try:
+                delattr(self, cached)
+            except AttributeError:
+                pass
+
+    @functools.cached_property
+    def tweet_index(self) -> TweetIndex:
+        """The index of tweets in the data directory"""
+        return TweetIndex(
+            self.tweet_index_path, self.tweet_data_dir, bundles=self.bundles
         )
-        result += [m["tweetid"]]
-
-    rgcmd = [
-        "rg",
-        "--no-filename",
-        "--no-line-number",
-        r"\{\{. twarchiveThread .[0-9]+(-intentionallyinvalid)?",
-        site.content,
-    ]
-    rg = subprocess.run(rgcmd, capture_output=True)
-    outlines = rg.stdout.decode().strip().split("\n")
-    for line in outlines:
-        if not line:
-            continue
-        m = re.search(
-            "{{. twarchiveThread .(?P<tweetid>[0-9]+(:?-intentionallyinvalid)?)", line
+
+    @functools.cached_property
+    def crawl_journal(self) -> CrawlJournal:
+        """The journal of crawls in progress, so that interrupted crawls can be resumed"""
+        return CrawlJournal(self.crawl_journal_path)
+
+    @functools.cached_property
+    def downloader(self) -> Downloader:
+        """A Downloader that caches media under .twarchive/cache/http
+
+        The cache size defaults to 1GiB,
+        and can be set with http_cache_max_bytes in .twarchive/settings.json.
+        """
+        max_size = self.settings.get("http_cache_max_bytes", 1024**3)
+        return Downloader(
+            cache=HTTPCache(self.http_cache, max_size=max_size),
+            spool=self.download_spool,
+        )
+
+    @property
+    def blobstore(self) -> typing.Optional[BlobStore]:
+        """The blob store for media, if the site keeps media out of its tweet JSON"""
+        if self.settings.get("media_storage") == "blobs":
+            return BlobStore(self.assets_twarchive_blobs)
+        return None
+
+    @property
+    def bundles(self) -> bool:
+        """Whether tweets are saved as page bundles
+
+        By default, tweets are saved to data/twarchive/<id>.json,
+        and Hugo loads every one of them into .Site.Data.twarchive on every build.
+        With layout set to "bundles" in .twarchive/settings.json,
+        each tweet is saved to content/twarchive/<id>/tweet.json alongside its page,
+        with its media in content/twarchive/<id>/media/,
+        and Hugo only reads the tweets that the pages it renders use.
+        """
+        return self.settings.get("layout") == "bundles"
+
+    @property
+    def tweet_data_dir(self) -> str:
+        """The directory that tweet data files are saved under"""
+        return self.content_twarchive if self.bundles else self.data_twarchive
+
+    def tweet_data_path(self, tweetid: str) -> str:
+        """The path to the JSON data file for a tweet"""
+        if self.bundles:
+            return os.path.join(self.content_twarchive, tweetid, "tweet.json")
+        return os.path.join(self.data_twarchive, f"{tweetid}.json")
+
+    def tweet_page_path(self, tweetid: str) -> str:
+        """The path to the content page for a tweet"""
+        if self.bundles:
+            return os.path.join(self.content_twarchive, tweetid, "index.md")
+        return os.path.join(self.content_twarchive, f"{tweetid}.md")
+
+    def media_store(self, tweetid: str) -> typing.Optional[BlobStore]:
+        """The blob store for a tweet's media, or None if media is embedded in its JSON
+
+        Page bundles always keep media in the bundle, regardless of media_storage.
+        """
+        if self.bundles:
+            return BlobStore(os.path.join(self.content_twarchive, tweetid, "media"))
+        return self.blobstore
+
+    def video_store(self, tweetid: str) -> BlobStore:
+        """The blob store for a tweet's videos and GIFs
+
+        Videos are too big to embed in tweet JSON,
+        so they are saved to a blob store even when media_storage is not "blobs".
+        """
+        return self.media_store(tweetid) or BlobStore(self.assets_twarchive_blobs)
+
+
+@profiling.timed("media")
+def save_user_pfp(site: HugoSite, username: str, pfp: bytes) -> str:
+    """Save a profile picture to the user's profile picture table, and return its hash
+
+    Each user has a table at data/twarchive_pfps/<username>.json,
+    mapping the sha256 of each of their profile pictures to its base64 data.
+    Usernames are lowercased, because Twitter usernames are case insensitive.
+    The table is only written if the picture is not already in it.
+    The hashes in each table are remembered in site.known_pfps,
+    so a table is only read again when a picture we haven't seen turns up,
+    in case another process has added it since.
+    """
+    sha256 = hashlib.sha256(pfp).hexdigest()
+    known = site.known_pfps.setdefault(username.lower(), set())
+    if sha256 in known:
+        return sha256
+    table_path = os.path.join(site.data_twarchive_pfps, f"{username.lower()}.json")
+    try:
+        with open(table_path) as tfp:
+            table = json.load(tfp)
+    except FileNotFoundError:
+        table = {}
+    known.update(table)
+    if sha256 in table:
+        return sha256
+    table[sha256] = base64.b64encode(pfp).decode()
+    os.makedirs(site.data_twarchive_pfps, exist_ok=True)
+    tmp_path = f"{table_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as tfp:
+        json.dump(table, tfp, indent=2, sort_keys=True)
+    os.replace(tmp_path, table_path)
+    known.add(sha256)
+    return sha256
+
+
+@profiling.timed("write", items=1)
+def save_tweet(site: HugoSite, infltweet: InflatedTweet):
+    """Save an inflated tweet to site data
+
+    Media is embedded in the JSON or saved to a blob store,
+    depending on the site's media_storage and layout settings.
+    Videos and GIFs are always saved to a blob store; see HugoSite.video_store.
+    If the site's json_format setting is "compact", the JSON is written without whitespace;
+    otherwise it is indented and sorted so that it diffs nicely in git.
+
+    The profile picture is moved out of the tweet and into the user's profile picture table,
+    and the saved tweet refers to it by hash.
+    This is done to a copy; the caller's tweet keeps its user_pfp.
+    """
+    if infltweet.user_pfp:
+        pfp = infltweet.user_pfp
+        infltweet = copy.copy(infltweet)
+        infltweet.user_pfp_sha256 = save_user_pfp(site, infltweet.username, pfp)
+        infltweet.user_pfp = b""
+    tweet_data_path = site.tweet_data_path(infltweet.id)
+    os.makedirs(os.path.dirname(tweet_data_path), exist_ok=True)
+    infltweet.jdump(
+        filepath=tweet_data_path,
+        blobstore=site.media_store(infltweet.id),
+        video_blobstore=site.video_store(infltweet.id),
+        compact=site.settings.get("json_format") == "compact",
+    )
+    site.tweet_index.update(
+        os.path.relpath(tweet_data_path, site.tweet_data_dir),
+        tweet_metadata(infltweet),
+    )
+
+
+def media2blobs(site: HugoSite):
+    """Move media embedded in every data/twarchive/*.json file into the blob store
+
+    Converts the data directory in place,
+    and sets the site to save media for new tweets to the blob store too.
+    """
+    site.settings["media_storage"] = "blobs"
+    site.save_settings()
+    site.tweet_index.sync()
+    tweetids = sorted(site.tweet_index.ids())
+    for idx, tweetid in enumerate(tweetids):
+        if idx % 100 == 0:
+            logger.info(f"Moving media for tweet {idx} of {len(tweetids)}")
+        infltweet = InflatedTweet.jload(filepath=site.tweet_data_path(tweetid))
+        save_tweet(site, infltweet)
+
+
+def set_layout(site: HugoSite, layout: str):
+    """Move every tweet to a layout, and save new tweets in that layout too
+
+    layout is "data" or "bundles"; see HugoSite.bundles.
+    Media moves along with its tweet.
+    Pages are regenerated in the new layout.
+    """
+    if layout not in ["data", "bundles"]:
+        raise ValueError(f"Unknown layout {layout}")
+    site.tweet_index.sync()
+    tweetids = sorted(site.tweet_index.ids())
+    old_files = {
+        tweetid: (
+            site.tweet_data_path(tweetid),
+            site.tweet_page_path(tweetid),
+            site.video_store(tweetid),
         )
-        result += [m["tweetid"]]
+        for tweetid in tweetids
+    }
+    bundles_before = site.bundles
+
+    site.settings["layout"] = layout
+    site.save_settings()
+    site.reload_settings()
+    if site.bundles == bundles_before:
+        return
+
+    for idx, tweetid in enumerate(tweetids):
+        if idx % 100 == 0:
+            logger.info(f"Moving tweet {idx} of {len(tweetids)} to {layout} layout")
+        data_path, page_path, video_store = old_files[tweetid]
+        infltweet = InflatedTweet.jload(filepath=data_path)
+        for attachment in infltweet.media:
+            attachment.locate(video_store)
+        save_tweet(site, infltweet)
+        os.remove(data_path)
+        if os.path.exists(page_path):
+            os.remove(page_path)
+        if bundles_before:
+            shutil.rmtree(os.path.dirname(data_path))
+    site.tweet_index.rebuild()
+    data2md(site)
+
+
+def find_inline_tweets(site: HugoSite) -> typing.Set[str]:
+    """Find tweets inlined with 'twarchiveTweet' or 'twarchiveThread' shortcodes in site content
+
+    Pages under content/twarchive/ are skipped;
+    data2md generates them from tweets that have already been downloaded.
+    """
+    scanner = ShortcodeScanner(
+        site.content, site.shortcode_cache, exclude=[site.content_twarchive]
+    )
+    return scanner.scan()
 
-    return set(result)
 
+def get_downloaded_tweets(site: HugoSite) -> typing.Set[str]:
+    """Return the IDs of tweets that have already been downloaded
 
-def get_downloaded_tweets(site: HugoSite) -> typing.List[str]:
-    """Return a list of tweet IDs that have already been downloaded"""
-    return [t.strip(".json") for t in os.listdir(site.data_twarchive)]
+    This queries the tweet index rather than listing the data directory.
+    Tweets are added to the index when they are saved;
+    files copied into the data directory by hand are picked up by the next data2md,
+    or by 'twarchive internals reindex'.
+    """
+    return site.tweet_index.ids()
 
 
 def showinlines(site: HugoSite):
@@ -75,35 +346,143 @@ def showinlines(site: HugoSite):
         print(f"- {line}")
 
 
-def data2md(site: HugoSite):
-    """For tweets that have been downloaded to the data directory, make a page for them in the content"""
+def write_if_changed(path: str, contents: str) -> bool:
+    """Write contents to a file only if it doesn't already contain them
 
-    tweets = {}
-    tweetgraph = {}
+    This leaves the mtime of unchanged files alone, so that Hugo doesn't rebuild them.
+    Return True if the file was written.
+    """
+    try:
+        with open(path) as fp:
+            if fp.read() == contents:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w") as fp:
+        fp.write(contents)
+    return True
 
-    # Load all tweets into RAM so that we only have to read from the filesystem once.
-    # For reference, my archive of 2700 tweets is 323MB on disk and takes about 2-3 seconds to load.
-    tweet_file_list = os.listdir(site.data_twarchive)
-    for idx, tweet_json in enumerate(tweet_file_list):
-        if idx % 100 == 0:
-            print(f"Loading tweet {idx} of {len(tweet_file_list)}")
-        tweet_json_path = os.path.join(site.data_twarchive, tweet_json)
-        with open(tweet_json_path) as tjfp:
-            tweet = json.load(tjfp)
-        tweetid = tweet_json.strip(".json")
-        tweets[tweetid] = tweet
 
-        if tweet.get("replyto_tweetid"):
-            tweetgraph[tweetid] = tweet["replyto_tweetid"]
+def build_thread_index(
+    tweets: typing.Mapping[str, typing.Mapping],
+) -> typing.Dict[str, typing.Dict]:
+    """Find every thread in a set of tweets
+
+    tweets maps tweet IDs to their thread_parent_id (and any other metadata),
+    like rows from the tweet index.
+
+    Returns a dict with two keys:
+        threads:    Maps the last tweet of each thread to the IDs of all its tweets, first to last.
+                    Like the theme's f_twarchiveThread.html partial,
+                    a thread starts at its first tweet with no parent,
+                    or at the first parent that hasn't been downloaded.
+        tweets:     Maps each tweet in a thread to the last tweet of its thread.
+                    If replies branch, so that a tweet is part of more than one thread,
+                    it maps to the thread that ends with the latest tweet.
+    """
+    parents = {
+        tweetid: tweet["thread_parent_id"]
+        for tweetid, tweet in tweets.items()
+        if tweet["thread_parent_id"]
+    }
+    has_children = set(parents.values())
+    threads = {}
+    for lastid in parents:
+        if lastid in has_children:
+            continue
+        thread = [lastid]
+        seen = {lastid}
+        while thread[-1] in parents and parents[thread[-1]] not in seen:
+            thread.append(parents[thread[-1]])
+            seen.add(thread[-1])
+        threads[lastid] = thread[::-1]
+
+    membership = {}
+    # Tweet IDs increase over time; sort them numerically so that later threads win
+    for lastid in sorted(threads, key=lambda t: (len(t), t)):
+        for tweetid in threads[lastid]:
+            membership[tweetid] = lastid
+
+    return {"threads": threads, "tweets": membership}
+
 
-    parents = list(set(tweetgraph.values()))
-    thread_finals = [t for t in tweetgraph.keys() if t not in parents]
+def media_blobs(site: HugoSite) -> typing.Dict[str, str]:
+    """Return the sha256 and path of every media blob in the site
+
+    This includes the blob store and, for page bundles, the media in every bundle.
+    """
+    stores = [site.assets_twarchive_blobs]
+    if site.bundles:
+        stores += [
+            os.path.join(site.content_twarchive, tweetid, "media")
+            for tweetid in site.tweet_index.ids()
+        ]
+    blobs = {}
+    for store in stores:
+        try:
+            shards = list(os.scandir(store))
+        except FileNotFoundError:
+            continue
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for blob in os.scandir(shard.path):
+                if not blob.name.startswith("."):
+                    blobs[blob.name] = blob.path
+    return blobs
 
-    # Find the end of every reply chain.
-    for childid in tweetgraph:
-        if childid not in parents:
-            thread_finals += [childid]
 
+def image_derivatives(site: HugoSite, jobs: int = 0) -> int:
+    """Make resized copies of every photo in the site that doesn't have them yet
+
+    Derivatives are saved under assets/twarchive/derivatives,
+    and the theme uses them instead of inlining full size photos.
+    This needs Pillow, and only works for media in the blob store or page bundles,
+    not media embedded in tweet JSON;
+    run 'twarchive media2blobs' to move embedded photos to the blob store.
+    Photos that already have derivatives are remembered in .twarchive/cache/derivatives.json,
+    so only new blobs are looked at.
+    Set image_derivatives in .twarchive/settings.json to false to turn it off,
+    or to a dict to change the widths, turn on WebP, or change the quality;
+    see derivatives.DerivativeSettings.
+
+    Returns the number of media files processed.
+    """
+    settings = derivatives.DerivativeSettings.from_setting(
+        site.settings.get("image_derivatives")
+    )
+    if not settings:
+        return 0
+    if not site.bundles and not site.blobstore and derivatives.Image is not None:
+        # Embedded media is the default, so only warn if derivatives were asked for
+        log = logger.warning if "image_derivatives" in site.settings else logger.info
+        log(
+            "Photos embedded in tweet JSON don't get image derivatives and are inlined at full size; "
+            "run 'twarchive media2blobs' to move them to the blob store"
+        )
+    with profiling.phase("derivatives") as measure:
+        measure.items = derivatives.generate(
+            media_blobs(site),
+            site.assets_twarchive_derivatives,
+            "twarchive/derivatives",
+            settings,
+            site.derivatives_index,
+            jobs=jobs,
+        )
+    return measure.items
+
+
+@profiling.timed("write")
+def write_tweet_pages(
+    site: HugoSite,
+    tweets: typing.Mapping[str, typing.Mapping],
+    thread_finals: typing.Collection[str],
+) -> int:
+    """Write the content page for each tweet, and return how many changed
+
+    thread_finals are the IDs of the last tweets in threads,
+    whose pages show the whole thread.
+    """
     # For the ends of reply chains, we'll add content with the whole thread.
     thread_addemdum_template = string.Template(
         "\n".join(
@@ -118,22 +497,59 @@ def data2md(site: HugoSite):
     )
 
     os.makedirs(site.content_twarchive, exist_ok=True)
+    written = 0
     for tweetid, tweet in tweets.items():
-        tweet_md_path = os.path.join(site.content_twarchive, f"{tweetid}.md")
+        tweet_md_path = site.tweet_page_path(tweetid)
         tweet_date = datetime.datetime.strptime(tweet["date"], "%Y-%m-%dT%H:%M:%S%z")
         mdcontents = textwrap.dedent(
             f"""\
             ---
             tweetid: "{tweetid}"
             date: {tweet_date}
-            ---
             """
         )
+        if site.bundles:
+            # The theme reads tweet.json and media from the bundle,
+            # but they don't need to be copied to public/
+            mdcontents += "_build:\n  publishResources: false\n"
+        mdcontents += "---\n"
 
         if tweetid in thread_finals:
             mdcontents += (
                 "\n\n" + thread_addemdum_template.substitute(tweetid=tweetid) + "\n"
             )
 
-        with open(tweet_md_path, "w") as tmdfp:
-            tmdfp.write(mdcontents)
+        if write_if_changed(tweet_md_path, mdcontents):
+            written += 1
+    return written
+
+
+def data2md(site: HugoSite, jobs: int = 0):
+    """For tweets that have been downloaded to the data directory, make a page for them in the content
+
+    Tweet metadata comes from the tweet index,
+    so this does not have to decode media or even re-read tweets that haven't changed.
+    Pages whose contents would not change are not rewritten.
+
+    Image derivatives are made for any new photos, with jobs processes;
+    see image_derivatives().
+    """
+
+    tweets = {}
+    site.tweet_index.sync()
+    for row in site.tweet_index.rows():
+        tweets[row["id"]] = row
+
+    threads = build_thread_index(tweets)
+    os.makedirs(site.data, exist_ok=True)
+    if write_if_changed(
+        site.data_twarchive_threads, json.dumps(threads, indent=2, sort_keys=True)
+    ):
+        logger.info(f"Wrote thread index with {len(threads['threads'])} threads")
+    thread_finals = threads["threads"].keys()
+
+    written = write_tweet_pages(site, tweets, thread_finals)
+
+    logger.info(f"Wrote {written} changed pages out of {len(tweets)} tweets")
+
+    image_derivatives(site, jobs=jobs)
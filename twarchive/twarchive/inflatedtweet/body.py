@@ -6,60 +6,106 @@ from twarchive import util
 from twarchive.inflatedtweet.inflatedtweet import Replacement
 
 
-def tweet_html_body(
-    tweet_text: str,
-    entities: typing.Dict,
-    render_qt_link=False,
-) -> str:
-    """Create an HTML tweet body for archiving
+class TweetBodies(typing.NamedTuple):
+    """Both HTML bodies of a tweet
+
+    strip_qts:  Links to other tweets are stripped out,
+                so they can be included in full fidelity by other means.
+    link_qts:   Links to other tweets are rendered as regular <a> links.
+    """
+
+    strip_qts: str
+    link_qts: str
+
+
+def tweet_html_bodies(tweet_text: str, entities: typing.Dict) -> TweetBodies:
+    """Create both HTML tweet bodies for archiving
 
     - Text hashtags become links to search Twitter for the hashtag
     - Text URLs become links to the original URL (not the shortened one)
     - Text @mentions become links to the user's profile on Twitter
     - Text links to media get stripped out complete (they will be handled elsewhere)
+    - Links to other tweets are stripped from one body and rendered as links in the other
+
+    Entities are walked once, and each body is joined once from the text between entities
+    and their replacements, so the cost is linear in the length of the tweet
+    no matter how many entities it has.
+    If entities overlap, which Twitter should never send, only the first is replaced.
 
     Arguments:
         tweet_text:     The full_text of a tweet
         entities:       A tweepy.Tweet.entities or a tweet['entities'] from a tweet in a Twitter archive
-        render_qt_link: If one of the URLs is a link to another tweet,
-                        should it be rendered as a link?
-                        If False, links to tweets will be stripped out completely,
-                        so they can be included in full fidelity by other means.
-                        If True, links to tweets will be rendered as regular <a> links.
     """
-    replacements = {}
+    # Each maps the start of an entity to its replacement.
+    # A QT link has a different replacement in each body; anything else is the same in both.
+    replacements: typing.Dict[int, Replacement] = {}
+    qt_links: typing.Dict[int, Replacement] = {}
     for hashtag in entities.get("hashtags", []):
         hash = hashtag["text"]
         start, end = hashtag["indices"]
         replace = f'<a href="https://twitter.com/hashtag/{hash}">#{hash}</a>'
-        replacements[start] = Replacement(int(start), int(end), replace)
+        replacements[int(start)] = Replacement(int(start), int(end), replace)
     for url in entities.get("urls", []):
         expanded_url = url["expanded_url"]
         display_url = url["display_url"]
         start, end = url["indices"]
-        if util.uri_is_tweet(expanded_url) and not render_qt_link:
+        replace = f'<a href="{expanded_url}">{display_url}</a>'
+        if util.uri_is_tweet(expanded_url):
+            qt_links[int(start)] = Replacement(int(start), int(end), replace)
             replace = ""
-        else:
-            replace = f'<a href="{expanded_url}">{display_url}</a>'
-        replacements[start] = Replacement(int(start), int(end), replace)
+        replacements[int(start)] = Replacement(int(start), int(end), replace)
     for mention in entities.get("user_mentions", []):
         start, end = mention["indices"]
         username = mention["screen_name"]
         replace = f'<a href="https://twitter.com/{username}">@{username}</a>'
-        replacements[start] = Replacement(int(start), int(end), replace)
+        replacements[int(start)] = Replacement(int(start), int(end), replace)
+        qt_links.pop(int(start), None)
     for media in entities.get("media", []):
         start, end = media["indices"]
-        replacements[start] = Replacement(int(start), int(end), "")
+        replacements[int(start)] = Replacement(int(start), int(end), "")
+        qt_links.pop(int(start), None)
 
-    # Iterate through replacements in reverse
-    # Means all the indexes will stay correct
-    for key in sorted(replacements.keys(), reverse=True):
-        r = replacements[key]
-        pre = tweet_text[0 : r.start]
-        post = tweet_text[r.end : len(tweet_text)]
-        tweet_text = pre + r.replace + post
+    strip_qts: typing.List[str] = []
+    link_qts: typing.List[str] = []
+    position = 0
+    for start in sorted(replacements):
+        r = replacements[start]
+        if r.start < position:
+            continue
+        between = tweet_text[position : r.start]
+        strip_qts += [between, r.replace]
+        link_qts += [
+            between,
+            qt_links[start].replace if start in qt_links else r.replace,
+        ]
+        position = r.end
+    strip_qts.append(tweet_text[position:])
+    link_qts.append(tweet_text[position:])
 
     # Clients may insert newlines, but we have to convert them to <br/> or else it won't display them properly
-    tweet_text = tweet_text.replace("\n", "<br/>")
+    return TweetBodies(
+        "".join(strip_qts).replace("\n", "<br/>"),
+        "".join(link_qts).replace("\n", "<br/>"),
+    )
+
 
-    return tweet_text
+def tweet_html_body(
+    tweet_text: str,
+    entities: typing.Dict,
+    render_qt_link=False,
+) -> str:
+    """Create one HTML tweet body for archiving
+
+    See tweet_html_bodies(); when both bodies are needed, call that instead.
+
+    Arguments:
+        tweet_text:     The full_text of a tweet
+        entities:       A tweepy.Tweet.entities or a tweet['entities'] from a tweet in a Twitter archive
+        render_qt_link: If one of the URLs is a link to another tweet,
+                        should it be rendered as a link?
+                        If False, links to tweets will be stripped out completely,
+                        so they can be included in full fidelity by other means.
+                        If True, links to tweets will be rendered as regular <a> links.
+    """
+    bodies = tweet_html_bodies(tweet_text, entities)
+    return bodies.link_qts if render_qt_link else bodies.strip_qts
@@ -3,16 +3,26 @@
 import datetime
 import typing
 
-import requests
 import tweepy
 
-from twarchive import util
+from twarchive import profiling, util
+from twarchive.download import Downloader, default_downloader
 from twarchive.inflatedtweet import inflmedia
-from twarchive.inflatedtweet.body import tweet_html_body
+from twarchive.inflatedtweet.body import tweet_html_bodies
 from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
 
 
-def inflated_tweet_from_tweepy(tweet: tweepy.models.Status):
+@profiling.timed("inflate", items=1)
+def inflated_tweet_from_tweepy(
+    tweet: tweepy.models.Status, downloader: typing.Optional[Downloader] = None
+):
+    """Given a tweepy Status, download its media and profile picture and return an inflated tweet
+
+    The profile picture and all media are downloaded concurrently.
+    """
+    downloader = downloader or default_downloader()
+    user_pfp_future = downloader.submit(tweet.user.profile_image_url)
+
     qts: typing.List[str] = []
 
     try:
@@ -28,14 +38,18 @@ def inflated_tweet_from_tweepy(tweet: tweepy.models.Status):
         extended_entities = tweet.extended_entities
     except AttributeError:
         extended_entities = {}
-    media = inflmedia.get_all_media(extended_entities, tweet.id_str, None)
+    media = inflmedia.get_all_media(
+        extended_entities, tweet.id_str, None, downloader=downloader
+    )
 
     try:
         rt_of = tweet.retweeted_status.id_str
     except AttributeError:
         rt_of = None
 
-    user_pfp = requests.get(tweet.user.profile_image_url).content
+    with profiling.phase("media") as measure:
+        user_pfp = user_pfp_future.result()
+        measure.nbytes = len(user_pfp)
 
     replyto_tweetid = None
     replyto_username = None
@@ -43,13 +57,15 @@ def inflated_tweet_from_tweepy(tweet: tweepy.models.Status):
         replyto_tweetid = tweet.in_reply_to_status_id_str
         replyto_username = tweet._json["in_reply_to_screen_name"]
 
+    bodies = tweet_html_bodies(tweet.full_text, tweet.entities)
+
     infltweet = InflatedTweet(
         tweet.id_str,
         tweet.created_at,
         tweet._json["created_at"],
         tweet.full_text,
-        tweet_html_body(tweet.full_text, tweet.entities, False),
-        tweet_html_body(tweet.full_text, tweet.entities, True),
+        bodies.strip_qts,
+        bodies.link_qts,
         media,
         tweet.entities,
         qts,
@@ -63,4 +79,4 @@ def inflated_tweet_from_tweepy(tweet: tweepy.models.Status):
         replyto_username,
     )
 
-    return infltweet
\ No newline at end of file
+    return infltweet
@@ -7,9 +7,9 @@ from tkinter import W
 import typing
 
 # WARNING: do _not_ import twarchive.twitterarchive from here, as it will result in circular imports
-from twarchive import util
+from twarchive import profiling, util
 from twarchive.inflatedtweet import inflmedia
-from twarchive.inflatedtweet.body import tweet_html_body
+from twarchive.inflatedtweet.body import tweet_html_bodies
 from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
 
 if typing.TYPE_CHECKING:
@@ -53,6 +53,7 @@ def first_mention_from_tweet_text(text: str) -> str:
     return replyto_username
 
 
+@profiling.timed("inflate", items=1)
 def inflated_tweet_from_twitter_archive(
     tweet: typing.Dict,
     user_pfp: bytes,
@@ -92,7 +93,7 @@ def inflated_tweet_from_twitter_archive(
             qtid = util.tweeturi2tweetid(item["expanded_url"])
             qts += [qtid]
 
-    extended_entities = tweet.get("extended_entitites", {})
+    extended_entities = tweet.get("extended_entities", {})
     media = inflmedia.get_all_media(extended_entities, tweet["id_str"], archive)
 
     replyto_tweetid = None
@@ -108,13 +109,15 @@ def inflated_tweet_from_twitter_archive(
                 "Can't figure out a username this tweet is replying to, lol"
             )
 
+    bodies = tweet_html_bodies(tweet["full_text"], tweet["entities"])
+
     infltweet = InflatedTweet(
         tweet["id_str"],
         created_at_dt,
         tweet["created_at"],
         tweet["full_text"],
-        tweet_html_body(tweet["full_text"], tweet["entities"], False),
-        tweet_html_body(tweet["full_text"], tweet["entities"], True),
+        bodies.strip_qts,
+        bodies.link_qts,
         media,
         tweet["entities"],
         qts,
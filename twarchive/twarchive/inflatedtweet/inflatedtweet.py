@@ -7,9 +7,18 @@ are also downloaded and included.
 import base64
 import datetime
 import json
+import os
 import re
 import typing
 
+from twarchive import jsonbackend, profiling
+from twarchive.blobstore import BlobStore
+
+
+def json_datetime(dt: datetime.datetime) -> str:
+    """Format a datetime the way InflatedTweetEncoder saves it"""
+    return dt.astimezone().isoformat(timespec="seconds")
+
 
 class Replacement(typing.NamedTuple):
     """Text replacement for a tweet body."""
@@ -30,8 +39,26 @@ class TweetMediaAttachment:
         height: int,
         alttext: str,
         url: str,
-        data: bytes,
+        data: typing.Optional[bytes] = None,
+        sha256: str = "",
+        size: int = 0,
+        path: str = "",
+        temporary: bool = False,
     ):
+        """Create a media attachment
+
+        An attachment either carries its data directly,
+        refers to a blob in a BlobStore by its sha256,
+        or refers to a file on disk by its path.
+        Large media like videos is passed by path, so that it never has to be held in memory;
+        it is read only if the data is needed, and is hashed into a blob store in chunks.
+        A temporary file, like a download, is moved into the blob store instead of copied.
+        The path is never written to JSON.
+
+        Data may be passed as bytes, or as a base64 string (as when loaded from JSON).
+        A base64 string is kept as-is and only decoded when .data is accessed,
+        and is written back out unchanged if it never was.
+        """
         if media_type not in ["photo", "video", "animated_gif"]:
             raise ValueError(f"Unknown media_type {media_type}")
         self.media_type = media_type
@@ -40,10 +67,85 @@ class TweetMediaAttachment:
         self.height = height
         self.alttext = alttext
         self.url = url
-        if isinstance(data, str):
-            self.data = base64.b64decode(data)
+        self._data: typing.Union[bytes, str, None] = data
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+        self.temporary = temporary
+        if data is None and not sha256 and not path:
+            raise ValueError(
+                f"Media attachment {url} has neither data, a blob hash, nor a path"
+            )
+
+    @property
+    def data(self) -> typing.Optional[bytes]:
+        if isinstance(self._data, str):
+            self._data = base64.b64decode(self._data)
+        elif self._data is None and self.path:
+            with open(self.path, "rb") as mfp:
+                self._data = mfp.read()
+            if self.temporary:
+                os.remove(self.path)
+                self.path = ""
+                self.temporary = False
+        return self._data
+
+    @data.setter
+    def data(self, value: typing.Optional[bytes]):
+        self._data = value
+
+    def load(self, blobstore: BlobStore) -> bytes:
+        """Return the data for this attachment, reading it from a blob store if necessary"""
+        if self._data is None and not self.path:
+            self._data = blobstore.get(self.sha256)
+        return self.data
+
+    def locate(self, blobstore: BlobStore):
+        """Refer to this attachment's blob by its path, without reading it
+
+        Saving the attachment to another blob store will then link or copy the file,
+        rather than reading it into memory.
+        """
+        if self._data is None and not self.path:
+            self.path = blobstore.blobpath(self.sha256)
+
+    def jsonable(self, blobstore: typing.Optional[BlobStore] = None) -> typing.Dict:
+        """Return a dict suitable for encoding to JSON
+
+        With a blob store, save the data to the store and refer to it by hash.
+        Without one, embed the data in the result directly.
+        """
+        result = {
+            "media_type": self.media_type,
+            "content_type": self.content_type,
+            "width": self.width,
+            "height": self.height,
+            "alttext": self.alttext,
+            "url": self.url,
+        }
+        if blobstore:
+            with profiling.phase("media") as measure:
+                if self._data is not None:
+                    self.sha256 = blobstore.put(self.data)
+                    self.size = measure.nbytes = len(self.data)
+                elif self.path:
+                    self.sha256 = blobstore.put_file(self.path, move=self.temporary)
+                    self.path = blobstore.blobpath(self.sha256)
+                    self.temporary = False
+                    self.size = measure.nbytes = os.stat(self.path).st_size
+            result["sha256"] = self.sha256
+            result["size"] = self.size
         else:
-            self.data = data
+            # Reads the file, if the attachment refers to one
+            data = self._data if self._data is not None else self.data
+            if data is None:
+                raise Exception(
+                    f"Media attachment {self.url} refers to blob {self.sha256}, but no blob store was provided"
+                )
+            # Either bytes, which the encoder will base64 encode,
+            # or a base64 string that was never decoded and can be written back out as-is
+            result["data"] = data
+        return result
 
 
 class InflatedTweet:
@@ -72,6 +174,7 @@ class InflatedTweet:
         post_uri: str = "",
         user_uri: str = "",
         user_pfp_background_color: str = "",
+        user_pfp_sha256: str = "",
     ):
         self.id = id
 
@@ -92,10 +195,8 @@ class InflatedTweet:
         self.username = username
         self.user_displayname = user_displayname
 
-        if isinstance(user_pfp, str):
-            self.user_pfp = base64.b64decode(user_pfp)
-        else:
-            self.user_pfp = user_pfp
+        # Like TweetMediaAttachment.data, a base64 string is only decoded when accessed
+        self._user_pfp: typing.Union[bytes, str, None] = user_pfp
 
         self.retrieved_date = retrieved_date
 
@@ -109,6 +210,26 @@ class InflatedTweet:
 
         self.user_pfp_background_color = user_pfp_background_color
 
+        # If set, the profile picture is stored once per user in a separate table,
+        # and user_pfp is empty.
+        self.user_pfp_sha256 = user_pfp_sha256
+
+    @property
+    def user_pfp(self) -> typing.Optional[bytes]:
+        if isinstance(self._user_pfp, str):
+            self._user_pfp = base64.b64decode(self._user_pfp)
+        return self._user_pfp
+
+    @user_pfp.setter
+    def user_pfp(self, value: typing.Optional[bytes]):
+        self._user_pfp = value
+
+    def jsonable(self) -> typing.Dict:
+        """Return a dict suitable for encoding to JSON"""
+        result = dict(self.__dict__)
+        result["user_pfp"] = result.pop("_user_pfp")
+        return result
+
     @property
     def profileimg_b64(self):
         return base64.b64encode(self.profileimg).decode()
@@ -147,19 +268,58 @@ class InflatedTweet:
         self,
         fp: typing.Optional[typing.TextIO] = None,
         filepath: typing.Optional[str] = "",
+        blobstore: typing.Optional[BlobStore] = None,
+        video_blobstore: typing.Optional[BlobStore] = None,
+        compact: bool = False,
     ):
         """Dump the inflated tweet to a JSON file
 
         We expect that users will commit the results to git,
-        and indent=2 and sort_keys=True make diffs much nicer.
+        so by default the JSON is indented and its keys sorted, which makes diffs much nicer.
+        With compact=True, it is written without whitespace instead.
+        See jsonbackend for details.
+
+        If blobstore is passed, media is saved there and the JSON refers to it by hash.
+        If only video_blobstore is passed, videos and GIFs are saved there,
+        and photos are embedded in the JSON.
+
+        Tweets with media embedded are streamed to the file with jsonbackend.dump(),
+        so that the base64 of their media is never built in memory all at once.
+        The output is the same either way.
         """
         if not fp and not filepath:
             raise Exception("Must provide exactly one of fp= or filepath= to jdump")
-        if fp:
-            json.dump(self, fp, cls=InflatedTweetEncoder, indent=2, sort_keys=True)
+        encoder = InflatedTweetEncoder(
+            blobstore=blobstore, video_blobstore=video_blobstore
+        )
+        if blobstore or not self.media:
+            with profiling.phase("encode") as measure:
+                contents = jsonbackend.dumps(
+                    self, default=encoder.default, compact=compact
+                )
+                measure.nbytes = len(contents)
+            if fp:
+                fp.write(contents)
+            else:
+                with open(filepath, "w", encoding="utf-8") as fp:
+                    fp.write(contents)
+        elif fp:
+            with profiling.phase("encode"):
+                jsonbackend.dump(self, fp, default=encoder.default, compact=compact)
         else:
-            with open(filepath, "w") as fp:
-                json.dump(self, fp, cls=InflatedTweetEncoder, indent=2, sort_keys=True)
+            # Don't leave half a file behind if encoding fails partway through
+            tmp_path = f"{filepath}.tmp-{os.getpid()}"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as fp, profiling.phase(
+                    "encode"
+                ) as measure:
+                    jsonbackend.dump(self, fp, default=encoder.default, compact=compact)
+                    measure.nbytes = fp.tell()
+                os.replace(tmp_path, filepath)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
 
     @classmethod
     def jload(
@@ -171,52 +331,72 @@ class InflatedTweet:
         if not fp and not filepath:
             raise Exception("Must provide exactly one of fp= or filepath= to jload")
         if fp:
-            infltweet = json.load(fp, cls=InflatedTweetDecoder)
+            contents = fp.read()
         else:
-            with open(filepath) as fp:
-                infltweet = json.load(fp, cls=InflatedTweetDecoder)
-        return infltweet
+            with open(filepath, "rb") as fp:
+                contents = fp.read()
+        return jsonbackend.loads(contents, object_hook=inflated_tweet_object_hook)
 
 
 class InflatedTweetEncoder(json.JSONEncoder):
+    def __init__(
+        self,
+        *args,
+        blobstore: typing.Optional[BlobStore] = None,
+        video_blobstore: typing.Optional[BlobStore] = None,
+        **kwargs,
+    ):
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+        self.blobstore = blobstore
+        self.video_blobstore = video_blobstore
+
     def default(self, obj):
         if isinstance(obj, InflatedTweet):
-            return obj.__dict__
+            return obj.jsonable()
         if isinstance(obj, Replacement):
             return obj.__dict__
         if isinstance(obj, TweetMediaAttachment):
-            return obj.__dict__
+            blobstore = self.blobstore
+            if not blobstore and obj.media_type in ["video", "animated_gif"]:
+                blobstore = self.video_blobstore
+            return obj.jsonable(blobstore)
         if isinstance(obj, bytes):
             return base64.b64encode(obj).decode()
         if isinstance(obj, datetime.datetime):
-            return obj.astimezone().isoformat(timespec="seconds")
+            return json_datetime(obj)
         return json.JSONEncoder.default(self, obj)
 
 
+def inflated_tweet_object_hook(obj: typing.Dict):
+    """Automatically detect the shape of custom objects we have"""
+    infltweet_fields = [
+        "id",
+        "date",
+        "date_original_format",
+        "full_text",
+        "media",
+        "entities",
+        "username",
+        "user_displayname",
+        "user_pfp",
+    ]
+    is_inflated_tweet = all([f in obj for f in infltweet_fields])
+    if is_inflated_tweet:
+        return InflatedTweet(**obj)
+
+    mediaatt_fields = ["width", "height", "alttext", "url"]
+    is_media_att = all([f in obj for f in mediaatt_fields]) and (
+        "data" in obj or "sha256" in obj
+    )
+    if is_media_att:
+        return TweetMediaAttachment(**obj)
+
+    return obj
+
+
 class InflatedTweetDecoder(json.JSONDecoder):
     def __init__(self, *args, **kwargs):
         json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
 
     def object_hook(self, obj):
-        """Automatically detect the shape of custom objects we have"""
-        infltweet_fields = [
-            "id",
-            "date",
-            "date_original_format",
-            "full_text",
-            "media",
-            "entities",
-            "username",
-            "user_displayname",
-            "user_pfp",
-        ]
-        is_inflated_tweet = all([f in obj for f in infltweet_fields])
-        if is_inflated_tweet:
-            return InflatedTweet(**obj)
-
-        mediaatt_fields = ["width", "height", "alttext", "url", "data"]
-        is_media_att = all([f in obj for f in mediaatt_fields])
-        if is_media_att:
-            return TweetMediaAttachment(**obj)
-
-        return obj
+        return inflated_tweet_object_hook(obj)
@@ -1,111 +1,134 @@
-"""Retrieving media from tweets
-
-TODO: would be nice to DRY these functions out
-"""
+"""Retrieving media from tweets"""
 
 import os
 import typing
+import urllib.parse
 
-import requests
-
-from twarchive import util
+from twarchive import logger, profiling, util
+from twarchive.download import Downloader, default_downloader
 from twarchive.inflatedtweet.inflatedtweet import TweetMediaAttachment
 
 if typing.TYPE_CHECKING:
     from twarchive.twitterarchive import TwitterArchive
 
 
-def get_media_photo(
-    item: typing.Dict, tweetid: str, archive: typing.Optional["TwitterArchive"]
-) -> TweetMediaAttachment:
-    # if item["type"] == "photo":
-    w = item["sizes"]["small"]["w"]
-    h = item["sizes"]["small"]["h"]
-    alttext = item.get("media_alt_text", "")
-    url = item["media_url_https"]
-    mime = item.get("content_type", util.guess_mime_type(url))
-    if archive:
-        url_filename = url.split("/")[-1]
-        media_filename = f"{tweetid}-{url_filename}"
-        media_path = os.path.join(archive.tweetmedia, media_filename)
-        with open(media_path, "b") as mfp:
-            data = mfp.read()
-    else:
-        data = requests.get(url).content
-    attachment = TweetMediaAttachment("photo", mime, w, h, alttext, url, data)
-    return attachment
+class MediaSource(typing.NamedTuple):
+    """Everything about a media item except its data"""
+
+    media_type: str
+    content_type: str
+    width: int
+    height: int
+    alttext: str
+    url: str
 
 
-def get_media_video(
-    item: typing.Dict, tweetid: str, archive: typing.Optional["TwitterArchive"]
-) -> TweetMediaAttachment:
-    # if item["type"] == "video":
+def get_media_source(item: typing.Dict, tweetid: str) -> MediaSource:
+    """Describe a media item from a tweet's extended_entities"""
     w = item["sizes"]["small"]["w"]
     h = item["sizes"]["small"]["h"]
     alttext = item.get("media_alt_text", "")
-    variants = {
-        int(v["bitrate"]): v for v in item["video_info"]["variants"] if "bitrate" in v
-    }
-    best_bitrate = max(variants.keys())
-    variant = variants[best_bitrate]
-    url = variant["url"]
-    mime = variant.get("content_type", util.guess_mime_type(url))
-    if archive:
-        url_filename = url.split("/")[-1]
-        media_filename = f"{tweetid}-{url_filename}"
-        media_path = os.path.join(archive.tweetmedia, media_filename)
-        with open(media_path, "b") as mfp:
-            data = mfp.read()
+    if item["type"] == "photo":
+        url = item["media_url_https"]
+        mime = item.get("content_type", util.guess_mime_type(url))
+    elif item["type"] in ["video", "animated_gif"]:
+        variants = {
+            int(v["bitrate"]): v
+            for v in item["video_info"]["variants"]
+            if "bitrate" in v
+        }
+        best_bitrate = max(variants.keys())
+        variant = variants[best_bitrate]
+        url = variant["url"]
+        mime = variant.get("content_type", util.guess_mime_type(url))
     else:
-        data = requests.get(url).content
-    attachment = TweetMediaAttachment("video", mime, w, h, alttext, url, data)
-    return attachment
+        raise Exception(
+            f"Unknown item type {item['type']} trying to download media for tweet {tweetid}"
+        )
+    return MediaSource(item["type"], mime, w, h, alttext, url)
 
 
-def get_media_gif(
-    item: typing.Dict, tweetid: str, archive: typing.Optional["TwitterArchive"]
-) -> TweetMediaAttachment:
-    # if item["type"] == "animated_gif":
-    w = item["sizes"]["small"]["w"]
-    h = item["sizes"]["small"]["h"]
-    alttext = item.get("media_alt_text", "")
-    variants = {
-        int(v["bitrate"]): v for v in item["video_info"]["variants"] if "bitrate" in v
-    }
-    best_bitrate = max(variants.keys())
-    variant = variants[best_bitrate]
-    url = variant["url"]
-    mime = variant.get("content_type", util.guess_mime_type(url))
-    if archive:
-        url_filename = url.split("/")[-1]
-        media_filename = f"{tweetid}-{url_filename}"
-        media_path = os.path.join(archive.tweetmedia, media_filename)
-        with open(media_path, "b") as mfp:
-            data = mfp.read()
-    else:
-        data = requests.get(url).content
-    attachment = TweetMediaAttachment("animated_gif", mime, w, h, alttext, url, data)
-    return attachment
+def get_archive_media_path(
+    source: MediaSource, tweetid: str, archive: "TwitterArchive"
+) -> str:
+    """Return the path to a media item in the tweet_media directory of a Twitter archive
+
+    Files are named after the tweet and the last part of the URL's path;
+    video URLs have queries like ?tag=12, which aren't part of the name.
+    """
+    url_filename = urllib.parse.urlsplit(source.url).path.split("/")[-1]
+    media_filename = f"{tweetid}-{url_filename}"
+    return os.path.join(archive.tweetmedia, media_filename)
+
+
+def get_archive_media_data(
+    source: MediaSource, tweetid: str, archive: "TwitterArchive"
+) -> bytes:
+    """Read the data for a media item from the tweet_media directory of a Twitter archive"""
+    with open(get_archive_media_path(source, tweetid, archive), "rb") as mfp:
+        return mfp.read()
+
+
+def is_large(source: MediaSource) -> bool:
+    """Whether a media item may be too big to hold in memory
+
+    Large media is passed around by path instead of as bytes;
+    see TweetMediaAttachment.
+    """
+    return source.media_type in ["video", "animated_gif"]
 
 
 def get_all_media(
     extended_entities: typing.Dict,
     tweetid: str,
     archive: typing.Optional["TwitterArchive"],
+    downloader: typing.Optional[Downloader] = None,
 ) -> typing.List[TweetMediaAttachment]:
-    media: typing.List[TweetMediaAttachment] = []
-    for item in extended_entities.get("media", []):
-        if item["type"] == "photo":
-            attachment = get_media_photo(item, tweetid, archive)
-            media += [attachment]
-        elif item["type"] == "video":
-            attachment = get_media_video(item, tweetid, archive)
-            media += [attachment]
-        elif item["type"] == "animated_gif":
-            attachment = get_media_gif(item, tweetid, archive)
-            media += [attachment]
+    """Retrieve all media for a tweet
+
+    Media is read from the archive if one is passed;
+    archives sometimes leave files out, and those items are logged and skipped.
+    Otherwise, it is downloaded, with all items fetched concurrently.
+    Videos and GIFs are never read into memory:
+    those in an archive are referred to where they are,
+    and downloaded ones are streamed to temporary files.
+    """
+    sources = [
+        get_media_source(item, tweetid) for item in extended_entities.get("media", [])
+    ]
+    with profiling.phase("media", items=len(sources)) as measure:
+        if archive:
+            media = []
+            for source in sources:
+                path = get_archive_media_path(source, tweetid, archive)
+                if not os.path.exists(path):
+                    logger.warning(
+                        f"Media {path} for tweet {tweetid} is missing from the archive, skipping it"
+                    )
+                    continue
+                media.append(
+                    TweetMediaAttachment(*source, path=path)
+                    if is_large(source)
+                    else TweetMediaAttachment(
+                        *source, get_archive_media_data(source, tweetid, archive)
+                    )
+                )
         else:
-            raise Exception(
-                f"Unknown item type {item['type']} trying to download media for tweet {tweetid}"
+            downloader = downloader or default_downloader()
+            futures = [
+                downloader.submit_file(s.url)
+                if is_large(s)
+                else downloader.submit(s.url)
+                for s in sources
+            ]
+            media = [
+                TweetMediaAttachment(*source, path=future.result(), temporary=True)
+                if is_large(source)
+                else TweetMediaAttachment(*source, future.result())
+                for source, future in zip(sources, futures)
+            ]
+        if profiling.active():
+            measure.nbytes = sum(
+                os.path.getsize(m.path) if m.path else len(m.data) for m in media
             )
     return media
@@ -0,0 +1,367 @@
+"""Encoding and decoding JSON, quickly if possible
+
+If orjson is installed, it is used to decode JSON, and to encode compact JSON;
+otherwise, the standard library json module is.
+
+Output comes in two forms:
+
+canonical
+    Indented by 2 spaces, with sorted keys and only ASCII characters,
+    so that diffs are readable when tweets are committed to git.
+    This is always encoded by json.dumps(obj, indent=2, sort_keys=True),
+    whichever backend is in use.
+    orjson formats floats and non-ASCII characters differently,
+    and rewriting its output to match costs more than it saves.
+compact
+    No whitespace, keys in whatever order they come, and UTF-8,
+    for when nobody is going to read the file.
+
+Both backends build the whole document in memory before it is written.
+dump() instead streams it to a file a piece at a time,
+base64 encoding bytes in chunks as it goes,
+so that tweets with large media embedded never need a second copy of it in memory.
+skim() reads just a few top level keys from a file the same way,
+skipping over media without decoding it or holding all of it in memory.
+"""
+
+import base64
+import json
+import os
+import re
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKENDS = ("stdlib", "orjson")
+
+
+def check_backend(backend: str) -> str:
+    """Return backend if it is known and installed, or raise ValueError saying why not"""
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown JSON backend {backend!r}, expected one of {', '.join(BACKENDS)}"
+        )
+    if backend == "orjson" and orjson is None:
+        raise ValueError(
+            "JSON backend orjson is not installed; pip install twarchive[fast]"
+        )
+    return backend
+
+
+# Set TWARCHIVE_JSON_BACKEND=stdlib to use the standard library even if orjson is installed
+BACKEND = check_backend(
+    os.environ.get("TWARCHIVE_JSON_BACKEND") or ("orjson" if orjson else "stdlib")
+)
+
+
+def dumps(
+    obj: typing.Any,
+    default: typing.Optional[typing.Callable] = None,
+    compact: bool = False,
+    backend: str = "",
+) -> str:
+    """Encode obj as JSON
+
+    default is called for objects that can't otherwise be encoded, as with json.dumps.
+    Datetimes are always passed to it.
+    """
+    backend = backend or BACKEND
+    if not compact:
+        return json.dumps(obj, default=default, indent=2, sort_keys=True)
+    if backend == "orjson":
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(obj, default=default, option=options).decode()
+        except orjson.JSONEncodeError:
+            # orjson refuses some things the json module accepts, like integers over 64 bits
+            pass
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
+
+
+# Encode this many bytes of a bytes value at a time; a multiple of 3,
+# so that each chunk encodes to base64 without padding
+STREAM_CHUNK_SIZE = 3 * 256 * 1024
+
+# Characters that json.dumps() escapes in strings, with and without ensure_ascii
+_NEEDS_ESCAPE_ASCII = re.compile(r'[^\x20-\x7e]|["\\]')
+_NEEDS_ESCAPE = re.compile(r'[\x00-\x1f"\\]')
+
+
+def _iterencode_str(s: str, compact: bool) -> typing.Iterator[str]:
+    """Encode a string, passing long strings with nothing to escape (like base64) through in slices"""
+    needs_escape = _NEEDS_ESCAPE if compact else _NEEDS_ESCAPE_ASCII
+    if len(s) <= STREAM_CHUNK_SIZE or needs_escape.search(s):
+        yield json.dumps(s, ensure_ascii=not compact)
+    else:
+        yield '"'
+        for start in range(0, len(s), STREAM_CHUNK_SIZE):
+            yield s[start : start + STREAM_CHUNK_SIZE]
+        yield '"'
+
+
+def _iterencode_bytes(data: bytes) -> typing.Iterator[str]:
+    """Encode bytes as a base64 string, a chunk at a time"""
+    yield '"'
+    view = memoryview(data)
+    for start in range(0, len(view), STREAM_CHUNK_SIZE):
+        yield base64.b64encode(view[start : start + STREAM_CHUNK_SIZE]).decode()
+    yield '"'
+
+
+def _key(key: typing.Any) -> str:
+    """Convert a dict key to a string, the way the json module does"""
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {type(key)}")
+
+
+def _iterencode(
+    obj: typing.Any,
+    default: typing.Optional[typing.Callable],
+    compact: bool,
+    level: int,
+) -> typing.Iterator[str]:
+    if isinstance(obj, str):
+        yield from _iterencode_str(obj, compact)
+    elif obj is None or isinstance(obj, (bool, int, float)):
+        yield json.dumps(obj)
+    elif isinstance(obj, bytes):
+        yield from _iterencode_bytes(obj)
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            yield "[]"
+            return
+        if compact:
+            open_, separator, close = "[", ",", "]"
+        else:
+            indent = "\n" + "  " * (level + 1)
+            open_, separator, close = (
+                "[" + indent,
+                "," + indent,
+                "\n" + "  " * level + "]",
+            )
+        yield open_
+        for idx, item in enumerate(obj):
+            if idx:
+                yield separator
+            yield from _iterencode(item, default, compact, level + 1)
+        yield close
+    elif isinstance(obj, dict):
+        if not obj:
+            yield "{}"
+            return
+        if compact:
+            open_, separator, colon, close = "{", ",", ":", "}"
+            items = obj.items()
+        else:
+            indent = "\n" + "  " * (level + 1)
+            open_, separator, colon = "{" + indent, "," + indent, ": "
+            close = "\n" + "  " * level + "}"
+            items = sorted(obj.items())
+        yield open_
+        for idx, (key, value) in enumerate(items):
+            if idx:
+                yield separator
+            yield json.dumps(_key(key), ensure_ascii=not compact)
+            yield colon
+            yield from _iterencode(value, default, compact, level + 1)
+        yield close
+    elif default:
+        yield from _iterencode(default(obj), default, compact, level)
+    else:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dump(
+    obj: typing.Any,
+    fp: typing.TextIO,
+    default: typing.Optional[typing.Callable] = None,
+    compact: bool = False,
+):
+    """Encode obj as JSON and write it to fp a piece at a time
+
+    Canonical output is byte for byte the same as dumps().
+    Compact output is the same as the stdlib backend's.
+    Bytes may appear anywhere in obj, or be returned by default,
+    and are written as base64 strings a chunk at a time rather than encoded all at once;
+    long strings are also written out in slices.
+    Extra memory use is bounded by STREAM_CHUNK_SIZE, not by the size of obj.
+    """
+    pending: typing.List[str] = []
+    pending_size = 0
+    for piece in _iterencode(obj, default, compact, 0):
+        if len(piece) >= STREAM_CHUNK_SIZE:
+            fp.write("".join(pending))
+            fp.write(piece)
+            pending, pending_size = [], 0
+            continue
+        pending.append(piece)
+        pending_size += len(piece)
+        if pending_size >= STREAM_CHUNK_SIZE:
+            fp.write("".join(pending))
+            pending, pending_size = [], 0
+    fp.write("".join(pending))
+
+
+_NON_WHITESPACE = re.compile(r"\S")
+_QUOTE_OR_BACKSLASH = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r"[\s,\]}]")
+
+
+class _Skimmer:
+    """Walks a JSON document in a file a chunk at a time
+
+    Only the part of the document from mark (if set) or pos onwards is kept in memory.
+    """
+
+    def __init__(self, fp: typing.TextIO):
+        self.fp = fp
+        self.buf = ""
+        self.pos = 0
+        self.mark: typing.Optional[int] = None
+
+    def _more(self):
+        chunk = self.fp.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("Unexpected end of JSON")
+        cut = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[cut:] + chunk
+        self.pos -= cut
+        if self.mark is not None:
+            self.mark -= cut
+
+    def peek(self) -> str:
+        """Move past whitespace and return the next character"""
+        while True:
+            m = _NON_WHITESPACE.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            self._more()
+
+    def skip_string(self):
+        self.pos += 1
+        while True:
+            m = _QUOTE_OR_BACKSLASH.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+            elif m.group() == '"':
+                self.pos = m.end()
+                return
+            elif m.end() < len(self.buf):
+                # Skip the escaped character, which may be a quote
+                self.pos = m.end() + 1
+                continue
+            else:
+                # Keep the backslash until we have the character it escapes
+                self.pos = m.start()
+            self._more()
+
+    def skip_scalar(self):
+        while True:
+            m = _SCALAR_END.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return
+            self.pos = len(self.buf)
+            try:
+                self._more()
+            except ValueError:
+                # A number at the very end of the document
+                return
+
+    def skip_value(self):
+        depth = 0
+        while True:
+            char = self.peek()
+            if char == '"':
+                self.skip_string()
+            elif char in "{[":
+                depth += 1
+                self.pos += 1
+            elif char in "}]":
+                depth -= 1
+                self.pos += 1
+            elif char in ",:":
+                self.pos += 1
+            else:
+                self.skip_scalar()
+            if depth == 0:
+                return
+
+    def read_value(self) -> typing.Any:
+        self.peek()
+        self.mark = self.pos
+        self.skip_value()
+        text = self.buf[self.mark : self.pos]
+        self.mark = None
+        return json.loads(text)
+
+
+def skim(
+    fp: typing.TextIO, keys: typing.Collection[str]
+) -> typing.Dict[str, typing.Any]:
+    """Decode just some of the top level keys of a JSON object from fp
+
+    The file is read a chunk at a time,
+    and the values of other keys are skipped over without being decoded,
+    so memory use is bounded by STREAM_CHUNK_SIZE and the size of the values wanted,
+    not by the size of the file.
+    This works for any formatting, canonical or compact.
+    Keys that aren't in the object are left out of the result.
+    """
+    skimmer = _Skimmer(fp)
+    if skimmer.peek() != "{":
+        raise ValueError("Not a JSON object")
+    skimmer.pos += 1
+    result = {}
+    while len(result) < len(keys):
+        char = skimmer.peek()
+        if char == "}":
+            break
+        if char == ",":
+            skimmer.pos += 1
+            continue
+        key = skimmer.read_value()
+        if skimmer.peek() != ":":
+            raise ValueError(f"Expected ':' after key {key!r}")
+        skimmer.pos += 1
+        if key in keys:
+            result[key] = skimmer.read_value()
+        else:
+            skimmer.skip_value()
+    return result
+
+
+def _apply_object_hook(obj: typing.Any, object_hook: typing.Callable) -> typing.Any:
+    """Call object_hook on every dict in obj, innermost first, like json.loads does"""
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                obj[key] = _apply_object_hook(value, object_hook)
+        return object_hook(obj)
+    if isinstance(obj, list):
+        for idx, value in enumerate(obj):
+            if isinstance(value, (dict, list)):
+                obj[idx] = _apply_object_hook(value, object_hook)
+    return obj
+
+
+def loads(
+    s: typing.Union[str, bytes],
+    object_hook: typing.Optional[typing.Callable] = None,
+    backend: str = "",
+) -> typing.Any:
+    """Decode JSON, calling object_hook on every dict as json.loads does"""
+    backend = backend or BACKEND
+    if backend == "orjson":
+        obj = orjson.loads(s)
+        return _apply_object_hook(obj, object_hook) if object_hook else obj
+    return json.loads(s, object_hook=object_hook)
@@ -0,0 +1,284 @@
+"""Timing the phases of a run, for twarchive --profile
+
+Code that does a distinct kind of work wraps it in a phase:
+
+    with profiling.phase("parse") as measure:
+        ...
+        measure.items += 1
+        measure.nbytes += len(chunk)
+
+The phases are:
+
+parse       Decoding tweets from a Twitter archive
+inflate     Turning archive or API tweets into InflatedTweets
+media       Reading, downloading, and storing media and profile pictures
+derivatives Making resized copies of photos
+encode      Encoding tweets to JSON
+write       Saving tweets and pages to the site
+api         Waiting for Twitter API responses
+ratelimit   Waiting for rate limit tokens before API calls
+
+Phases nest, and each one counts only its own time:
+the time spent saving media to a blob store while encoding a tweet is counted as media, not encode.
+Nesting is tracked per thread,
+and time in different threads and worker processes is added together,
+so the total of all phases can be more than the wall time of the run.
+
+When no profile is running, phase() does almost nothing,
+so it is safe to use in hot loops.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import typing
+
+from twarchive import logger
+
+
+class Measure:
+    """What a phase did, which the code in the phase may add to"""
+
+    __slots__ = ["items", "nbytes", "child_seconds"]
+
+    def __init__(self, items: int = 0, nbytes: int = 0):
+        self.items = items
+        self.nbytes = nbytes
+        self.child_seconds = 0.0
+
+
+class PhaseStats(typing.NamedTuple):
+    seconds: float = 0.0
+    calls: int = 0
+    items: int = 0
+    nbytes: int = 0
+
+    def plus(self, other: "PhaseStats") -> "PhaseStats":
+        return PhaseStats(*(a + b for a, b in zip(self, other)))
+
+    def minus(self, other: "PhaseStats") -> "PhaseStats":
+        return PhaseStats(*(a - b for a, b in zip(self, other)))
+
+
+class Profiler:
+    """Phase timings for one run; safe to use from several threads at once"""
+
+    def __init__(self):
+        self.phases: typing.Dict[str, PhaseStats] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, name: str, stats: PhaseStats):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, PhaseStats()).plus(stats)
+
+    @property
+    def stack(self) -> typing.List[Measure]:
+        """The phases open in the calling thread, innermost last"""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def snapshot(self) -> typing.Dict[str, PhaseStats]:
+        with self._lock:
+            return dict(self.phases)
+
+
+_profiler: typing.Optional[Profiler] = None
+
+
+@contextlib.contextmanager
+def phase(name: str, items: int = 0, nbytes: int = 0) -> typing.Iterator[Measure]:
+    """Time a phase of work, if a profile is running
+
+    Don't use this around an await;
+    coroutines sharing a thread would interleave their phases.
+    Time those with add() instead.
+    """
+    measure = Measure(items, nbytes)
+    profiler = _profiler
+    if profiler is None:
+        yield measure
+        return
+    stack = profiler.stack
+    stack.append(measure)
+    start = time.perf_counter()
+    try:
+        yield measure
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1].child_seconds += elapsed
+        profiler.add(
+            name,
+            PhaseStats(
+                elapsed - measure.child_seconds, 1, measure.items, measure.nbytes
+            ),
+        )
+
+
+def timed(name: str, items: int = 0) -> typing.Callable:
+    """Decorate a function to time each call to it as a phase"""
+
+    def decorator(func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name, items=items):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add(name: str, seconds: float, items: int = 0, nbytes: int = 0):
+    """Record time spent in a phase that was measured some other way"""
+    if _profiler is not None:
+        _profiler.add(name, PhaseStats(seconds, 1, items, nbytes))
+
+
+def active() -> bool:
+    """Whether a profile is running in this process"""
+    return _profiler is not None
+
+
+def start_worker(profile: bool):
+    """Start recording in a worker process, if its parent is profiling
+
+    Forked workers are already recording, since they inherit the parent's profiler;
+    workers started some other way are not.
+    """
+    global _profiler
+    if profile and _profiler is None:
+        _profiler = Profiler()
+
+
+def snapshot() -> typing.Dict[str, PhaseStats]:
+    """Return the phases recorded so far in this process
+
+    Worker processes return since(snapshot()) from before their work to the parent,
+    which merge()s it.
+    """
+    return _profiler.snapshot() if _profiler else {}
+
+
+def since(before: typing.Dict[str, PhaseStats]) -> typing.Dict[str, PhaseStats]:
+    """Return what has been recorded since a snapshot"""
+    return {
+        name: stats.minus(before.get(name, PhaseStats()))
+        for name, stats in snapshot().items()
+    }
+
+
+def merge(phases: typing.Dict[str, PhaseStats]):
+    """Add phases recorded in a worker process to the profile"""
+    if _profiler is None:
+        return
+    for name, stats in phases.items():
+        _profiler.add(name, PhaseStats(*stats))
+
+
+def report(profiler: Profiler, wall_seconds: float) -> typing.Dict[str, typing.Any]:
+    """Summarize a profile, with throughput for each phase"""
+    phases = {}
+    for name, stats in sorted(profiler.snapshot().items()):
+        phases[name] = {
+            "seconds": round(stats.seconds, 6),
+            "calls": stats.calls,
+            "items": stats.items,
+            "bytes": stats.nbytes,
+            "items_per_second": round(stats.items / stats.seconds, 3)
+            if stats.seconds
+            else None,
+            "megabytes_per_second": round(stats.nbytes / 2**20 / stats.seconds, 3)
+            if stats.seconds
+            else None,
+        }
+    # save_tweet counts each tweet it saves under write
+    tweets = phases.get("write", {}).get("items", 0)
+    return {
+        "wall_seconds": round(wall_seconds, 6),
+        "tweets_saved": tweets,
+        "tweets_per_second": round(tweets / wall_seconds, 3) if wall_seconds else None,
+        "phases": phases,
+    }
+
+
+@contextlib.contextmanager
+def profile(
+    report_path: str,
+    command: typing.Sequence[str] = (),
+    cprofile: bool = False,
+    memory: bool = False,
+):
+    """Profile everything run inside this context, and write a JSON report to report_path
+
+    Arguments:
+        report_path:    Where to write the report
+        command:        The command line, recorded in the report
+        cprofile:       Also run cProfile on the main thread,
+                        and save its stats next to the report with a .prof extension
+        memory:         Also trace memory allocations with tracemalloc,
+                        and report the peak and the biggest allocation sites
+    """
+    global _profiler
+    profiler = Profiler()
+    started = datetime.datetime.now(datetime.timezone.utc)
+    profiler_cprofile = cProfile.Profile() if cprofile else None
+    if memory:
+        tracemalloc.start()
+    _profiler = profiler
+    if profiler_cprofile:
+        profiler_cprofile.enable()
+    start = time.perf_counter()
+    try:
+        yield profiler
+    finally:
+        wall_seconds = time.perf_counter() - start
+        if profiler_cprofile:
+            profiler_cprofile.disable()
+        _profiler = None
+
+        result = {
+            "command": list(command),
+            "started": started.isoformat(timespec="seconds"),
+            **report(profiler, wall_seconds),
+        }
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            tracemalloc.stop()
+            result["memory"] = {
+                "peak_bytes": peak,
+                "top": [
+                    {
+                        "location": str(stat.traceback),
+                        "bytes": stat.size,
+                        "count": stat.count,
+                    }
+                    for stat in top
+                ],
+            }
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        if profiler_cprofile:
+            cprofile_path = os.path.splitext(report_path)[0] + ".prof"
+            profiler_cprofile.dump_stats(cprofile_path)
+            result["cprofile"] = cprofile_path
+        with open(report_path, "w") as rfp:
+            json.dump(result, rfp, indent=2, sort_keys=True)
+
+        logger.info(
+            f"Profile: {wall_seconds:.2f}s wall time, {result['tweets_saved']} tweets saved"
+        )
+        for name, stats in result["phases"].items():
+            logger.info(
+                f"Profile: {name:<12} {stats['seconds']:9.3f}s {stats['calls']:7} calls {stats['items']:7} items {stats['bytes'] / 2**20:9.1f} MiB"
+            )
+        logger.info(f"Profile: report saved to {report_path}")
@@ -0,0 +1,110 @@
+"""Keeping Twitter API calls inside their rate limits
+
+Twitter limits each endpoint to some number of calls per 15 minute window.
+Rather than making calls until Twitter refuses one and then sleeping for the rest of the window,
+we draw every call from a token bucket per endpoint,
+which refills continuously at the rate the window allows.
+Calls are spread across the window,
+and whatever else the process is doing keeps going while a call waits for its token.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+
+from twarchive import profiling
+
+
+# Calls allowed per window for each endpoint we use, with user authentication
+# <https://developer.twitter.com/en/docs/twitter-api/v1/rate-limits>
+RATE_LIMIT_WINDOW = 15 * 60
+RATE_LIMITS = {
+    "statuses/lookup": 900,
+    "statuses/show": 900,
+    "statuses/user_timeline": 900,
+}
+
+
+class TokenBucket:
+    """A token bucket that allows limit calls per window seconds
+
+    The bucket starts full, so a short run can make calls in a burst.
+    Tokens may be taken from one thread (or one event loop) at a time,
+    but observe() and exhaust() may be called from any thread.
+    """
+
+    def __init__(self, limit: int, window: float = RATE_LIMIT_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        """Tokens added per second"""
+        return self.limit / self.window
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Return how many seconds until a token is available"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def _take(self):
+        with self._lock:
+            self.tokens -= 1
+
+    async def acquire(self):
+        """Wait for a token without blocking the event loop, then take it"""
+        start = time.perf_counter()
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self._take()
+        profiling.add("ratelimit", time.perf_counter() - start)
+
+    def acquire_blocking(self):
+        """Wait for a token, blocking the calling thread, then take it"""
+        with profiling.phase("ratelimit"):
+            while (delay := self.delay()) > 0:
+                time.sleep(delay)
+        self._take()
+
+    def observe(self, remaining: int, reset: float):
+        """Correct the bucket with the rate limit headers of a response
+
+        Twitter says how many calls are left in the window, and when it resets (a Unix time).
+        If that is fewer than the bucket holds,
+        for instance because another process is using the same credentials,
+        the bucket is drained to match, so we slow down before Twitter refuses a call.
+        """
+        if remaining <= 0:
+            self.exhaust(reset)
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+
+    def exhaust(self, reset: float):
+        """Empty the bucket until reset, a Unix time
+
+        Call this when Twitter refuses a call anyway,
+        for instance because another process is using the same credentials.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - max(0, reset - time.time()) * self.rate
+
+
+@functools.cache
+def bucket(endpoint: str) -> TokenBucket:
+    """The TokenBucket shared by everything in this process that calls an endpoint"""
+    return TokenBucket(RATE_LIMITS[endpoint])
@@ -0,0 +1,97 @@
+"""Finding tweets inlined into site content with twarchive shortcodes
+
+Content files are scanned in a single pass for both the twarchiveTweet and twarchiveThread shortcodes.
+The tweet IDs found in each file are cached along with the file's size and mtime,
+so that only files that changed since the last scan are read again.
+"""
+
+import json
+import os
+import re
+import tempfile
+import typing
+
+
+# Matches e.g. {{< twarchiveTweet "1234" >}} or {{% twarchiveThread "1234-intentionallyinvalid" %}}
+SHORTCODE_PATTERN = re.compile(
+    rb"\{\{. twarchive(?:Tweet|Thread) .(?P<tweetid>[0-9]+(?:-intentionallyinvalid)?)"
+)
+
+
+def scan_file(path: str) -> typing.List[str]:
+    """Return the tweet IDs inlined in a content file"""
+    with open(path, "rb") as cfp:
+        contents = cfp.read()
+    return sorted({m["tweetid"].decode() for m in SHORTCODE_PATTERN.finditer(contents)})
+
+
+class ShortcodeScanner:
+    """Find inlined tweets in a content directory, caching results per file
+
+    Arguments:
+        content:        The content directory to scan
+        cache_path:     A JSON file to keep the results for each file in
+        exclude:        Directories to skip
+                        Hidden files and directories are always skipped.
+    """
+
+    def __init__(
+        self, content: str, cache_path: str, exclude: typing.Iterable[str] = ()
+    ):
+        self.content = content
+        self.cache_path = cache_path
+        self.exclude = {os.path.normpath(e) for e in exclude}
+
+    def load_cache(self) -> typing.Dict[str, typing.List]:
+        try:
+            with open(self.cache_path) as cfp:
+                return json.load(cfp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_cache(self, cache: typing.Dict[str, typing.List]):
+        cachedir = os.path.dirname(self.cache_path)
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=cachedir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as cfp:
+            json.dump(cache, cfp)
+        os.replace(tmppath, self.cache_path)
+
+    def walk(self) -> typing.Iterator[os.DirEntry]:
+        """Yield every content file that should be scanned"""
+        dirs = [self.content]
+        while dirs:
+            try:
+                entries = list(os.scandir(dirs.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    if os.path.normpath(entry.path) not in self.exclude:
+                        dirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+    def scan(self) -> typing.Set[str]:
+        """Return the IDs of every inlined tweet
+
+        Only files whose size or mtime changed since the last scan are read.
+        """
+        cache = self.load_cache()
+        updated = {}
+        changed = False
+        for entry in self.walk():
+            relpath = os.path.relpath(entry.path, self.content)
+            stat = entry.stat()
+            cached = cache.pop(relpath, None)
+            if cached and cached[0:2] == [stat.st_size, stat.st_mtime_ns]:
+                updated[relpath] = cached
+                continue
+            updated[relpath] = [stat.st_size, stat.st_mtime_ns, scan_file(entry.path)]
+            changed = True
+        # Anything left in the cache was deleted
+        if changed or cache:
+            self.save_cache(updated)
+        return {tweetid for _, _, tweetids in updated.values() for tweetid in tweetids}
@@ -0,0 +1,337 @@
+"""Synthetic Twitter archives and Hugo sites, for tests and benchmarks
+
+Everything is generated from a seed, so the same parameters always produce the same files.
+"""
+
+import datetime
+import json
+import os
+import random
+import typing
+
+from twarchive.hugo import HugoSite
+
+
+# A mix of media sizes, in bytes, and how often each one occurs
+DEFAULT_MEDIA_SIZES = {
+    16 * 1024: 6,
+    128 * 1024: 3,
+    1024 * 1024: 1,
+}
+
+WORDS = [
+    "archive",
+    "bird",
+    "café",
+    "daemon",
+    "ephemeral",
+    "feed",
+    "garden",
+    "hugo",
+    "index",
+    "jekyll",
+    "kernel",
+    "läuft",
+    "markdown",
+    "network",
+    "ornithology",
+    "protocol",
+    "quote",
+    "reply",
+    "static",
+    "thread",
+    "🐦",
+    "🧵",
+]
+
+ACCOUNT_ID = "1000000001"
+PFP_FILENAME = "synthetic_pfp.jpg"
+
+
+class SyntheticArchiveParams(typing.NamedTuple):
+    """The shape of a synthetic archive
+
+    tweets:         The number of tweets, including replies and retweets
+    media_ratio:    The fraction of tweets that have media attached
+    media_sizes:    Maps media sizes in bytes to their relative weights
+    thread_depth:   The maximum number of tweets in a thread; 1 means no replies
+    thread_ratio:   The fraction of tweets that start or continue a thread
+    qt_ratio:       The fraction of tweets that quote an earlier tweet
+    rt_ratio:       The fraction of tweets that are low-fidelity retweets
+    seed:           The seed for the random number generator
+    """
+
+    tweets: int = 1000
+    media_ratio: float = 0.2
+    media_sizes: typing.Mapping[int, int] = DEFAULT_MEDIA_SIZES
+    thread_depth: int = 8
+    thread_ratio: float = 0.3
+    qt_ratio: float = 0.1
+    rt_ratio: float = 0.05
+    seed: int = 0
+
+
+def window_ytd(name: str, items: typing.List[typing.Dict]) -> str:
+    """Format items the way Twitter archives do"""
+    return f"window.YTD.{name}.part0 = " + json.dumps(items, indent=2)
+
+
+def synthetic_tweets(
+    params: SyntheticArchiveParams, username: str
+) -> typing.Iterator[typing.Tuple[typing.Dict, typing.List[typing.Tuple[str, int]]]]:
+    """Yield archive tweet dicts, along with the filenames and sizes of their media"""
+    rng = random.Random(params.seed)
+    sizes = list(params.media_sizes.keys())
+    weights = list(params.media_sizes.values())
+    # Snowflake IDs; they only need to increase
+    tweetid = 1200000000000000000
+    created = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    previous_ids: typing.List[str] = []
+    thread_parent: typing.Optional[str] = None
+    thread_length = 0
+
+    for idx in range(params.tweets):
+        tweetid += rng.randint(1, 10**12)
+        created += datetime.timedelta(seconds=rng.randint(1, 86400))
+        id_str = str(tweetid)
+
+        if rng.random() < params.rt_ratio:
+            text = f"RT @someone: {' '.join(rng.choices(WORDS, k=12))}"
+            entities = {"hashtags": [], "symbols": [], "user_mentions": [], "urls": []}
+            yield {
+                "retweeted": False,
+                "entities": entities,
+                "display_text_range": ["0", str(len(text))],
+                "favorite_count": "0",
+                "id_str": id_str,
+                "truncated": False,
+                "retweet_count": "0",
+                "id": id_str,
+                "created_at": created.strftime("%a %b %d %H:%M:%S %z %Y"),
+                "favorited": False,
+                "full_text": text,
+                "lang": "en",
+            }, []
+            continue
+
+        entities: typing.Dict[str, typing.List] = {
+            "hashtags": [],
+            "symbols": [],
+            "user_mentions": [],
+            "urls": [],
+        }
+        text = ""
+
+        def append(fragment: str) -> typing.List[str]:
+            """Append to the text and return the [start, end] indices of the fragment"""
+            nonlocal text
+            if text:
+                text += " "
+            start = len(text)
+            text += fragment
+            return [str(start), str(len(text))]
+
+        tweet: typing.Dict[str, typing.Any] = {}
+        in_thread = (
+            thread_parent is not None
+            and thread_length < params.thread_depth
+            and rng.random() < params.thread_ratio
+        )
+        if in_thread:
+            tweet["in_reply_to_status_id_str"] = thread_parent
+            tweet["in_reply_to_status_id"] = thread_parent
+            tweet["in_reply_to_user_id_str"] = ACCOUNT_ID
+            tweet["in_reply_to_user_id"] = ACCOUNT_ID
+            tweet["in_reply_to_screen_name"] = username
+            thread_length += 1
+        else:
+            thread_length = 1
+        thread_parent = id_str if params.thread_depth > 1 else None
+
+        for word in rng.choices(WORDS, k=rng.randint(5, 30)):
+            roll = rng.random()
+            if roll < 0.05:
+                entities["hashtags"].append(
+                    {"text": word, "indices": append(f"#{word}")}
+                )
+            elif roll < 0.1:
+                mention = f"user{rng.randint(1, 500)}"
+                entities["user_mentions"].append(
+                    {
+                        "name": mention.title(),
+                        "screen_name": mention,
+                        "indices": append(f"@{mention}"),
+                        "id_str": str(rng.randint(1, 10**9)),
+                        "id": "0",
+                    }
+                )
+            elif roll < 0.13:
+                entities["urls"].append(
+                    {
+                        "url": "https://t.co/synthetic",
+                        "expanded_url": f"https://example.com/{word}",
+                        "display_url": f"example.com/{word}",
+                        "indices": append("https://t.co/synthetic"),
+                    }
+                )
+            else:
+                append(word)
+            if roll > 0.97:
+                text += "\n"
+
+        if previous_ids and rng.random() < params.qt_ratio:
+            qtid = rng.choice(previous_ids)
+            entities["urls"].append(
+                {
+                    "url": "https://t.co/quoted",
+                    "expanded_url": f"https://twitter.com/{username}/status/{qtid}",
+                    "display_url": f"twitter.com/{username}/status/…",
+                    "indices": append("https://t.co/quoted"),
+                }
+            )
+
+        media_files = []
+        if rng.random() < params.media_ratio:
+            mediaitems = []
+            for _ in range(rng.randint(1, 4)):
+                key = f"{idx}{len(mediaitems)}syn"
+                filename = f"{key}.jpg"
+                media_files.append(
+                    (f"{id_str}-{filename}", rng.choices(sizes, weights)[0])
+                )
+                mediaitems.append(
+                    {
+                        "id_str": id_str,
+                        "id": id_str,
+                        "indices": append("https://t.co/media"),
+                        "media_url": f"http://pbs.twimg.com/media/{filename}",
+                        "media_url_https": f"https://pbs.twimg.com/media/{filename}",
+                        "url": "https://t.co/media",
+                        "display_url": "pic.twitter.com/media",
+                        "expanded_url": f"https://twitter.com/{username}/status/{id_str}/photo/1",
+                        "type": "photo",
+                        "sizes": {
+                            "small": {"w": "680", "h": "510", "resize": "fit"},
+                            "large": {"w": "2048", "h": "1536", "resize": "fit"},
+                        },
+                    }
+                )
+            entities["media"] = mediaitems
+            tweet["extended_entities"] = {"media": mediaitems}
+
+        tweet.update(
+            {
+                "retweeted": False,
+                "source": '<a href="https://mobile.twitter.com" rel="nofollow">Twitter Web App</a>',
+                "entities": entities,
+                "display_text_range": ["0", str(len(text))],
+                "favorite_count": str(rng.randint(0, 100)),
+                "id_str": id_str,
+                "truncated": False,
+                "retweet_count": str(rng.randint(0, 10)),
+                "id": id_str,
+                "created_at": created.strftime("%a %b %d %H:%M:%S %z %Y"),
+                "favorited": False,
+                "full_text": text,
+                "lang": "en",
+            }
+        )
+        previous_ids.append(id_str)
+        yield tweet, media_files
+
+
+def make_archive(
+    path: str,
+    params: SyntheticArchiveParams = SyntheticArchiveParams(),
+    username: str = "synthetic",
+) -> typing.List[str]:
+    """Write a synthetic, extracted Twitter archive to path
+
+    Returns the IDs of the tweets in the archive, oldest first.
+    """
+    rng = random.Random(params.seed)
+    data = os.path.join(path, "data")
+    profile_media = os.path.join(data, "profile_media")
+    tweet_media = os.path.join(data, "tweet_media")
+    os.makedirs(profile_media, exist_ok=True)
+    os.makedirs(tweet_media, exist_ok=True)
+
+    manifest = {
+        "userInfo": {
+            "accountId": ACCOUNT_ID,
+            "userName": username,
+            "displayName": "Synthetic Account",
+        },
+        "archiveInfo": {
+            "generationDate": "2022-05-06T17:27:17.889Z",
+            "isPartialArchive": False,
+        },
+    }
+    with open(os.path.join(data, "manifest.js"), "w") as fp:
+        fp.write("window.__THAR_CONFIG = " + json.dumps(manifest, indent=2))
+    account = {
+        "account": {
+            "username": username,
+            "accountId": ACCOUNT_ID,
+            "createdAt": "2009-04-24T19:18:20.000Z",
+            "accountDisplayName": "Synthetic Account",
+        }
+    }
+    with open(os.path.join(data, "account.js"), "w") as fp:
+        fp.write(window_ytd("account", [account]))
+    profile = {
+        "profile": {
+            "description": {"bio": "", "website": "", "location": ""},
+            "avatarMediaUrl": f"https://pbs.twimg.com/profile_images/1/{PFP_FILENAME}",
+            "headerMediaUrl": "https://pbs.twimg.com/profile_banners/1/1",
+        }
+    }
+    with open(os.path.join(data, "profile.js"), "w") as fp:
+        fp.write(window_ytd("profile", [profile]))
+    with open(os.path.join(profile_media, f"{ACCOUNT_ID}-{PFP_FILENAME}"), "wb") as fp:
+        fp.write(rng.randbytes(8 * 1024))
+
+    # Write tweet.js one tweet at a time, so that huge archives don't have to fit in memory
+    tweetids = []
+    with open(os.path.join(data, "tweet.js"), "w") as fp:
+        fp.write("window.YTD.tweet.part0 = [")
+        for tweet, media_files in synthetic_tweets(params, username):
+            if tweetids:
+                fp.write(",")
+            fp.write("\n" + json.dumps({"tweet": tweet}, indent=2))
+            tweetids.append(tweet["id_str"])
+            for filename, size in media_files:
+                with open(os.path.join(tweet_media, filename), "wb") as mfp:
+                    mfp.write(rng.randbytes(size))
+        fp.write("\n]")
+    return tweetids
+
+
+def make_site(
+    path: str,
+    tweetids: typing.Sequence[str],
+    pages: int = 100,
+    inlines_per_page: int = 5,
+    seed: int = 0,
+) -> HugoSite:
+    """Make a Hugo site at path, with content pages that inline some of tweetids
+
+    Pages inline tweets with both the twarchiveTweet and twarchiveThread shortcodes.
+    No tweets are saved to the site; use e.g. twitterarchive.archive2data for that.
+    """
+    rng = random.Random(seed)
+    site = HugoSite(path)
+    posts = os.path.join(site.content, "posts")
+    for directory in [posts, site.content_twarchive, site.data_twarchive]:
+        os.makedirs(directory, exist_ok=True)
+    for pagenum in range(pages):
+        lines = ["---", f"title: Post {pagenum}", "---", ""]
+        for _ in range(inlines_per_page):
+            lines.append(" ".join(rng.choices(WORDS, k=40)))
+            lines.append("")
+            shortcode = rng.choice(["twarchiveTweet", "twarchiveThread"])
+            lines.append(f'{{{{< {shortcode} "{rng.choice(tweetids)}" >}}}}')
+            lines.append("")
+        with open(os.path.join(posts, f"post{pagenum}.md"), "w") as fp:
+            fp.write("\n".join(lines))
+    return site
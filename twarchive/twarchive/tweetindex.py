@@ -0,0 +1,198 @@
+"""A SQLite index of the tweets saved to a site's data directory
+
+The index holds the metadata that commands need to make decisions about tweets,
+like their dates, users, and the tweets they refer to,
+so that those commands do not have to list or parse the data directory.
+
+It is kept up to date by hugo.save_tweet(),
+and can always be rebuilt from the data files on disk.
+"""
+
+import json
+import os
+import sqlite3
+import typing
+
+from twarchive import jsonbackend
+from twarchive import logger
+from twarchive.inflatedtweet.inflatedtweet import InflatedTweet, json_datetime
+
+
+# The fields from a tweet's data file that the index records
+TWEET_METADATA_FIELDS = [
+    "date",
+    "username",
+    "replyto_tweetid",
+    "thread_parent_id",
+    "qts",
+    "rt_of",
+]
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    date TEXT,
+    username TEXT,
+    replyto_tweetid TEXT,
+    thread_parent_id TEXT,
+    qts TEXT,
+    rt_of TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tweets_username ON tweets (username);
+CREATE INDEX IF NOT EXISTS tweets_replyto_tweetid ON tweets (replyto_tweetid);
+"""
+
+
+def read_tweet_metadata(tweet_json_path: str) -> typing.Dict:
+    """Read just the fields in TWEET_METADATA_FIELDS from a tweet data file
+
+    The file is read a chunk at a time with jsonbackend.skim(),
+    which skips over media and profile pictures without decoding them,
+    so even a tweet with enormous media embedded is never loaded into memory all at once.
+    """
+    with open(tweet_json_path, encoding="utf-8") as tjfp:
+        metadata = jsonbackend.skim(tjfp, TWEET_METADATA_FIELDS)
+    return {field: metadata.get(field) for field in TWEET_METADATA_FIELDS}
+
+
+def tweet_metadata(infltweet: InflatedTweet) -> typing.Dict:
+    """Return the fields in TWEET_METADATA_FIELDS from an inflated tweet, as they are saved in JSON"""
+    return {
+        "date": json_datetime(infltweet.date) if infltweet.date else None,
+        "username": infltweet.username,
+        "replyto_tweetid": infltweet.replyto_tweetid,
+        "thread_parent_id": infltweet.thread_parent_id,
+        "qts": infltweet.qts,
+        "rt_of": infltweet.rt_of,
+    }
+
+
+class TweetIndex:
+    """A SQLite index of the tweets in a data directory
+
+    The database connection is opened on first use,
+    and is not pickled,
+    so a TweetIndex can be passed to worker processes which will open their own.
+
+    Data files are either data_dir/<id>.json,
+    or with bundles, data_dir/<id>/tweet.json.
+    Filenames in the index are relative to data_dir.
+    """
+
+    def __init__(self, path: str, data_dir: str, bundles: bool = False):
+        self.path = path
+        self.data_dir = data_dir
+        self.bundles = bundles
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        self.created = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.created = not os.path.exists(self.path)
+            # Worker processes may write to the index at the same time,
+            # so wait for locks rather than failing.
+            # Within a process, the connection may be used from more than one thread,
+            # but never from two at once.
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(INDEX_SCHEMA)
+            if self.created:
+                self.sync()
+        return self._conn
+
+    def update(self, filename: str, metadata: typing.Dict):
+        """Record metadata for a data file, which must already be written"""
+        stat = os.stat(os.path.join(self.data_dir, filename))
+        tweetid = os.path.splitext(filename.split(os.sep)[0])[0]
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO tweets
+                (id, filename, date, username, replyto_tweetid, thread_parent_id, qts, rt_of, size, mtime_ns)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    tweetid,
+                    filename,
+                    metadata.get("date"),
+                    metadata.get("username"),
+                    metadata.get("replyto_tweetid"),
+                    metadata.get("thread_parent_id"),
+                    json.dumps(metadata.get("qts") or []),
+                    metadata.get("rt_of"),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ),
+            )
+
+    def data_files(self) -> typing.Iterator[typing.Tuple[str, str, os.stat_result]]:
+        """Yield the filename, path, and stat of every data file"""
+        try:
+            entries = list(os.scandir(self.data_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if self.bundles:
+                if not entry.is_dir():
+                    continue
+                filename = os.path.join(entry.name, "tweet.json")
+                path = os.path.join(self.data_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield filename, path, stat
+            elif entry.name.endswith(".json") and entry.is_file():
+                yield entry.name, entry.path, entry.stat()
+
+    def sync(self) -> int:
+        """Bring the index up to date with the data directory
+
+        Only files that are new or whose size or mtime have changed are read.
+        Returns the number of index entries that changed.
+        """
+        known = {
+            row["filename"]: (row["size"], row["mtime_ns"])
+            for row in self.conn.execute("SELECT filename, size, mtime_ns FROM tweets")
+        }
+        changed = 0
+        for filename, path, stat in self.data_files():
+            if known.pop(filename, None) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            self.update(filename, read_tweet_metadata(path))
+            changed += 1
+        if known:
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM tweets WHERE filename = ?",
+                    [(filename,) for filename in known],
+                )
+            changed += len(known)
+        if changed:
+            logger.info(f"Updated {changed} entries in tweet index {self.path}")
+        return changed
+
+    def rebuild(self):
+        """Throw away the index and rebuild it from the data directory"""
+        with self.conn:
+            self.conn.execute("DELETE FROM tweets")
+        self.sync()
+
+    def ids(self) -> typing.Set[str]:
+        """Return the IDs of every tweet in the index"""
+        return {row["id"] for row in self.conn.execute("SELECT id FROM tweets")}
+
+    def rows(self) -> typing.Iterator[sqlite3.Row]:
+        """Return every row in the index"""
+        return self.conn.execute("SELECT * FROM tweets")
@@ -1,13 +1,18 @@
 """Functionality that involves talking to the Twitter API"""
 
+import json
 import os
+import typing
 
 import tweepy
 
+from twarchive import apitelemetry
+from twarchive import crawler
 from twarchive import hugo
 from twarchive import logger
+from twarchive import profiling
+from twarchive import ratelimit
 from twarchive.inflatedtweet.inflatedtweet import InflatedTweet
-from twarchive.inflatedtweet.from_tweepy import inflated_tweet_from_tweepy
 
 
 def authenticate(consumer_key: str, consumer_secret: str) -> tweepy.API:
@@ -18,11 +23,16 @@ def authenticate(consumer_key: str, consumer_secret: str) -> tweepy.API:
 
 def get_status_expanded(api: tweepy.API, tweetid: str) -> tweepy.models.Status:
     """Get a status"""
-    tweet = api.get_status(
-        tweetid,
-        include_ext_alt_text=True,
-        tweet_mode="extended",
-    )
+    ratelimit.bucket("statuses/show").acquire_blocking()
+    with profiling.phase("api", items=1):
+        tweet = apitelemetry.call(
+            api,
+            "statuses/show",
+            api.get_status,
+            tweetid,
+            include_ext_alt_text=True,
+            tweet_mode="extended",
+        )
     return tweet
 
 
@@ -43,7 +53,7 @@ def tweet2data(
 ):
     """Save a tweet to site data
 
-    Save its QTs as well.
+    Save its QTs, parent, and retweeted tweet as well.
 
     Arguments:
         site:               A hugo.HugoSite object
@@ -51,8 +61,8 @@ def tweet2data(
         tweetid:            The ID of a tweet to save
         tweet:              An already retrieved Status object from tweepy
         force:              Redownload a tweet that already exists in site data.
-        rlevel:             The recursion level of this function call.
-                            This function calls itself for each QT, incrementing this value each time.
+        rlevel:             The recursion level of the tweet.
+                            Related tweets are retrieved at one level deeper than the tweet that refers to them.
                             At some level we will stop, in case we are in some pathological case.
         max_rlevel:         The maximum number of QT or parent tweets to retrieve.
     """
@@ -60,84 +70,92 @@ def tweet2data(
     if (tweetid and tweet) or (not tweetid and not tweet):
         raise Exception("Must provide exactly one of tweet or tweetid")
 
-    if not tweetid:
-        tweetid = tweet.id_str
+    tweetcrawler = crawler.Crawler(site, api, force=force, max_rlevel=max_rlevel)
+    if tweet:
+        tweetcrawler.add_status(tweet, rlevel)
+    else:
+        tweetcrawler.add(tweetid, rlevel)
+    tweetcrawler.run()
 
-    filename = os.path.join(site.data_twarchive, f"{tweetid}.json")
 
-    if os.path.exists(filename) and not force:
-        logger.info(
-            f"Tweet {tweetid} already exists in site data and force=False, not downloading"
-        )
-        return
+def tweets2data(
+    site: hugo.HugoSite,
+    api: tweepy.API,
+    tweetids: typing.Iterable[str],
+    force=False,
+    max_rlevel=20,
+    crawl: str = "",
+) -> int:
+    """Save many tweets to site data, along with their QTs, parents, and retweeted tweets
 
-    if rlevel > max_rlevel:
-        logger.warning(
-            f"WARNING! Recursion level of {rlevel}, refusing to download tweet {tweetid}"
-        )
-        return
+    All tweets are retrieved in one crawl,
+    so tweets that several of them refer to are downloaded only once.
+    If crawl is passed, progress is kept in the site's crawl journal under that name;
+    see crawler.Crawler.
 
-    if not tweet:
-        logger.info(f"Downloading tweet {tweetid}")
-        tweet = get_status_expanded(api, tweetid)
+    Returns the number of tweets saved.
+    """
+    tweetcrawler = crawler.Crawler(
+        site, api, force=force, max_rlevel=max_rlevel, crawl=crawl
+    )
+    for tweetid in tweetids:
+        tweetcrawler.add(tweetid)
+    return tweetcrawler.run()
 
-    infltweet = inflated_tweet_from_tweepy(tweet)
-    infltweet.jdump(filepath=filename)
-    rlevel += 1
-
-    related_tweets = []
-    related_tweets.extend(infltweet.qts)
-    if infltweet.thread_parent_id:
-        related_tweets.append(infltweet.thread_parent_id)
-    try:
-        related_tweets.append(tweet.retweeted_status.id_str)
-    except AttributeError:
-        pass
-
-    for reltweet in related_tweets:
-        tweet2data_continue_on_error(
-            site,
-            api,
-            tweetid=reltweet,
-            force=force,
-            rlevel=rlevel,
-            max_rlevel=max_rlevel,
-        )
 
+class UserSyncState:
+    """The newest tweet saved from each user's timeline, so that syncing it again only asks for newer tweets
 
-def tweet2data_continue_on_error(
-    site: hugo.HugoSite,
-    api: tweepy.API,
-    tweetid: str = "",
-    tweet: tweepy.models.Status = None,
-    force=False,
-    rlevel=0,
-    max_rlevel=20,
-):
-    """Call tweet2data() with the parameters, and handle exceptions from missing/removed tweets
+    Saved to .twarchive/user-sync.json.
+    For each user, by lowercased screen name, we record:
 
-    Tweepy will raise exceptions if a tweet has been deleted or an account has gone private.
-    Catch and log these exceptions, then continue.
+    newest_id:          The newest tweet saved from their timeline.
+                        The next sync passes it to Twitter as since_id.
+    pending_newest_id:  The newest tweet seen by a sync that hasn't finished.
+                        It becomes newest_id only once every tweet from that sync has been saved,
+                        so an interrupted sync never causes tweets to be skipped,
+                        even if the crawl journal is deleted.
     """
-    try:
-        tweet2data(
-            site,
-            api,
-            tweetid=tweetid,
-            tweet=tweet,
-            force=force,
-            rlevel=rlevel,
-            max_rlevel=max_rlevel,
-        )
-    except tweepy.errors.NotFound:
-        # This appears to mean the tweet (or account) were intentionally deleted
-        logger.warning(f"Could not find tweet with ID {tweetid}")
-    except tweepy.errors.Forbidden as exc:
-        # This appears to happen when the account was suspended
-        exc_message = str(exc).replace("\n", " ")
-        logger.warning(
-            f"Not permitted to access tweet with ID {tweetid}: {exc_message}"
-        )
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as sfp:
+                contents = json.load(sfp)
+        except FileNotFoundError:
+            contents = {}
+        self.users: typing.Dict[str, typing.Dict[str, str]] = contents.get("users", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as sfp:
+            json.dump({"users": self.users}, sfp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def newest_id(self, screen_name: str) -> typing.Optional[str]:
+        """Return the newest tweet saved from a user's timeline, if we have synced it before"""
+        return self.users.get(screen_name.lower(), {}).get("newest_id")
+
+    def saw(self, screen_name: str, tweetid: str):
+        """Record a tweet seen on a user's timeline by a sync in progress"""
+        user = self.users.setdefault(screen_name.lower(), {})
+        pending = user.get("pending_newest_id")
+        if pending and int(pending) >= int(tweetid):
+            return
+        user["pending_newest_id"] = tweetid
+        self.save()
+
+    def finish(self, screen_name: str):
+        """Record that every tweet seen by a sync has been saved"""
+        user = self.users.get(screen_name.lower(), {})
+        pending = user.pop("pending_newest_id", None)
+        if not pending:
+            return
+        newest = user.get("newest_id")
+        if not newest or int(pending) > int(newest):
+            user["newest_id"] = pending
+        self.save()
 
 
 def usertweets2data(
@@ -160,38 +178,76 @@ def usertweets2data(
                         If force is True, this has no extra effect.
                         If force is False, the program will not redownload QTs or media
                         for tweets it already has, but will check all tweets the Twitter API lets us retrieve.
+
+    Once a user's timeline has been synced,
+    the newest tweet from it is kept in .twarchive/user-sync.json (see UserSyncState),
+    and later syncs only ask Twitter for tweets newer than that,
+    unless force or retrieve_all is True.
+    A user with no new tweets costs a single API call.
+
+    Progress is kept in the site's crawl journal,
+    so if this is interrupted, running it again with the same screen_name continues where it stopped.
     """
 
     # Twitter API limit
     max_tweets_per_call = 200
 
-    downloaded_tweets = hugo.get_downloaded_tweets(site)
-    user_tweets = []
-    oldest = None
-    while True:
-        logger.info(f"Retrieving tweets for @{screen_name} older than {oldest}")
-        new_tweets = api.user_timeline(
-            screen_name=screen_name,
-            count=max_tweets_per_call,
-            tweet_mode="extended",
-            max_id=oldest,
+    crawl = f"user2data/{screen_name.lower()}"
+    journal = site.crawl_journal
+    sync_state = UserSyncState(site.user_sync_state)
+    since_id = None if force or retrieve_all else sync_state.newest_id(screen_name)
+    oldest, paginated = journal.cursor(crawl)
+    if oldest or paginated:
+        logger.info(f"Resuming retrieving tweets for @{screen_name}")
+    # Everything newer than since_id is new to us,
+    # so there is no need to check against the tweets we already have.
+    downloaded_tweets = set() if since_id else hugo.get_downloaded_tweets(site)
+    retrieved = 0
+    while not paginated:
+        logger.info(
+            f"Retrieving tweets for @{screen_name} older than {oldest} and newer than {since_id}"
         )
-        if not new_tweets:
-            break
-
+        ratelimit.bucket("statuses/user_timeline").acquire_blocking()
+        with profiling.phase("api") as measure:
+            new_tweets = apitelemetry.call(
+                api,
+                "statuses/user_timeline",
+                api.user_timeline,
+                screen_name=screen_name,
+                count=max_tweets_per_call,
+                tweet_mode="extended",
+                max_id=oldest,
+                since_id=since_id,
+            )
+            measure.items = len(new_tweets)
         if force:
+            unseen_tweets = new_tweets
+        else:
+            unseen_tweets = [t for t in new_tweets if t.id_str not in downloaded_tweets]
+        retrieved += len(unseen_tweets)
+        paginated = not new_tweets or (
+            not retrieve_all and len(unseen_tweets) < len(new_tweets)
+        )
+        if new_tweets:
             oldest = str(new_tweets[-1].id - 1)
-            continue
-
-        unseen_tweets = [t for t in new_tweets if t.id_str not in downloaded_tweets]
-        user_tweets.extend(unseen_tweets)
-        if not retrieve_all and len(unseen_tweets) < len(new_tweets):
-            break
-        oldest = str(new_tweets[-1].id - 1)
+            sync_state.saw(screen_name, new_tweets[0].id_str)
+        journal.save_page(crawl, oldest, paginated, [t._json for t in unseen_tweets])
 
     logger.info(
-        f"Finished retrieving tweets for @{screen_name}, got {len(user_tweets)} tweets (force={force}, retrieve_all={retrieve_all})"
+        f"Finished retrieving tweets for @{screen_name}, got {retrieved} tweets (force={force}, retrieve_all={retrieve_all})"
     )
 
-    for tweet in user_tweets:
-        tweet2data(site, api, tweet=tweet, force=force, max_rlevel=max_rlevel)
+    if retrieved or journal.pending(crawl):
+        tweetcrawler = crawler.Crawler(
+            site, api, force=force, max_rlevel=max_rlevel, crawl=crawl
+        )
+        tweetcrawler.run()
+        if 0 in tweetcrawler.failed.values():
+            # Keep asking for the failed tweets from the timeline until they are saved
+            logger.warning(
+                f"Some tweets from @{screen_name}'s timeline could not be saved; the next sync will retry them"
+            )
+            return
+    else:
+        journal.finish(crawl)
+    sync_state.finish(screen_name)
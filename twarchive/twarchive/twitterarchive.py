@@ -9,17 +9,21 @@ Note that a tweet found in an archive should _never_ be redownloaded,
 at least as long as Twitter does not permit edits.
 """
 
+import collections
+import concurrent.futures
 import datetime
 from functools import cache
 import functools
+import hashlib
 import json
 import os
 import re
+import time
 import typing
 
 import tweepy
 
-from twarchive import hugo, logger, twitterapi
+from twarchive import crawler, hugo, logger, profiling
 from twarchive.inflatedtweet.from_twitter_archive import (
     inflated_tweet_from_twitter_archive,
     twitter_archive_tweet_is_low_fidelity_retweet,
@@ -108,6 +112,74 @@ def parse_twitter_window_YTD_bullshit(
     return parsed
 
 
+def iter_twitter_window_YTD_bullshit(
+    archivefile: str,
+    chunksize: int = 1024 * 1024,
+) -> typing.Iterator[typing.Any]:
+    """Yield each item in the array of a window.YTD archive file, one at a time
+
+    Unlike parse_twitter_window_YTD_bullshit(),
+    this never holds the whole file in memory.
+    It reads the file in chunks, skips past the window.YTD prefix,
+    and decodes one array item at a time.
+    Memory use is bounded by the chunk size and the size of the largest single item.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[ \t\n\r]*")
+    with open(archivefile) as afp:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def refill():
+            """Drop consumed input and read more, at least doubling what is left over"""
+            nonlocal buf, pos, eof
+            more = afp.read(max(chunksize, len(buf) - pos))
+            if not more:
+                eof = True
+            buf = buf[pos:] + more
+            pos = 0
+
+        # Skip the window.YTD.whatever.partN = prefix, up to the opening bracket
+        while "[" not in buf:
+            refill()
+            if eof:
+                raise ValueError(f"No JSON array found in {archivefile}")
+        prefix, _ = buf.split("[", 1)
+        if prefix.strip() and not re.match(
+            r"^window\.YTD\.[a-zA-Z0-9_]+\.part[a-zA-Z0-9_]+ = $", prefix
+        ):
+            raise ValueError(f"Unexpected prefix {prefix!r} in {archivefile}")
+        pos = len(prefix) + 1
+
+        while True:
+            # Skip whitespace and the commas between items
+            while True:
+                pos = whitespace.match(buf, pos).end()
+                if pos < len(buf) and buf[pos] == ",":
+                    pos += 1
+                    continue
+                if pos < len(buf) or eof:
+                    break
+                refill()
+            if pos >= len(buf):
+                raise ValueError(f"Unterminated JSON array in {archivefile}")
+            if buf[pos] == "]":
+                return
+            try:
+                with profiling.phase("parse") as measure:
+                    item, end = decoder.raw_decode(buf, pos)
+                    measure.items, measure.nbytes = 1, end - pos
+            except json.JSONDecodeError:
+                # Probably an item split across chunks; read more and try again
+                if eof:
+                    raise
+                refill()
+                continue
+            yield item
+            pos = end
+
+
 def find_archives(site: hugo.HugoSite) -> typing.List[str]:
     """Find archives saved locally.
 
@@ -132,16 +204,125 @@ def find_archives(site: hugo.HugoSite) -> typing.List[str]:
     return archives
 
 
+class ArchiveImportManifest:
+    """A record of which archive tweets have already been imported to a site
+
+    Saved to .twarchive/archive-imports.json.
+    For each archive, we record its generation date.
+    For each tweet, we record a fingerprint of the tweet dict from the archive,
+    so that re-importing the same (or a newer) archive can skip tweets that have not changed.
+    Fingerprints are only recorded once their tweets are saved,
+    and the manifest is saved every save_interval seconds during an import,
+    so an import that is interrupted picks up where it left off.
+    """
+
+    save_interval = 30
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_saved = time.monotonic()
+        try:
+            with open(path) as mfp:
+                contents = json.load(mfp)
+        except FileNotFoundError:
+            contents = {}
+        self.archives: typing.Dict[str, typing.Dict] = contents.get("archives", {})
+        self.tweets: typing.Dict[str, str] = contents.get("tweets", {})
+
+    @staticmethod
+    def fingerprint(tweet: typing.Dict) -> str:
+        """Return a fingerprint of a tweet dict from an archive"""
+        canonical = json.dumps(tweet, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as mfp:
+            json.dump(
+                {"archives": self.archives, "tweets": self.tweets},
+                mfp,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
+        self.last_saved = time.monotonic()
+
+    def record(self, fingerprints: typing.Mapping[str, str]):
+        """Record the fingerprints of tweets that have been saved
+
+        The manifest is saved if it hasn't been for save_interval seconds.
+        """
+        self.tweets.update(fingerprints)
+        if time.monotonic() - self.last_saved >= self.save_interval:
+            self.save()
+
+
+def save_archive_tweets(
+    site: hugo.HugoSite,
+    archive: TwitterArchive,
+    tweets: typing.List[typing.Dict],
+    pfp_bytes: bytes,
+    username: str,
+    displayname: str,
+):
+    """Inflate regular (not low fidelity retweet) tweets from an archive and save them to site data
+
+    This is the unit of work for archive2data,
+    which may run it in a worker process.
+    """
+    for tweet in tweets:
+        logger.info(
+            f"Tweet {tweet['id_str']} in archive {archive.path} is a regular tweet, saving to disk..."
+        )
+        infltweet = inflated_tweet_from_twitter_archive(
+            tweet,
+            pfp_bytes,
+            username,
+            displayname,
+            archive,
+        )
+        hugo.save_tweet(site, infltweet)
+
+
+def save_archive_tweets_in_worker(
+    profile: bool, *args
+) -> typing.Dict[str, profiling.PhaseStats]:
+    """Run save_archive_tweets() in a worker process, and return what it profiled"""
+    profiling.start_worker(profile)
+    before = profiling.snapshot()
+    save_archive_tweets(*args)
+    return profiling.since(before)
+
+
 def archive2data(
     site: hugo.HugoSite,
     archive: TwitterArchive,
     api: typing.Optional[tweepy.API] = None,
     max_recurse=1,
     api_force_download=False,
+    jobs=1,
+    chunksize=64,
+    reimport_all=False,
 ):
-    """Parse all the tweets in an archive and return a list of InflatedTweet objects"""
+    """Parse all the tweets in an archive and save them to site data
+
+    Tweets are read from the archive one at a time,
+    so memory use does not grow with the size of the archive.
+
+    Arguments:
+        jobs:       The number of processes to inflate and save tweets,
+                    and to make image derivatives, with.
+                    If 1, do everything in this process.
+                    If 0, use one process per CPU.
+        chunksize:  The number of tweets sent to a worker process at a time.
+        reimport_all:
+                    Inflate and save every tweet,
+                    even ones that the import manifest says are already saved and unchanged.
+    """
 
-    os.makedirs(site.data_twarchive, exist_ok=True)
+    os.makedirs(site.tweet_data_dir, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
 
     parsed_account = parse_twitter_window_YTD_bullshit(archive.accountjs)
     account = parsed_account[0]["account"]
@@ -157,39 +338,103 @@ def archive2data(
     with open(pfp_path, "br") as pfpfp:
         pfp_bytes = pfpfp.read()
 
-    parsed_tweets = parse_twitter_window_YTD_bullshit(archive.tweetjs)
-
-    infltweets: typing.List[InflatedTweet] = []
-    for outertweet in parsed_tweets:
-        tweet = outertweet["tweet"]
-        tweetid = tweet["id_str"]
-        logprefix = f"Tweet {tweetid} in archive {archive.path}"
-        if twitter_archive_tweet_is_low_fidelity_retweet(tweet):
-            if api:
-                logger.info(
-                    f"{logprefix} is a low fidelity retweet, will try to download the original from Twitter..."
-                )
-                twitterapi.tweet2data_continue_on_error(
-                    site,
-                    api,
-                    tweetid,
-                    None,
-                    force=api_force_download,
-                    max_rlevel=max_recurse,
-                )
+    # Add the profile picture to the table before saving any tweets,
+    # so that worker processes never have to write the table concurrently.
+    hugo.save_user_pfp(site, username, pfp_bytes)
+
+    # Low fidelity retweets are downloaded from the API after all regular tweets are saved.
+    lowfi_retweet_ids: typing.List[str] = []
+
+    manifest = ArchiveImportManifest(site.archive_import_manifest)
+    counts = collections.Counter()
+
+    def regular_tweet_chunks() -> typing.Iterator[
+        typing.Tuple[typing.List[typing.Dict], typing.Dict[str, str]]
+    ]:
+        """Yield chunks of tweets to save, with the fingerprints of the tweets in each"""
+        chunk = []
+        fingerprints = {}
+        for outertweet in iter_twitter_window_YTD_bullshit(archive.tweetjs):
+            tweet = outertweet["tweet"]
+            tweetid = tweet["id_str"]
+            if twitter_archive_tweet_is_low_fidelity_retweet(tweet):
+                lowfi_retweet_ids.append(tweetid)
+                continue
+            fingerprint = manifest.fingerprint(tweet)
+            previous = manifest.tweets.get(tweetid)
+            saved = os.path.exists(site.tweet_data_path(tweetid))
+            if previous == fingerprint and saved:
+                if not reimport_all:
+                    counts["skipped"] += 1
+                    continue
+                counts["resaved"] += 1
             else:
-                logger.info(
-                    f"{logprefix} is low fidelity retweet and api argument was not passed, skipping..."
-                )
+                counts["changed" if previous and saved else "new"] += 1
+            fingerprints[tweetid] = fingerprint
+            chunk.append(tweet)
+            if len(chunk) >= chunksize:
+                yield chunk, fingerprints
+                chunk = []
+                fingerprints = {}
+        if chunk:
+            yield chunk, fingerprints
+
+    saveargs = (pfp_bytes, username, displayname)
+    try:
+        if jobs == 1:
+            for chunk, fingerprints in regular_tweet_chunks():
+                save_archive_tweets(site, archive, chunk, *saveargs)
+                manifest.record(fingerprints)
         else:
-            logger.info(f"{logprefix} is a regular tweet, saving to disk...")
-            infltweet = inflated_tweet_from_twitter_archive(
-                tweet,
-                pfp_bytes,
-                username,
-                displayname,
-                archive,
-            )
-            filename = os.path.join(site.data_twarchive, f"{tweetid}.json")
-            infltweet.jdump(filepath=filename)
-            infltweets.append(infltweet)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Keep only a few chunks in flight,
+                # so that we don't read the whole archive into memory waiting for workers.
+                pending: typing.Deque[
+                    typing.Tuple[concurrent.futures.Future, typing.Dict[str, str]]
+                ] = collections.deque()
+                for chunk, fingerprints in regular_tweet_chunks():
+                    future = executor.submit(
+                        save_archive_tweets_in_worker,
+                        profiling.active(),
+                        site,
+                        archive,
+                        chunk,
+                        *saveargs,
+                    )
+                    pending.append((future, fingerprints))
+                    if len(pending) >= 2 * jobs:
+                        future, fingerprints = pending.popleft()
+                        profiling.merge(future.result())
+                        manifest.record(fingerprints)
+                while pending:
+                    future, fingerprints = pending.popleft()
+                    profiling.merge(future.result())
+                    manifest.record(fingerprints)
+
+        manifest.archives[os.path.basename(os.path.normpath(archive.path))] = {
+            "generation_date": archive.generation_date.isoformat(),
+        }
+    finally:
+        # Even if the import fails, remember the tweets that were saved
+        manifest.save()
+    logger.info(
+        f"Imported archive {archive.path}: {counts['new']} new, {counts['changed']} changed, {counts['skipped']} skipped and {counts['resaved']} re-saved (unchanged) tweets"
+    )
+    hugo.image_derivatives(site, jobs=jobs)
+
+    if not lowfi_retweet_ids:
+        return
+    if api:
+        logger.info(
+            f"{len(lowfi_retweet_ids)} tweets in archive {archive.path} are low fidelity retweets, will try to download the originals from Twitter..."
+        )
+        tweetcrawler = crawler.Crawler(
+            site, api, force=api_force_download, max_rlevel=max_recurse
+        )
+        for tweetid in lowfi_retweet_ids:
+            tweetcrawler.add(tweetid)
+        tweetcrawler.run()
+    else:
+        logger.info(
+            f"{len(lowfi_retweet_ids)} tweets in archive {archive.path} are low fidelity retweets and api argument was not passed, skipping..."
+        )
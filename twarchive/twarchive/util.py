@@ -1,7 +1,21 @@
 """Internal utilities"""
 
+import errno
 import os
 import re
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Read and write large files this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+# The Linux ioctl to make a copy-on-write clone of a file (a reflink), on filesystems that support it
+FICLONE = 0x40049409
 
 
 def uri_is_tweet(uri: str) -> bool:
@@ -48,3 +62,43 @@ def guess_mime_type(filename: str) -> str:
     extension = re.sub("\?.*", "", extension)
 
     return mime_types[extension]
+
+
+def copy_file(src: str, dst: str):
+    """Copy a file without reading it into memory
+
+    Try a reflink first, which shares the file's blocks on filesystems like btrfs and XFS;
+    then copy_file_range(), which copies inside the kernel;
+    then an ordinary copy in chunks.
+    """
+    with open(src, "rb") as sfp, open(dst, "wb") as dfp:
+        if fcntl:
+            try:
+                fcntl.ioctl(dfp.fileno(), FICLONE, sfp.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(sfp.fileno(), dfp.fileno(), CHUNK_SIZE * 64):
+                    pass
+                return
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                    raise
+                dfp.truncate(0)
+                sfp.seek(0)
+                dfp.seek(0)
+        shutil.copyfileobj(sfp, dfp, CHUNK_SIZE)
+
+
+def link_or_copy(src: str, dst: str):
+    """Hard link a file, or copy it if that isn't possible (e.g. across filesystems)
+
+    Only use this for files that are never modified in place,
+    since a hard link shares its contents with the original.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)